@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Daraja (M-Pesa) API
+
+Serves the OAuth and STK push endpoints with injectable latency and error
+rates so USSD load tests never touch Safaricom.
+
+    python benchmarks/daraja_stub.py --port 8099 --stk-latency-ms 800 --error-rate 0.05
+    MPESA_BASE_URL=http://127.0.0.1:8099 python ussd.py
+"""
+
+import argparse
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+OAUTH_PATH = '/oauth/v1/generate'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+STATS_PATH = '/__stub/stats'
+
+
+class StubSettings:
+    def __init__(self, oauth_latency_ms: float = 50, stk_latency_ms: float = 300,
+                 jitter_ms: float = 50, error_rate: float = 0.0, token_ttl: int = 3599):
+        self.oauth_latency_ms = oauth_latency_ms
+        self.stk_latency_ms = stk_latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.lock = threading.Lock()
+        self.counts = {'oauth': 0, 'stk_push': 0, 'errors': 0}
+
+    def delay(self, base_ms: float):
+        time.sleep(max(0.0, base_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def make_handler(settings: StubSettings):
+    class DarajaStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _inject_error(self) -> bool:
+            if settings.error_rate and random.random() < settings.error_rate:
+                settings.count('errors')
+                self._send_json(503, {'errorCode': '503.001.01', 'errorMessage': 'Service unavailable (stub)'})
+                return True
+            return False
+
+        def do_GET(self):
+            if self.path == STATS_PATH:
+                with settings.lock:
+                    return self._send_json(200, dict(settings.counts))
+            if not self.path.startswith(OAUTH_PATH):
+                return self._send_json(404, {'errorMessage': 'Not found'})
+            settings.count('oauth')
+            settings.delay(settings.oauth_latency_ms)
+            if self._inject_error():
+                return
+            self._send_json(200, {'access_token': uuid.uuid4().hex, 'expires_in': str(settings.token_ttl)})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if not self.path.startswith(STK_PUSH_PATH):
+                return self._send_json(404, {'errorMessage': 'Not found'})
+            settings.count('stk_push')
+            settings.delay(settings.stk_latency_ms)
+            if self._inject_error():
+                return
+            try:
+                json.loads(body or b'{}')
+            except ValueError:
+                return self._send_json(400, {'errorMessage': 'Invalid JSON'})
+            self._send_json(200, {
+                'MerchantRequestID': uuid.uuid4().hex[:12],
+                'CheckoutRequestID': f'ws_CO_{uuid.uuid4().hex[:16]}',
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+                'CustomerMessage': 'Success. Request accepted for processing'
+            })
+
+    return DarajaStubHandler
+
+
+def start_stub(host: str = '127.0.0.1', port: int = 0, settings: StubSettings = None):
+    """Start the stub in a background thread, returns (server, base_url, settings)"""
+    settings = settings or StubSettings()
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='daraja-stub', daemon=True).start()
+    return server, f'http://{host}:{server.server_port}', settings
+
+
+def start_stub_process(settings: StubSettings, host: str = '127.0.0.1'):
+    """Run the stub in a child process so it does not compete with the app under test
+    for the GIL. Returns (process, base_url)."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([
+        sys.executable, __file__, '--host', host, '--port', str(port),
+        '--oauth-latency-ms', str(settings.oauth_latency_ms),
+        '--stk-latency-ms', str(settings.stk_latency_ms),
+        '--jitter-ms', str(settings.jitter_ms),
+        '--error-rate', str(settings.error_rate)
+    ], stdout=subprocess.DEVNULL)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.2):
+                return process, f'http://{host}:{port}'
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Daraja stub did not start")
+
+
+def fetch_stats(base_url: str) -> dict:
+    import urllib.request
+    with urllib.request.urlopen(base_url + STATS_PATH, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local Daraja API stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--oauth-latency-ms', type=float, default=50)
+    parser.add_argument('--stk-latency-ms', type=float, default=300)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    settings = StubSettings(args.oauth_latency_ms, args.stk_latency_ms, args.jitter_ms, args.error_rate)
+    server, base_url, _ = start_stub(args.host, args.port, settings)
+    print(f"Daraja stub listening on {base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(5)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"Requests served: {settings.counts}")
+
+
+if __name__ == '__main__':
+    main()
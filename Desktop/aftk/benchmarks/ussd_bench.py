@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+USSD load test and benchmark
+
+Replays realistic Africa's Talking USSD sessions (sessionId, phoneNumber and
+cumulative `text` paths such as 2*1*1) at a configurable concurrency and
+reports p50/p95/p99 latency per menu node, throughput and error rates.
+
+By default the USSD Flask app runs in-process against a throwaway database
+seeded with synthetic tenants, with M-Pesa OAuth/STK calls going to the local
+Daraja stub. Use --url to load an already running server instead.
+
+    python benchmarks/ussd_bench.py --sessions 2000 --concurrency 32
+    python benchmarks/ussd_bench.py --save-baseline month_end
+    python benchmarks/ussd_bench.py --baseline month_end   # exits 1 on regression
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from daraja_stub import StubSettings, start_stub_process, fetch_stats
+
+# Each scenario is one dial: a list of (menu node, cumulative text) hops
+SCENARIOS = {
+    'check_dues': [('main', ''), ('check_dues', '1'), ('main', '1*1'), ('exit', '1*1*0')],
+    'pay_mpesa': [('main', ''), ('pay_rent', '2'), ('payment_methods', '2*1'),
+                  ('mpesa', '2*1*1'), ('payment_completed', '2*1*1*1')],
+    'back_navigation': [('main', ''), ('pay_rent', '2'), ('payment_methods', '2*1'),
+                        ('pay_rent', '2*1*#'), ('main', '2*1*#*2'), ('exit', '2*1*#*2*0')],
+    'airtel': [('main', ''), ('pay_rent', '2'), ('payment_methods', '2*1'),
+               ('airtel', '2*1*2'), ('payment_methods', '2*1*2*1'), ('exit', '2*1*2*1*0')],
+    'quick_exit': [('main', ''), ('exit', '0')],
+}
+
+# Month-end mix: most dials are payments
+SCENARIO_WEIGHTS = {
+    'pay_mpesa': 0.5,
+    'check_dues': 0.25,
+    'back_navigation': 0.1,
+    'airtel': 0.05,
+    'quick_exit': 0.1,
+}
+
+UNKNOWN_CALLER_SHARE = 0.05
+
+ERROR_MARKERS = ('Invalid choice', 'error', 'not available', 'busy', 'Session expired', 'not found')
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def is_error(status: int, body: str, last_hop: bool) -> bool:
+    if status != 200 or not (body.startswith('CON ') or body.startswith('END ')):
+        return True
+    if body.startswith('END ') and not last_hop:
+        return True
+    return any(marker in body for marker in ERROR_MARKERS)
+
+
+class InProcessTarget:
+    """Drive the USSD Flask app directly through its WSGI test client"""
+
+    def __init__(self, tenants: int, stub_url: str, seed: int):
+        self.db_dir = tempfile.mkdtemp(prefix='rentpay-bench-')
+        os.environ['RENTPAY_DB_PATH'] = os.path.join(self.db_dir, 'bench.db')
+        os.environ['MPESA_BASE_URL'] = stub_url
+        os.environ.setdefault('MPESA_CONSUMER_KEY', 'bench-key')
+        os.environ.setdefault('MPESA_CONSUMER_SECRET', 'bench-secret')
+        os.environ.setdefault('MPESA_SHORTCODE', '174379')
+        os.environ.setdefault('MPESA_PASSKEY', 'bench-passkey')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+        import ussd
+        self.ussd = ussd
+        rng = random.Random(seed)
+        estates = [f'Estate {i}' for i in range(50)]
+        ussd.tenant_store.bulk_upsert({
+            phone: {
+                'name': f'Tenant {i}',
+                'house_number': f'HSe no. {i}',
+                'estate': rng.choice(estates),
+                'rent_due': rng.randrange(5000, 60000, 500),
+                'last_payment': '2024-01-15'
+            }
+            for i, phone in enumerate(tenant_phones(tenants))
+        })
+        self._local = threading.local()
+
+    def post(self, session_id: str, phone: str, text: str):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.ussd.app.test_client()
+        response = client.post('/ussd', data={
+            'sessionId': session_id, 'serviceCode': '*384*11897#', 'phoneNumber': phone, 'text': text
+        })
+        return response.status_code, response.get_data(as_text=True)
+
+    def stk_summary(self, timeout: float = 30) -> dict:
+        """Wait for queued STK pushes to drain and summarise their outcome"""
+        if not self.ussd.mpesa_available:
+            return {}
+        queue = self.ussd.stk_queue
+        deadline = time.time() + timeout
+        while queue.stats()['pending'] and time.time() < deadline:
+            time.sleep(0.05)
+        statuses = {}
+        for job in list(queue._jobs.values()):
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return statuses
+
+
+class HttpTarget:
+    """Drive a running USSD server over HTTP"""
+
+    def __init__(self, url: str):
+        import requests
+        self.url = url
+        self.requests = requests
+        self._local = threading.local()
+
+    def post(self, session_id: str, phone: str, text: str):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+        try:
+            response = session.post(self.url, data={
+                'sessionId': session_id, 'serviceCode': '*384*11897#', 'phoneNumber': phone, 'text': text
+            }, timeout=10)
+            return response.status_code, response.text
+        except self.requests.RequestException as e:
+            return 0, str(e)
+
+    def stk_summary(self, timeout: float = 0) -> dict:
+        return {}
+
+
+def tenant_phones(count: int) -> list:
+    return [f'+2547{i:08d}' for i in range(count)]
+
+
+def run_load(target, sessions: int, concurrency: int, tenants: int, seed: int, think_ms: float) -> dict:
+    rng = random.Random(seed)
+    names = list(SCENARIO_WEIGHTS)
+    weights = [SCENARIO_WEIGHTS[name] for name in names]
+    phones = tenant_phones(tenants)
+
+    plan = []
+    for _ in range(sessions):
+        if rng.random() < UNKNOWN_CALLER_SHARE:
+            plan.append(('unknown_caller', f'+2541{rng.randrange(10 ** 8):08d}',
+                         [('main', ''), ('exit', '0')]))
+        else:
+            name = rng.choices(names, weights)[0]
+            plan.append((name, rng.choice(phones), SCENARIOS[name]))
+
+    samples = {}
+    errors = {}
+    lock = threading.Lock()
+    next_index = [0]
+
+    def worker():
+        local_samples = {}
+        local_errors = {}
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= len(plan):
+                break
+            _, phone, hops = plan[index]
+            session_id = f'ATUid_{uuid.uuid4().hex}'
+            for hop_number, (node, text) in enumerate(hops):
+                started = time.perf_counter()
+                status, body = target.post(session_id, phone, text)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                local_samples.setdefault(node, []).append(elapsed_ms)
+                if is_error(status, body, last_hop=hop_number == len(hops) - 1):
+                    local_errors[node] = local_errors.get(node, 0) + 1
+                if think_ms:
+                    time.sleep(think_ms / 1000)
+        with lock:
+            for node, values in local_samples.items():
+                samples.setdefault(node, []).extend(values)
+            for node, count in local_errors.items():
+                errors[node] = errors.get(node, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f'bench-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    nodes = {}
+    total_hops = 0
+    total_errors = 0
+    for node, values in sorted(samples.items()):
+        values.sort()
+        total_hops += len(values)
+        total_errors += errors.get(node, 0)
+        nodes[node] = {
+            'count': len(values),
+            'errors': errors.get(node, 0),
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'p99_ms': round(percentile(values, 99), 3),
+            'max_ms': round(values[-1], 3)
+        }
+
+    return {
+        'sessions': sessions,
+        'concurrency': concurrency,
+        'duration_s': round(duration, 3),
+        'hops': total_hops,
+        'throughput_hops_per_s': round(total_hops / duration, 1) if duration else 0.0,
+        'error_rate': round(total_errors / total_hops, 4) if total_hops else 0.0,
+        'nodes': nodes
+    }
+
+
+def print_report(report: dict):
+    print(f"\nSessions: {report['sessions']}  Concurrency: {report['concurrency']}  "
+          f"Duration: {report['duration_s']}s")
+    print(f"Throughput: {report['throughput_hops_per_s']} hops/s  Error rate: {report['error_rate']:.2%}\n")
+    print(f"{'node':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for node, stats in report['nodes'].items():
+        print(f"{node:<20}{stats['count']:>8}{stats['errors']:>8}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+    if report.get('stk_jobs'):
+        print(f"\nSTK jobs: {report['stk_jobs']}")
+    if report.get('daraja_stub'):
+        print(f"Daraja stub requests: {report['daraja_stub']}")
+
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BASELINE_DIR, f'{name}.json')
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    """List regressions: per-node p95/p99 latency, throughput and error rate"""
+    regressions = []
+    for node, stats in report['nodes'].items():
+        base = baseline.get('nodes', {}).get(node)
+        if not base:
+            continue
+        for key in ('p95_ms', 'p99_ms'):
+            if stats[key] > base[key] * (1 + tolerance) and stats[key] - base[key] > min_delta_ms:
+                regressions.append(f"{node} {key}: {base[key]:.2f} -> {stats[key]:.2f}")
+    if report['throughput_hops_per_s'] < baseline['throughput_hops_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput: {baseline['throughput_hops_per_s']} -> {report['throughput_hops_per_s']} hops/s")
+    if report['error_rate'] > baseline['error_rate'] + 0.01:
+        regressions.append(f"error rate: {baseline['error_rate']:.2%} -> {report['error_rate']:.2%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='USSD load test with a simulated gateway')
+    parser.add_argument('--sessions', type=int, default=1000, help='USSD dials to replay')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent gateway connections')
+    parser.add_argument('--tenants', type=int, default=10000, help='synthetic tenants (in-process mode)')
+    parser.add_argument('--think-ms', type=float, default=0, help='pause between hops of a session')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--url', help='benchmark a running server, e.g. http://localhost:5000/ussd')
+    parser.add_argument('--oauth-latency-ms', type=float, default=50)
+    parser.add_argument('--stk-latency-ms', type=float, default=300)
+    parser.add_argument('--jitter-ms', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Daraja stub error injection rate')
+    parser.add_argument('--save-baseline', metavar='NAME', help='save the report as a named baseline')
+    parser.add_argument('--baseline', metavar='NAME', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore latency changes below this')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    stub = None
+    if args.url:
+        target = HttpTarget(args.url)
+    else:
+        settings = StubSettings(args.oauth_latency_ms, args.stk_latency_ms, args.jitter_ms, args.error_rate)
+        stub, stub_url = start_stub_process(settings)
+        target = InProcessTarget(args.tenants, stub_url, args.seed)
+
+    try:
+        report = run_load(target, args.sessions, args.concurrency, args.tenants, args.seed, args.think_ms)
+        report['stk_jobs'] = target.stk_summary()
+        if stub is not None:
+            report['daraja_stub'] = fetch_stats(stub_url)
+    finally:
+        if stub is not None:
+            stub.terminate()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path(args.save_baseline), 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved: {baseline_path(args.save_baseline)}")
+
+    if args.baseline:
+        with open(baseline_path(args.baseline)) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("\nRegressions against baseline '%s':" % args.baseline)
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print(f"\nNo regressions against baseline '{args.baseline}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Circuit breaker for upstream APIs
+
+Tracks the error and slow-call rates of recent calls over a rolling window.
+Once either rate passes its threshold the circuit opens and calls fail fast
+with CircuitOpenError instead of tying up a worker on a degraded upstream.
+After a cool-down the circuit goes half-open and lets a few probe calls
+through: if they succeed it closes again, if any fails it re-opens.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from logging_setup import event
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_rate: float = 0.5, slow_call_rate: float = 0.8,
+                 slow_call_seconds: float = 5, min_calls: int = 10, window: float = 30,
+                 open_seconds: float = 30, half_open_probes: int = 1):
+        """
+        failure_rate / slow_call_rate: fraction of calls in the window that opens the circuit
+        min_calls: calls needed in the window before the rates are trusted
+        open_seconds: cool-down before probe calls are let through
+        half_open_probes: successful probes needed to close the circuit again
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._calls = deque()  # (finished_at, failed, slow)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probes_passed = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def is_open(self) -> bool:
+        """True while calls would be rejected (cool-down not over yet)"""
+        return self.state == OPEN
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning("Circuit %s %s -> %s", self.name, self._state, state,
+                       extra=event('circuit.state', circuit=self.name, state=state))
+        self._state = state
+        self._calls.clear()
+        self._probes_in_flight = 0
+        self._probes_passed = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+
+    def before_call(self):
+        """Reserve a call slot, raises CircuitOpenError when the upstream is being avoided"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes_in_flight + self._probes_passed < self.half_open_probes:
+                self._probes_in_flight += 1
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+
+    def release(self):
+        """Give back the slot of a call allowed by before_call that was never sent"""
+        with self._lock:
+            if self._current_state(time.monotonic()) == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record(self, failed: bool, elapsed: float):
+        """Report the outcome of a call allowed by before_call"""
+        now = time.monotonic()
+        slow = elapsed >= self.slow_call_seconds
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.half_open_probes:
+                        self._transition(CLOSED)
+                return
+            if state == OPEN:
+                return  # a call that started before the circuit opened
+
+            calls = self._calls
+            calls.append((now, failed, slow))
+            while calls and calls[0][0] < now - self.window:
+                calls.popleft()
+            if len(calls) < self.min_calls:
+                return
+            failures = sum(1 for _, call_failed, _ in calls if call_failed)
+            slow_calls = sum(1 for _, _, call_slow in calls if call_slow)
+            if failures >= self.failure_rate * len(calls) or slow_calls >= self.slow_call_rate * len(calls):
+                self._transition(OPEN)
+
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            calls = len(self._calls)
+            return {
+                'state': state,
+                'calls_in_window': calls,
+                'failures_in_window': sum(1 for _, failed, _ in self._calls if failed),
+                'slow_in_window': sum(1 for _, _, slow in self._calls if slow),
+                'rejected': self.rejected
+            }
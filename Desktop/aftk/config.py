@@ -18,6 +18,9 @@ class Config:
     else:
         MPESA_BASE_URL = 'https://api.safaricom.co.ke'
     
+    # Override the Daraja host, e.g. to point at the local stub used by the benchmarks
+    MPESA_BASE_URL = os.getenv('MPESA_BASE_URL') or MPESA_BASE_URL
+    
     MPESA_OAUTH_URL = f'{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials'
     MPESA_STK_PUSH_URL = f'{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest'
     
@@ -26,3 +29,88 @@ class Config:
     
     # Cache settings
     ACCESS_TOKEN_CACHE_DURATION = 3600  # 1 hour in seconds
+    TOKEN_CACHE_BACKEND = os.getenv('MPESA_TOKEN_CACHE', 'sqlite')  # sqlite (shared by workers) or memory
+    TOKEN_CACHE_PATH = os.getenv('MPESA_TOKEN_CACHE_PATH', '')  # defaults to the RentPay database
+    TOKEN_REFRESH_RATIO = float(os.getenv('MPESA_TOKEN_REFRESH_RATIO', '0.6'))  # renew in background
+    TOKEN_EXPIRY_RATIO = float(os.getenv('MPESA_TOKEN_EXPIRY_RATIO', '0.8'))  # stop using the token
+    TOKEN_REFRESH_LEASE = float(os.getenv('MPESA_TOKEN_REFRESH_LEASE', '30'))
+    
+    # Per-landlord paybills (JSON list, see mpesa_integrations.py); MPESA_* above is the default
+    MPESA_INTEGRATIONS_FILE = os.getenv('MPESA_INTEGRATIONS_FILE', '')
+    MPESA_PREWARM_WORKERS = int(os.getenv('MPESA_PREWARM_WORKERS', '8'))  # concurrent token fetches at startup
+    
+    # Phone numbers are stored in E.164; local numbers (07..., 7...) get this country code
+    PHONE_COUNTRY_CODE = os.getenv('PHONE_COUNTRY_CODE', '254')
+    
+    # Tenant database (SQLite, shared by the USSD app and the dashboard)
+    DATABASE_PATH = os.getenv('RENTPAY_DB_PATH', 'rentpay.db')
+    DATABASE_BUSY_TIMEOUT = float(os.getenv('RENTPAY_DB_BUSY_TIMEOUT', '5'))
+    
+    # Landlord dashboard tenant lists
+    DASHBOARD_PAGE_SIZE = int(os.getenv('DASHBOARD_PAGE_SIZE', '50'))
+    DASHBOARD_MAX_PAGE_SIZE = int(os.getenv('DASHBOARD_MAX_PAGE_SIZE', '200'))
+    
+    # Background STK push workers
+    STK_WORKERS = int(os.getenv('MPESA_STK_WORKERS', '8'))
+    STK_MAX_PENDING = int(os.getenv('MPESA_STK_MAX_PENDING', '500'))
+    STK_MAX_TRACKED_JOBS = int(os.getenv('MPESA_STK_MAX_TRACKED_JOBS', '10000'))
+    
+    # USSD session state (tenant, balance snapshot, navigation) kept between hops of one dial
+    USSD_SESSION_TTL = float(os.getenv('USSD_SESSION_TTL', '180'))  # gateway session lifetime
+    USSD_MAX_SESSIONS = int(os.getenv('USSD_MAX_SESSIONS', '50000'))
+    
+    # Daraja HTTP connection pool
+    MPESA_HTTP_POOL_SIZE = int(os.getenv('MPESA_HTTP_POOL_SIZE', '20'))
+    MPESA_HTTP_CONNECT_TIMEOUT = float(os.getenv('MPESA_HTTP_CONNECT_TIMEOUT', '5'))
+    MPESA_HTTP_READ_TIMEOUT = float(os.getenv('MPESA_HTTP_READ_TIMEOUT', '30'))
+    MPESA_HTTP_RETRIES = int(os.getenv('MPESA_HTTP_RETRIES', '3'))  # idempotent calls only
+    MPESA_HTTP_BACKOFF = float(os.getenv('MPESA_HTTP_BACKOFF', '0.5'))
+    
+    # Daraja deadlines and circuit breaker
+    STK_PUSH_DEADLINE = float(os.getenv('MPESA_STK_PUSH_DEADLINE', '8'))  # seconds from the USSD hop that queued it
+    MPESA_BREAKER_FAILURE_RATE = float(os.getenv('MPESA_BREAKER_FAILURE_RATE', '0.5'))
+    MPESA_BREAKER_SLOW_CALL_RATE = float(os.getenv('MPESA_BREAKER_SLOW_CALL_RATE', '0.8'))
+    MPESA_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('MPESA_BREAKER_SLOW_CALL_SECONDS', '5'))
+    MPESA_BREAKER_MIN_CALLS = int(os.getenv('MPESA_BREAKER_MIN_CALLS', '10'))
+    MPESA_BREAKER_WINDOW = float(os.getenv('MPESA_BREAKER_WINDOW', '30'))  # seconds of calls considered
+    MPESA_BREAKER_OPEN_SECONDS = float(os.getenv('MPESA_BREAKER_OPEN_SECONDS', '30'))  # cool-down before probing
+    MPESA_BREAKER_HALF_OPEN_PROBES = int(os.getenv('MPESA_BREAKER_HALF_OPEN_PROBES', '1'))
+    
+    # M-Pesa callback ledger (group commit)
+    LEDGER_BATCH_SIZE = int(os.getenv('LEDGER_BATCH_SIZE', '200'))
+    LEDGER_BATCH_WINDOW = float(os.getenv('LEDGER_BATCH_WINDOW', '0.005'))  # seconds to wait for more callbacks
+    LEDGER_ACK_TIMEOUT = float(os.getenv('LEDGER_ACK_TIMEOUT', '5'))
+    
+    # SMS delivery reports (group commit)
+    DELIVERY_REPORT_BATCH_SIZE = int(os.getenv('DELIVERY_REPORT_BATCH_SIZE', '200'))
+    DELIVERY_REPORT_BATCH_WINDOW = float(os.getenv('DELIVERY_REPORT_BATCH_WINDOW', '0.005'))
+    DELIVERY_REPORT_ACK_TIMEOUT = float(os.getenv('DELIVERY_REPORT_ACK_TIMEOUT', '5'))
+    
+    # Background bulk-invoice jobs
+    INVOICE_JOB_CHUNK_SIZE = int(os.getenv('INVOICE_JOB_CHUNK_SIZE', '100'))  # recipients per checkpoint
+    INVOICE_JOB_LEASE = float(os.getenv('INVOICE_JOB_LEASE', '60'))  # seconds before another worker may resume
+    
+    # Outbound SMS spool drained by `python sms_spool.py` (SMS_SPOOL_ENABLED=true to use it)
+    SMS_SPOOL_PATH = os.getenv('SMS_SPOOL_PATH', '')  # defaults to the RentPay database
+    SMS_SPOOL_BATCH_SIZE = int(os.getenv('SMS_SPOOL_BATCH_SIZE', '100'))
+    SMS_SPOOL_POLL_INTERVAL = float(os.getenv('SMS_SPOOL_POLL_INTERVAL', '0.5'))
+    SMS_SPOOL_MAX_ATTEMPTS = int(os.getenv('SMS_SPOOL_MAX_ATTEMPTS', '8'))
+    SMS_SPOOL_RETRY_BASE = float(os.getenv('SMS_SPOOL_RETRY_BASE', '5'))  # first retry delay, doubles each time
+    SMS_SPOOL_RETRY_MAX = float(os.getenv('SMS_SPOOL_RETRY_MAX', '900'))
+    SMS_SPOOL_LEASE = float(os.getenv('SMS_SPOOL_LEASE', '120'))  # seconds a sender may hold a message
+    SMS_SPOOL_RETENTION_DAYS = float(os.getenv('SMS_SPOOL_RETENTION_DAYS', '30'))  # then finished messages are purged
+    
+    # Request profiling, switched at runtime through /debug/profile
+    PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'false').lower() == 'true'  # until first switched
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0.01'))  # fraction of requests profiled
+    PROFILE_MODE = os.getenv('PROFILE_MODE', 'stack')  # stack (sampling) or cprofile
+    PROFILE_STACK_INTERVAL = float(os.getenv('PROFILE_STACK_INTERVAL', '0.005'))  # seconds between stack samples
+    PROFILE_SETTINGS_TTL = float(os.getenv('PROFILE_SETTINGS_TTL', '2'))  # seconds before workers re-read the switch
+    PROFILE_OUTPUT_DIR = os.getenv('PROFILE_OUTPUT_DIR', 'profiles')
+    PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')  # required in X-Profile-Token; local requests only if unset
+    
+    # Logging
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text or json
+    LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'stk.payload=0.01,ussd.hop=0.01')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
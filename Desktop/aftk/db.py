@@ -0,0 +1,186 @@
+"""
+SQLite access layer for RentPay
+
+Each worker process keeps one connection per thread for every database file,
+opened lazily in WAL mode so the USSD app can read while the dashboard writes.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    def __init__(self, path: str = None):
+        self.path = path or Config.DATABASE_PATH
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schemas = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection tuned for concurrent readers and a single writer"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=Config.DATABASE_BUSY_TIMEOUT,
+            isolation_level=None,  # transactions are managed explicitly
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def connection(self, synchronous: str = None) -> sqlite3.Connection:
+        """Return this thread's connection, reconnecting after a fork"""
+        local = self._local
+        pid = os.getpid()
+        if getattr(local, 'conn', None) is None or local.pid != pid:
+            local.conn = self._connect()
+            local.pid = pid
+        if synchronous:
+            local.conn.execute(f'PRAGMA synchronous={synchronous}')
+        return local.conn
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return self.connection().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Run a block in a write transaction (BEGIN IMMEDIATE)"""
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def ensure_schema(self, name: str, sql: str):
+        """Create tables and indexes once per process"""
+        if name in self._schemas:
+            return
+        with self._schema_lock:
+            if name not in self._schemas:
+                self.connection().executescript(sql)
+                self._schemas.add(name)
+
+
+class GroupCommitWriter:
+    """
+    Batches writes from many request threads into one transaction per batch.
+
+    Callers submit items and (optionally) wait for their batch to commit, so a
+    burst of requests shares a single fsync instead of queueing on the disk.
+    apply_batch(conn, items) runs inside the transaction and returns one result
+    per item. Each item is applied in its own savepoint, so an item that fails
+    is rolled back and its caller gets the error while the rest still commit.
+    """
+
+    def __init__(self, db: Database, apply_batch, batch_size: int = 200,
+                 batch_window: float = 0.005, name: str = 'group-commit'):
+        self.db = db
+        self.apply_batch = apply_batch
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        """Start the writer thread, restarting it in forked workers"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, item, wait: bool = True, timeout: float = None):
+        """Queue an item, returning its result once committed when wait is True"""
+        self._ensure_thread()
+        pending = _PendingWrite(item)
+        self._queue.put(pending)
+        if not wait:
+            return None
+        if not pending.done.wait(timeout):
+            raise TimeoutError(f"{self.name}: write not committed within {timeout}s")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.batch_window))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        # Acknowledged writes must survive a power loss, so this connection fsyncs every commit
+        self.db.connection(synchronous='FULL')
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.db.transaction() as conn:
+                    for pending in batch:
+                        self._apply_one(conn, pending)
+            except Exception as e:
+                # The commit itself (or a rollback) failed: nothing in the batch is durable
+                logger.exception("%s: batch of %d failed", self.name, len(batch))
+                for pending in batch:
+                    pending.result = None
+                    pending.error = e
+            for pending in batch:
+                pending.done.set()
+
+    def _apply_one(self, conn, pending):
+        conn.execute('SAVEPOINT group_commit_item')
+        try:
+            pending.result = self.apply_batch(conn, [pending.item])[0]
+        except Exception as e:
+            conn.execute('ROLLBACK TO group_commit_item')
+            logger.exception("%s: write failed and was rolled back", self.name)
+            pending.error = e
+        finally:
+            conn.execute('RELEASE group_commit_item')
+
+
+class _PendingWrite:
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path: str = None) -> Database:
+    """Shared Database instance for a file, so every module uses the same pool"""
+    path = path or Config.DATABASE_PATH
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = Database(path)
+        return _databases[path]
@@ -0,0 +1,217 @@
+"""
+SMS delivery reports
+
+Every message handed to a provider is recorded under its provider message id,
+and the delivery-report webhooks of Africa's Talking and Twilio move it on to
+delivered or failed. Writes go through a group-commit writer, so a burst of
+reports after a bulk run shares a few transactions. A trigger keeps the
+latest message's status per phone in sms_phone_status, so the dashboard reads
+one row per tenant instead of searching the message history. Reports can
+arrive out of order; a final status (delivered, failed) is never overwritten
+by an earlier one.
+"""
+
+import base64
+import hashlib
+import hmac
+from datetime import datetime
+from config import Config
+from db import get_database, GroupCommitWriter
+from phone_numbers import normalize_phone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sms_messages (
+    message_id TEXT PRIMARY KEY,
+    phone TEXT NOT NULL,
+    provider TEXT,
+    status TEXT NOT NULL,
+    status_rank INTEGER NOT NULL,
+    failure_reason TEXT,
+    sent_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sms_messages_phone ON sms_messages(phone, sent_at);
+
+CREATE TABLE IF NOT EXISTS sms_delivery_events (
+    id INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    provider_status TEXT,
+    failure_reason TEXT,
+    received_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sms_delivery_events_message ON sms_delivery_events(message_id);
+
+CREATE TABLE IF NOT EXISTS sms_phone_status (
+    phone TEXT PRIMARY KEY,
+    message_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS sms_phone_status_insert AFTER INSERT ON sms_messages
+BEGIN
+    INSERT INTO sms_phone_status (phone, message_id, status, updated_at)
+    VALUES (NEW.phone, NEW.message_id, NEW.status, NEW.sent_at)
+    ON CONFLICT(phone) DO UPDATE SET
+        message_id = excluded.message_id,
+        status = excluded.status,
+        updated_at = excluded.updated_at
+    WHERE excluded.updated_at >= sms_phone_status.updated_at;
+END;
+
+CREATE TRIGGER IF NOT EXISTS sms_phone_status_update AFTER UPDATE OF status ON sms_messages
+WHEN OLD.status IS NOT NEW.status
+BEGIN
+    UPDATE sms_phone_status SET status = NEW.status
+    WHERE phone = NEW.phone AND message_id = NEW.message_id;
+END;
+"""
+
+# Delivery states, ranked so a late 'sent' report cannot undo 'delivered'
+SENT = 'sent'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+STATUS_RANK = {SENT: 1, DELIVERED: 2, FAILED: 2}
+
+AFRICASTALKING_STATUSES = {
+    'sent': SENT, 'submitted': SENT, 'buffered': SENT,
+    'success': DELIVERED,
+    'rejected': FAILED, 'failed': FAILED, 'absentsubscriber': FAILED, 'expired': FAILED
+}
+TWILIO_STATUSES = {
+    'accepted': SENT, 'scheduled': SENT, 'queued': SENT, 'sending': SENT, 'sent': SENT,
+    'delivered': DELIVERED, 'read': DELIVERED,
+    'undelivered': FAILED, 'failed': FAILED, 'canceled': FAILED
+}
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def parse_africastalking_report(form: dict) -> dict:
+    """Africa's Talking delivery report (form fields id, status, phoneNumber, failureReason)"""
+    message_id = form.get('id')
+    if not message_id:
+        raise ValueError("Delivery report has no message id")
+    provider_status = form.get('status', '')
+    return {
+        'message_id': message_id,
+        'phone': normalize_phone(form.get('phoneNumber')),
+        'provider': "Africa's Talking",
+        'status': AFRICASTALKING_STATUSES.get(provider_status.lower(), SENT),
+        'provider_status': provider_status,
+        'failure_reason': form.get('failureReason') or None
+    }
+
+
+def parse_twilio_report(form: dict) -> dict:
+    """Twilio status callback (MessageSid, MessageStatus, To, ErrorCode)"""
+    message_id = form.get('MessageSid') or form.get('SmsSid')
+    if not message_id:
+        raise ValueError("Status callback has no MessageSid")
+    provider_status = form.get('MessageStatus') or form.get('SmsStatus') or ''
+    return {
+        'message_id': message_id,
+        'phone': normalize_phone(form.get('To')),
+        'provider': 'Twilio',
+        'status': TWILIO_STATUSES.get(provider_status.lower(), SENT),
+        'provider_status': provider_status,
+        'failure_reason': form.get('ErrorCode') or None
+    }
+
+
+def valid_twilio_signature(auth_token: str, url: str, form: dict, signature: str) -> bool:
+    """Check X-Twilio-Signature: HMAC-SHA1 of the URL followed by the sorted form fields"""
+    payload = url + ''.join(f'{key}{form[key]}' for key in sorted(form))
+    expected = base64.b64encode(hmac.new(auth_token.encode(), payload.encode(), hashlib.sha1).digest()).decode()
+    return hmac.compare_digest(expected, signature or '')
+
+
+class DeliveryReportStore:
+    def __init__(self, db_path: str = None):
+        self.db = get_database(db_path)
+        self.db.ensure_schema('sms_messages', SCHEMA)
+        self.writer = GroupCommitWriter(
+            self.db,
+            self._apply_batch,
+            batch_size=Config.DELIVERY_REPORT_BATCH_SIZE,
+            batch_window=Config.DELIVERY_REPORT_BATCH_WINDOW,
+            name='delivery-reports'
+        )
+
+    def record_sent(self, message_id: str, phone: str, provider: str = None):
+        """Note a message the provider accepted (does not wait for the write)"""
+        if message_id:
+            self.writer.submit(('sent', {
+                'message_id': message_id, 'phone': normalize_phone(phone), 'provider': provider
+            }), wait=False)
+
+    def record_report(self, report: dict) -> str:
+        """Apply a parsed delivery report once it is durable, returns the message's status"""
+        return self.writer.submit(('report', report), timeout=Config.DELIVERY_REPORT_ACK_TIMEOUT)
+
+    def _apply_batch(self, conn, items: list) -> list:
+        now = _now()
+        results = []
+        for kind, item in items:
+            if kind == 'sent':
+                # A report may already have created the row; it stays ahead of 'sent'
+                conn.execute(
+                    '''INSERT OR IGNORE INTO sms_messages
+                       (message_id, phone, provider, status, status_rank, sent_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (item['message_id'], item['phone'], item['provider'], SENT, STATUS_RANK[SENT], now, now)
+                )
+                results.append(SENT)
+                continue
+
+            conn.execute(
+                '''INSERT INTO sms_messages
+                   (message_id, phone, provider, status, status_rank, failure_reason, sent_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(message_id) DO UPDATE SET
+                       status = excluded.status,
+                       status_rank = excluded.status_rank,
+                       failure_reason = excluded.failure_reason,
+                       updated_at = excluded.updated_at
+                   WHERE excluded.status_rank >= sms_messages.status_rank
+                     AND sms_messages.status_rank < ?''',
+                (item['message_id'], item['phone'], item['provider'], item['status'],
+                 STATUS_RANK[item['status']], item['failure_reason'], now, now, STATUS_RANK[DELIVERED])
+            )
+            conn.execute(
+                '''INSERT INTO sms_delivery_events (message_id, status, provider_status, failure_reason, received_at)
+                   VALUES (?, ?, ?, ?, ?)''',
+                (item['message_id'], item['status'], item['provider_status'], item['failure_reason'], now)
+            )
+            results.append(conn.execute(
+                'SELECT status FROM sms_messages WHERE message_id = ?', (item['message_id'],)
+            ).fetchone()[0])
+        return results
+
+    def get(self, message_id: str):
+        row = self.db.execute('SELECT * FROM sms_messages WHERE message_id = ?', (message_id,)).fetchone()
+        if row is None:
+            return None
+        message = dict(row)
+        message['events'] = [dict(event) for event in self.db.execute(
+            '''SELECT status, provider_status, failure_reason, received_at FROM sms_delivery_events
+               WHERE message_id = ? ORDER BY id''', (message_id,)
+        )]
+        return message
+
+    def status_for(self, phones: list) -> dict:
+        """Latest message status per phone, for a page of tenants"""
+        phones = list(phones)
+        if not phones:
+            return {}
+        rows = self.db.execute(
+            f'''SELECT phone, message_id, status, updated_at FROM sms_phone_status
+                WHERE phone IN ({",".join("?" * len(phones))})''', phones
+        ).fetchall()
+        return {row['phone']: dict(row) for row in rows}
+
+    def pending_writes(self) -> int:
+        return self.writer.depth()
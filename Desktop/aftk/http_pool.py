@@ -0,0 +1,160 @@
+"""
+Pooled keep-alive HTTP sessions for upstream APIs
+
+A PooledSession wraps one requests.Session with a sized urllib3 connection
+pool, split connect/read timeouts and retry-with-backoff for idempotent
+methods only. It is shared by all threads of a worker, so TCP/TLS handshakes
+are paid once per pooled connection instead of once per call. A request may
+carry a Deadline, which caps its timeouts to the time the caller has left
+and turns off retries, whose backoff would not fit in it.
+A named session records each call's duration and status in metrics.py.
+"""
+
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import UPSTREAM_SECONDS, UPSTREAM_REQUESTS
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+NO_RETRIES = Retry(total=False)
+
+
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+class Deadline:
+    """A point in time a piece of work must finish by, passed down to every call it makes"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, timeout: tuple) -> tuple:
+        """(connect, read) timeouts shortened to the time left"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("Deadline exceeded before the request was sent")
+        return min(timeout[0], remaining), min(timeout[1], remaining)
+
+
+class _PoolAdapter(HTTPAdapter):
+    """HTTPAdapter whose retry policy can be replaced for the calls of one thread"""
+
+    def __init__(self, **kwargs):
+        self._call = threading.local()
+        super().__init__(**kwargs)
+
+    @property
+    def max_retries(self):
+        retries = getattr(self._call, 'retries', None)
+        return retries if retries is not None else self._max_retries
+
+    @max_retries.setter
+    def max_retries(self, value):
+        self._max_retries = value
+
+
+class PooledSession:
+    def __init__(self, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 30,
+                 retries: int = 3, backoff_factor: float = 0.5, pool_block: bool = False,
+                 name: str = None):
+        """name: upstream label for the call metrics (none recorded if not given)"""
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False
+        )
+        self.adapter = _PoolAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            pool_block=pool_block,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['Connection'] = 'keep-alive'
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._total_requests = 0
+
+    def request(self, method: str, url: str, timeout=None, deadline: Deadline = None,
+                operation: str = 'request', **kwargs) -> requests.Response:
+        """Send a request through the pool (timeout defaults to (connect, read)).
+        operation labels the call in the upstream metrics, e.g. 'oauth' or 'stk_push'."""
+        timeout = timeout or self.timeout
+        if deadline is not None:
+            timeout = deadline.timeout(timeout if isinstance(timeout, tuple) else (timeout, timeout))
+        with self._lock:
+            self._in_flight += 1
+            self._total_requests += 1
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            if deadline is not None:
+                self.adapter._call.retries = NO_RETRIES
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.Timeout:
+            status = 'timeout'
+            raise
+        finally:
+            self.adapter._call.retries = None
+            with self._lock:
+                self._in_flight -= 1
+            if self.name is not None:
+                UPSTREAM_SECONDS.labels(self.name, operation).observe(time.perf_counter() - started)
+                UPSTREAM_REQUESTS.labels(self.name, operation, status).inc()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        """Pool utilisation: in-flight requests and per-host connection counts"""
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            hosts[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': idle,
+                'max_size': self.pool_size
+            }
+        with self._lock:
+            return {
+                'in_flight': self._in_flight,
+                'total_requests': self._total_requests,
+                'pool_size': self.pool_size,
+                'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+                'hosts': hosts
+            }
+
+    def close(self):
+        self.session.close()
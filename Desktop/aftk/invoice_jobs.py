@@ -0,0 +1,454 @@
+"""
+Background bulk-invoice jobs
+
+The dashboard only records a job (its recipients, or the tenant filter to
+expand) and returns; a worker thread sends the invoices a chunk at a time.
+Every recipient's outcome is checkpointed in SQLite, so a job interrupted by a
+crash or deploy resumes where it stopped instead of messaging tenants twice.
+A lease on each job keeps gunicorn workers from running the same job; it is
+renewed while a chunk is sending, and a worker that lost it writes nothing back.
+With the SMS spool enabled, chunks are handed to the spool instead of the
+provider, in the checkpoint's transaction, and its sender delivers them. Those
+recipients stay spooled until the spool has their outcome, which is copied
+back (with the provider's message id) whenever the job is read.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from config import Config
+from db import get_database
+from logging_setup import event
+from phone_numbers import normalize_many
+from sms_spool import SENT as SPOOL_SENT, FAILED as SPOOL_FAILED, UNKNOWN as SPOOL_UNKNOWN
+from tenant_store import SCHEMA as TENANT_SCHEMA
+from delivery_reports import SCHEMA as DELIVERY_SCHEMA, SENT as DELIVERY_SENT, FAILED as DELIVERY_FAILED
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice_jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    rent_amount INTEGER NOT NULL,
+    due_date TEXT NOT NULL,
+    ussd_code TEXT NOT NULL,
+    estate TEXT,
+    arrears_status TEXT,
+    select_all INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    unknown INTEGER NOT NULL DEFAULT 0,
+    segments INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker TEXT,
+    lease_until REAL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_jobs_status ON invoice_jobs(status);
+
+CREATE TABLE IF NOT EXISTS invoice_job_recipients (
+    job_id TEXT NOT NULL REFERENCES invoice_jobs(id),
+    position INTEGER NOT NULL,
+    phone TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message_id TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_invoice_job_recipients_status ON invoice_job_recipients(job_id, status, position);
+"""
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# Recipient states. SENDING rows found on resume were handed to the provider
+# before the crash, so they become UNKNOWN instead of being sent again.
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+NOT_SENT = 'failed'
+UNKNOWN = 'unknown'
+SPOOLED = 'spooled'  # waiting in the SMS spool, counted once the spool has an outcome
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class InvoiceJobQueue:
+    def __init__(self, sms_service, tenant_store, db_path: str = None, chunk_size: int = None,
+                 lease_seconds: float = None):
+        self.sms_service = sms_service
+        self.tenant_store = tenant_store
+        self.chunk_size = chunk_size or Config.INVOICE_JOB_CHUNK_SIZE
+        self.lease_seconds = lease_seconds or Config.INVOICE_JOB_LEASE
+        self.db = get_database(db_path)
+        self.db.ensure_schema('tenants', TENANT_SCHEMA)
+        self.db.ensure_schema('invoice_jobs', SCHEMA)
+        self.db.ensure_schema('sms_messages', DELIVERY_SCHEMA)
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._wakeups = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def worker_id(self) -> str:
+        """Lease owner id, unique per worker process even after a fork"""
+        return f'{os.getpid()}-{self._instance_id}'
+
+    def submit(self, rent_amount: int, due_date: str, ussd_code: str, phones: list = None,
+               estate: str = None, arrears_status: str = None, select_all: bool = False) -> str:
+        """Record a bulk-invoice job and return its id straight away.
+        Either pass the selected phones, or select_all with the tenant filter."""
+        job_id = uuid.uuid4().hex
+        now = _now()
+        phones = [] if select_all else normalize_many(phones or [])
+        with self.db.transaction() as conn:
+            conn.execute(
+                '''INSERT INTO invoice_jobs (id, status, rent_amount, due_date, ussd_code, estate,
+                                             arrears_status, select_all, total, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (job_id, QUEUED, rent_amount, due_date, ussd_code, estate, arrears_status,
+                 int(select_all), len(phones), now, now)
+            )
+            conn.executemany(
+                'INSERT INTO invoice_job_recipients (job_id, position, phone, status) VALUES (?, ?, ?, ?)',
+                [(job_id, position, phone, PENDING) for position, phone in enumerate(phones)]
+            )
+        self._ensure_thread()
+        self._wakeups.put(job_id)
+        return job_id
+
+    def get(self, job_id: str):
+        self._settle(job_id)
+        row = self.db.execute('SELECT * FROM invoice_jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def recent(self, limit: int = 10) -> list:
+        query = 'SELECT * FROM invoice_jobs ORDER BY created_at DESC LIMIT ?'
+        rows = self.db.execute(query, (limit,)).fetchall()
+        settled = [self._settle(row['id']) for row in rows]
+        if any(settled):
+            rows = self.db.execute(query, (limit,)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        done = row['sent'] + row['failed'] + row['unknown']
+        return {
+            'job_id': row['id'],
+            'status': row['status'],
+            'total': row['total'],
+            'sent': row['sent'],
+            'failed': row['failed'],
+            'unknown': row['unknown'],
+            'pending': max(row['total'] - done, 0),
+            'percent': round(100 * done / row['total'], 1) if row['total'] else (
+                100.0 if row['status'] == COMPLETED else 0.0),
+            'segments': row['segments'],
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'finished_at': row['finished_at']
+        }
+
+    def recipients(self, job_id: str, status: str = None, limit: int = 100) -> list:
+        self._settle(job_id)
+        if status:
+            rows = self.db.execute(
+                '''SELECT * FROM invoice_job_recipients WHERE job_id = ? AND status = ?
+                   ORDER BY position LIMIT ?''', (job_id, status, limit)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                'SELECT * FROM invoice_job_recipients WHERE job_id = ? ORDER BY position LIMIT ?',
+                (job_id, limit)
+            ).fetchall()
+        return [
+            {'phone': row['phone'], 'status': row['status'], 'message_id': row['message_id'],
+             'error': row['error']}
+            for row in rows
+        ]
+
+    def retry_undelivered(self, job_id: str, include_unconfirmed: bool = False):
+        """Queue a new job for the recipients of a job who did not get their invoice:
+        send failures and failed delivery reports. include_unconfirmed also covers
+        interrupted sends and messages with no delivery report yet.
+        Returns the new job id, or None if there is nobody to retry."""
+        self._settle(job_id)
+        job = self.db.execute('SELECT * FROM invoice_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        retry_statuses = (NOT_SENT, UNKNOWN) if include_unconfirmed else (NOT_SENT,)
+        delivery_statuses = (DELIVERY_FAILED, DELIVERY_SENT) if include_unconfirmed else (DELIVERY_FAILED,)
+        rows = self.db.execute(
+            f'''SELECT r.phone FROM invoice_job_recipients r
+                LEFT JOIN sms_messages m ON m.message_id = r.message_id
+                WHERE r.job_id = ?
+                  AND (r.status IN ({",".join("?" * len(retry_statuses))})
+                       OR (r.status = ? AND COALESCE(m.status, ?) IN ({",".join("?" * len(delivery_statuses))})))
+                ORDER BY r.position''',
+            (job_id, *retry_statuses, SENT, DELIVERY_SENT, *delivery_statuses)
+        ).fetchall()
+        if not rows:
+            return None
+        return self.submit(job['rent_amount'], job['due_date'], job['ussd_code'],
+                           phones=[row['phone'] for row in rows])
+
+    def _settle(self, job_id: str) -> bool:
+        """Copy the spool's outcome to recipients it has finished with, True if any changed"""
+        spool = self.sms_service.spool
+        if spool is None:
+            return False
+        rows = self.db.execute(
+            'SELECT position, message_id FROM invoice_job_recipients WHERE job_id = ? AND status = ?',
+            (job_id, SPOOLED)
+        ).fetchall()
+        if not rows:
+            return False
+        found = spool.outcomes([row['message_id'] for row in rows])
+        updates = []
+        for row in rows:
+            message = found.get(row['message_id'])
+            if message is None:
+                updates.append((UNKNOWN, None, 'spool record purged', row['position']))
+            elif message['status'] == SPOOL_SENT:
+                # The provider's id, which delivery reports are keyed by
+                updates.append((SENT, message['message_id'], None, row['position']))
+            elif message['status'] == SPOOL_FAILED:
+                updates.append((NOT_SENT, None, message['error'], row['position']))
+            elif message['status'] == SPOOL_UNKNOWN:
+                updates.append((UNKNOWN, None, message['error'] or 'interrupted in the spool', row['position']))
+        if not updates:
+            return False
+        counts = {SENT: 0, NOT_SENT: 0, UNKNOWN: 0}
+        with self.db.transaction() as conn:
+            for status, message_id, error, position in updates:
+                # Guarded, so two readers settling at once count each recipient once
+                counts[status] += conn.execute(
+                    '''UPDATE invoice_job_recipients SET status = ?, message_id = ?, error = ?
+                       WHERE job_id = ? AND position = ? AND status = ?''',
+                    (status, message_id, error, job_id, position, SPOOLED)
+                ).rowcount
+            conn.execute(
+                '''UPDATE invoice_jobs SET sent = sent + ?, failed = failed + ?, unknown = unknown + ?,
+                                           updated_at = ? WHERE id = ?''',
+                (counts[SENT], counts[NOT_SENT], counts[UNKNOWN], _now(), job_id)
+            )
+        return True
+
+    def resume(self):
+        """Pick up jobs left unfinished by a previous run of any worker"""
+        self._ensure_thread()
+        self._wakeups.put(None)
+
+    def _ensure_thread(self):
+        """Start the worker thread, restarting it in forked workers"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._wakeups = queue.SimpleQueue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='invoice-jobs', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self._wakeups.get(timeout=self.lease_seconds)
+            except queue.Empty:
+                job_id = None  # also adopt jobs whose worker died and let the lease lapse
+            job_ids = [job_id] if job_id else self._resumable()
+            for job_id in job_ids:
+                try:
+                    self._process(job_id)
+                except Exception as e:
+                    logger.exception("Invoice job %s failed", job_id)
+                    self._finish(job_id, FAILED, str(e))
+
+    def _resumable(self) -> list:
+        rows = self.db.execute(
+            '''SELECT id FROM invoice_jobs WHERE status IN (?, ?) AND (lease_until IS NULL OR lease_until < ?)
+               ORDER BY created_at''', (QUEUED, RUNNING, time.time())
+        ).fetchall()
+        return [row['id'] for row in rows]
+
+    def _claim(self, job_id: str) -> bool:
+        """Take or renew the job's lease, False if another worker holds it"""
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                '''UPDATE invoice_jobs SET worker = ?, lease_until = ?, updated_at = ?
+                   WHERE id = ? AND status IN (?, ?)
+                     AND (worker = ? OR worker IS NULL OR lease_until IS NULL OR lease_until < ?)''',
+                (self.worker_id, time.time() + self.lease_seconds, _now(), job_id, QUEUED, RUNNING,
+                 self.worker_id, time.time())
+            )
+        return cursor.rowcount > 0
+
+    def _process(self, job_id: str):
+        if not self._claim(job_id):
+            return
+        job = self.db.execute('SELECT * FROM invoice_jobs WHERE id = ?', (job_id,)).fetchone()
+        with self.db.transaction() as conn:
+            if job['status'] == QUEUED and job['select_all']:
+                self._expand(conn, job)
+            # Sent to the provider before an interruption: never send twice
+            interrupted = conn.execute(
+                "UPDATE invoice_job_recipients SET status = ?, error = 'interrupted before checkpoint' "
+                'WHERE job_id = ? AND status = ?', (UNKNOWN, job_id, SENDING)
+            ).rowcount
+            conn.execute(
+                'UPDATE invoice_jobs SET status = ?, unknown = unknown + ?, updated_at = ? WHERE id = ?',
+                (RUNNING, interrupted, _now(), job_id)
+            )
+        logger.info("Invoice job %s running", job_id, extra=event('invoice_job.start', job_id=job_id))
+
+        while True:
+            chunk = self.db.execute(
+                '''SELECT position, phone FROM invoice_job_recipients
+                   WHERE job_id = ? AND status = ? ORDER BY position LIMIT ?''',
+                (job_id, PENDING, self.chunk_size)
+            ).fetchall()
+            if not chunk:
+                break
+            send_chunk = self._spool_chunk if self.sms_service.spool is not None else self._send_chunk
+            if not self._claim(job_id) or not send_chunk(job, chunk):
+                logger.warning("Invoice job %s: lease lost, stopping", job_id)
+                return
+        self._finish(job_id, COMPLETED)
+
+    def _expand(self, conn, job):
+        """Resolve a select-all job's tenant filter into recipients"""
+        phones = (tenant['phone'] for tenant in self.tenant_store.iter_tenants(
+            job['estate'], job['arrears_status'], fields=('phone',)))
+        conn.executemany(
+            'INSERT INTO invoice_job_recipients (job_id, position, phone, status) VALUES (?, ?, ?, ?)',
+            ((job['id'], position, phone, PENDING) for position, phone in enumerate(phones))
+        )
+        conn.execute(
+            'UPDATE invoice_jobs SET total = (SELECT COUNT(*) FROM invoice_job_recipients WHERE job_id = ?) '
+            'WHERE id = ?', (job['id'], job['id'])
+        )
+
+    def _heartbeat(self, job_id: str, stop: threading.Event, lost: threading.Event):
+        """Renew the job's lease until stop is set, a rate-limited chunk can outlast it"""
+        while not stop.wait(self.lease_seconds / 3):
+            if not self._claim(job_id):
+                lost.set()
+                return
+
+    def _render(self, job, chunk: list) -> tuple:
+        """Render a chunk's invoices: (outcomes of tenants not found, [(position, invoice, phone)])"""
+        outcomes = {}  # position -> (status, message_id, error)
+        invoices = []
+        for row in chunk:
+            tenant = self.tenant_store.get(row['phone'])
+            if tenant is None:
+                outcomes[row['position']] = (NOT_SENT, None, 'Tenant not found')
+                continue
+            invoices.append((row['position'], self.sms_service.render_rent_invoice(
+                tenant['name'], tenant['house_number'], tenant['estate'],
+                job['rent_amount'], job['due_date'], job['ussd_code'], tenant.get('landlord')
+            ), row['phone']))
+        return outcomes, invoices
+
+    def _spool_chunk(self, job, chunk: list) -> bool:
+        """Queue one chunk in the SMS spool and checkpoint it, False if the job's lease was lost.
+        Recipients stay spooled, with the spool's message key as their message id, until
+        _settle finds the spool's outcome. The key is per job and position, so a chunk queued
+        again after a crash is not sent twice, while a retry job still re-sends."""
+        job_id = job['id']
+        outcomes, invoices = self._render(job, chunk)
+        # One transaction with the checkpoint when the spool shares this database
+        with self.db.transaction() as conn:
+            if not self._owns(conn, job_id):
+                return False
+            for position, invoice, phone in invoices:
+                queued = self.sms_service.spool.enqueue(
+                    phone, invoice['text'], key=f'invoice-job:{job_id}:{position}', segments=invoice['segments']
+                )
+                outcomes[position] = (SPOOLED, queued['message_key'], None)
+            self._checkpoint(conn, job_id, outcomes, sum(invoice['segments'] for _, invoice, _ in invoices))
+        return True
+
+    def _send_chunk(self, job, chunk: list) -> bool:
+        """Send one chunk and checkpoint it, False if the job's lease was lost meanwhile"""
+        job_id = job['id']
+        with self.db.transaction() as conn:
+            conn.executemany(
+                'UPDATE invoice_job_recipients SET status = ? WHERE job_id = ? AND position = ?',
+                [(SENDING, job_id, row['position']) for row in chunk]
+            )
+
+        outcomes, invoices = self._render(job, chunk)
+
+        stop, lost = threading.Event(), threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop, lost),
+                                     name='invoice-jobs-lease', daemon=True)
+        heartbeat.start()
+        try:
+            results = self.sms_service.send_messages([(phone, invoice['text']) for _, invoice, phone in invoices])
+        finally:
+            stop.set()
+            heartbeat.join()
+        for (position, _, _), result in zip(invoices, results):
+            if result.get('success'):
+                outcomes[position] = (SENT, result.get('message_id'), None)
+            else:
+                outcomes[position] = (NOT_SENT, None, result.get('error', 'Unknown error'))
+
+        with self.db.transaction() as conn:
+            # Whoever took the job over has already counted this chunk's SENDING rows as unknown
+            if lost.is_set() or not self._owns(conn, job_id):
+                return False
+            self._checkpoint(conn, job_id, outcomes, sum(invoice['segments'] for _, invoice, _ in invoices))
+        return True
+
+    @staticmethod
+    def _checkpoint(conn, job_id: str, outcomes: dict, segments: int):
+        """Store a chunk's recipient outcomes and add them to the job's counters"""
+        sent = sum(1 for status, _, _ in outcomes.values() if status == SENT)
+        failed = sum(1 for status, _, _ in outcomes.values() if status == NOT_SENT)
+        conn.executemany(
+            '''UPDATE invoice_job_recipients SET status = ?, message_id = ?, error = ?
+               WHERE job_id = ? AND position = ?''',
+            [(status, message_id, error, job_id, position)
+             for position, (status, message_id, error) in outcomes.items()]
+        )
+        conn.execute(
+            '''UPDATE invoice_jobs SET sent = sent + ?, failed = failed + ?, segments = segments + ?,
+                                       updated_at = ? WHERE id = ?''',
+            (sent, failed, segments, _now(), job_id)
+        )
+
+    def _owns(self, conn, job_id: str) -> bool:
+        """True if this worker still holds the job, i.e. nobody has claimed it since"""
+        row = conn.execute('SELECT worker FROM invoice_jobs WHERE id = ?', (job_id,)).fetchone()
+        return row is not None and row['worker'] == self.worker_id
+
+    def _finish(self, job_id: str, status: str, error: str = None):
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                '''UPDATE invoice_jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL,
+                                           finished_at = ?, updated_at = ? WHERE id = ? AND worker = ?''',
+                (status, error, _now(), _now(), job_id, self.worker_id)
+            )
+        if cursor.rowcount == 0:
+            logger.warning("Invoice job %s: lease lost, not marking it %s", job_id, status)
+            return
+        logger.info("Invoice job %s %s", job_id, status,
+                    extra=event('invoice_job.finish', job_id=job_id, status=status))
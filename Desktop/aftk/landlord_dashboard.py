@@ -1,10 +1,27 @@
-from flask import Flask, render_template_string, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template_string, request, jsonify, redirect, url_for
 from sms_service import SMSService
+from logging_setup import setup_logging
+from tenant_store import TenantStore, IN_ARREARS, PAID_UP, LISTING_FIELDS
+from rent_aggregates import RentAggregates
+from invoice_jobs import InvoiceJobQueue, ACTIVE_STATUSES as ACTIVE_JOB_STATUSES
+from reconciliation import PaymentReconciler, load_statement, merge_statements
+from delivery_reports import parse_africastalking_report, parse_twilio_report, valid_twilio_signature
+from config import Config
+import metrics
+import profiling
 from datetime import datetime, timedelta
+import io
 import json
+import os
+import zlib
+
+setup_logging()
 
 app = Flask(__name__)
 
+# Sampled request profiling, off until switched on at /debug/profile
+profiler = profiling.RequestProfiler('dashboard').init_app(app)
+
 # Add custom Jinja2 filter for number formatting
 @app.template_filter('number_format')
 def number_format(value):
@@ -17,23 +34,24 @@ def number_format(value):
 # Initialize SMS service
 sms_service = SMSService()
 
-# Mock tenant database - in production, this would connect to a real database
-TENANT_DB = {
-    "+254792138852": {
-        "name": "John",
-        "house_number": "HSe no. 4",
-        "estate": "Killimani estate",
-        "rent_due": 25000,
-        "last_payment": "2024-01-15"
-    },
-    "+254715035359": {
-        "name": "Kenn",
-        "house_number": "HSe no. 12",
-        "estate": "Westlands",
-        "rent_due": 30000,
-        "last_payment": "2024-01-10"
-    }
-}
+# Tenant repository shared with the USSD app
+tenant_store = TenantStore()
+
+# Totals maintained by database triggers, read without scanning tenants
+rent_aggregates = RentAggregates()
+
+# Bulk invoices are sent by a background worker; pick up jobs a restart interrupted
+invoice_jobs = InvoiceJobQueue(sms_service, tenant_store)
+invoice_jobs.resume()
+
+# Matches M-Pesa statement exports against STK requests, callbacks and tenants
+reconciler = PaymentReconciler()
+
+metrics.gauge('rentpay_delivery_report_pending_writes', "SMS sent records and delivery reports waiting for a group commit",
+              sms_service.delivery_reports.pending_writes)
+if sms_service.spool is not None:
+    metrics.gauge('rentpay_sms_spool_messages', "Messages in the outbound SMS spool by status",
+                  sms_service.spool.stats, ('status',))
 
 # USSD code for the rent payment system
 USSD_CODE = "*384*11897#"
@@ -58,7 +76,7 @@ DASHBOARD_HTML = """
         .card { background: white; padding: 25px; border-radius: 10px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }
         .card h3 { color: #2c3e50; margin-bottom: 20px; font-size: 1.4em; }
         
-        .stats { display: grid; grid-template-columns: repeat(3, 1fr); gap: 20px; margin-bottom: 30px; }
+        .stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(180px, 1fr)); gap: 20px; margin-bottom: 30px; }
         .stat-card { background: white; padding: 20px; border-radius: 10px; text-align: center; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }
         .stat-number { font-size: 2.5em; font-weight: bold; color: #3498db; }
         .stat-label { color: #7f8c8d; margin-top: 5px; }
@@ -87,6 +105,14 @@ DASHBOARD_HTML = """
         .tenant-info h4 { color: #2c3e50; margin-bottom: 5px; }
         .tenant-info p { color: #7f8c8d; font-size: 0.9em; }
         .tenant-actions { display: flex; gap: 10px; }
+        .pager { display: flex; justify-content: space-between; padding-top: 15px; }
+        .pager a { color: #3498db; text-decoration: none; font-weight: 600; }
+        .filters { display: flex; gap: 20px; align-items: flex-end; }
+        .filters .form-group { flex: 1; margin-bottom: 0; }
+        .load-more { margin-top: 10px; background: #95a5a6; }
+        .load-more:hover { background: #7f8c8d; }
+        .progress { background: #ecf0f1; border-radius: 8px; height: 24px; overflow: hidden; margin: 15px 0; }
+        .progress-bar { background: #27ae60; height: 100%; width: 0; transition: width 0.5s; }
         
         .alert { padding: 15px; border-radius: 8px; margin-bottom: 20px; }
         .alert-success { background: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
@@ -119,21 +145,68 @@ DASHBOARD_HTML = """
         </div>
         {% endif %}
         
+        {% if job %}
+        <div class="card" id="invoice_job" style="margin-bottom: 30px;">
+            <h3>📤 Bulk Invoice Progress</h3>
+            <div class="progress"><div class="progress-bar" id="job_bar" style="width: {{ job.percent }}%;"></div></div>
+            <p id="job_summary">
+                {{ job.status | capitalize }}: {{ job.sent }} sent, {{ job.failed }} failed,
+                {{ job.pending }} pending of {{ job.total }}
+            </p>
+            {% if job.status not in active_job_statuses %}
+            <form method="POST" action="/invoice-jobs/{{ job.job_id }}/retry">
+                <button type="submit" class="btn">🔁 Retry undelivered</button>
+            </form>
+            {% endif %}
+        </div>
+        {% endif %}
+        
         <div class="stats">
             <div class="stat-card">
                 <div class="stat-number">{{ total_tenants }}</div>
-                <div class="stat-label">Total Tenants</div>
+                <div class="stat-label">{% if estate %}Tenants in {{ estate }}{% else %}Total Tenants{% endif %}</div>
             </div>
             <div class="stat-card">
                 <div class="stat-number">KES {{ total_rent_due | number_format }}</div>
                 <div class="stat-label">Total Rent Due</div>
             </div>
+            <div class="stat-card">
+                <div class="stat-number">{{ tenants_in_arrears }}</div>
+                <div class="stat-label">Tenants in Arrears</div>
+            </div>
+            <div class="stat-card">
+                <div class="stat-number">KES {{ collected.amount | number_format }}</div>
+                <div class="stat-label">Collected This Month</div>
+            </div>
             <div class="stat-card">
                 <div class="stat-number">{{ ussd_code }}</div>
                 <div class="stat-label">USSD Code</div>
             </div>
         </div>
         
+        <div class="card" style="margin-bottom: 30px;">
+            <form method="GET" action="/" class="filters">
+                <div class="form-group">
+                    <label for="filter_estate">Estate:</label>
+                    <select name="estate" id="filter_estate">
+                        <option value="">All estates</option>
+                        {% for name in estates %}
+                        <option value="{{ name }}" {% if name == estate %}selected{% endif %}>{{ name }}</option>
+                        {% endfor %}
+                    </select>
+                </div>
+                <div class="form-group">
+                    <label for="filter_status">Rent Status:</label>
+                    <select name="status" id="filter_status">
+                        <option value="">All tenants</option>
+                        <option value="arrears" {% if status == 'arrears' %}selected{% endif %}>In arrears</option>
+                        <option value="paid" {% if status == 'paid' %}selected{% endif %}>Paid up</option>
+                    </select>
+                </div>
+                <button type="submit" class="btn">🔍 Filter</button>
+            </form>
+        </div>
+        
         <div class="dashboard-grid">
             <div class="card">
                 <h3>📱 Send Rent Invoice</h3>
@@ -142,10 +215,10 @@ DASHBOARD_HTML = """
                         <label for="tenant_phone">Select Tenant:</label>
                         <select name="tenant_phone" id="tenant_phone" required>
                             <option value="">Choose a tenant...</option>
-                            {% for phone, tenant in tenants.items() %}
-                            <option value="{{ phone }}">{{ tenant.name }} - {{ tenant.house_number }}, {{ tenant.estate }}</option>
-                            {% endfor %}
                         </select>
+                        <button type="button" class="btn load-more" id="tenant_phone_more" onclick="loadTenantOptions()">
+                            Load more tenants
+                        </button>
                     </div>
                     
                     <div class="form-group">
@@ -172,21 +245,30 @@ DASHBOARD_HTML = """
             <div class="card">
                 <h3>📋 Tenant List</h3>
                 <div class="tenant-list">
-                    {% for phone, tenant in tenants.items() %}
+                    {% for tenant in tenants %}
                     <div class="tenant-item">
                         <div class="tenant-info">
                             <h4>{{ tenant.name }}</h4>
                             <p>{{ tenant.house_number }}, {{ tenant.estate }}</p>
                             <p>Rent: KES {{ tenant.rent_due | number_format }}</p>
+                            {% if delivery.get(tenant.phone) %}
+                            <p>Last SMS: {{ delivery[tenant.phone].status }}</p>
+                            {% endif %}
                         </div>
                         <div class="tenant-actions">
-                            <button class="btn" onclick="sendQuickInvoice('{{ phone }}', '{{ tenant.name }}', {{ tenant.rent_due }})">
+                            <button class="btn" onclick="sendQuickInvoice('{{ tenant.phone }}', '{{ tenant.name }}', {{ tenant.rent_due }})">
                                 📱 Quick Invoice
                             </button>
                         </div>
                     </div>
+                    {% else %}
+                    <p>No tenants match this filter.</p>
                     {% endfor %}
                 </div>
+                <div class="pager">
+                    <span>{% if prev_cursor %}<a href="{{ url_for('dashboard', estate=estate, status=status, before=prev_cursor) }}">← Previous</a>{% endif %}</span>
+                    <span>{% if next_cursor %}<a href="{{ url_for('dashboard', estate=estate, status=status, after=next_cursor) }}">Next →</a>{% endif %}</span>
+                </div>
             </div>
         </div>
         
@@ -195,14 +277,20 @@ DASHBOARD_HTML = """
             <form method="POST" action="/send-bulk-invoices">
                 <div class="form-group">
                     <label>Select Tenants for Bulk Invoice:</label>
-                    <div style="max-height: 200px; overflow-y: auto; border: 1px solid #e0e0e0; padding: 15px; border-radius: 8px;">
-                        {% for phone, tenant in tenants.items() %}
-                        <label style="display: block; margin-bottom: 10px;">
-                            <input type="checkbox" name="selected_tenants" value="{{ phone }}" style="margin-right: 10px;">
-                            {{ tenant.name }} - {{ tenant.house_number }}, {{ tenant.estate }} (KES {{ tenant.rent_due | number_format }})
-                        </label>
-                        {% endfor %}
+                    <div id="bulk_tenants" style="max-height: 200px; overflow-y: auto; border: 1px solid #e0e0e0; padding: 15px; border-radius: 8px;">
                     </div>
+                    <button type="button" class="btn load-more" id="bulk_tenants_more" onclick="loadTenantCheckboxes()">
+                        Load more tenants
+                    </button>
+                </div>
+                
+                <div class="form-group">
+                    <label>
+                        <input type="checkbox" name="select_all_matching" value="1" style="width: auto; margin-right: 10px;">
+                        Send to every tenant matching the current filter
+                    </label>
+                    <input type="hidden" name="estate" value="{{ estate or '' }}">
+                    <input type="hidden" name="status" value="{{ status or '' }}">
                 </div>
                 
                 <div class="form-group">
@@ -254,8 +342,78 @@ DASHBOARD_HTML = """
             
             document.getElementById('due_date').value = dueDate;
             document.getElementById('bulk_due_date').value = dueDate;
+            
+            loadTenantOptions();
+            loadTenantCheckboxes();
         });
         
+        {% if job and job.status in active_job_statuses %}
+        // Follow the bulk invoice job until the worker finishes it
+        const jobTimer = setInterval(function() {
+            fetch('/api/invoice-jobs/{{ job.job_id }}')
+                .then(response => response.json())
+                .then(job => {
+                    document.getElementById('job_bar').style.width = job.percent + '%';
+                    document.getElementById('job_summary').textContent =
+                        job.status.charAt(0).toUpperCase() + job.status.slice(1) + ': ' +
+                        job.sent + ' sent, ' + job.failed + ' failed, ' +
+                        job.pending + ' pending of ' + job.total;
+                    if (job.status !== 'queued' && job.status !== 'running') {
+                        clearInterval(jobTimer);
+                    }
+                });
+        }, 1000);
+        {% endif %}
+        
+        // The tenant pickers are filled a page at a time from the JSON API
+        const tenantFilter = {{ filter_args | tojson }};
+        const tenantCursors = {};
+        
+        function fetchTenantPage(list) {
+            const params = new URLSearchParams(tenantFilter);
+            params.set('fields', 'phone,name,house_number,estate,rent_due');
+            if (tenantCursors[list]) {
+                params.set('cursor', tenantCursors[list]);
+            }
+            return fetch('/api/tenants?' + params.toString())
+                .then(response => response.json())
+                .then(page => {
+                    tenantCursors[list] = page.next_cursor;
+                    document.getElementById(list + '_more').style.display = page.next_cursor ? 'inline-block' : 'none';
+                    return page.tenants;
+                });
+        }
+        
+        function tenantLabel(tenant) {
+            return tenant.name + ' - ' + tenant.house_number + ', ' + tenant.estate;
+        }
+        
+        function loadTenantOptions() {
+            fetchTenantPage('tenant_phone').then(tenants => {
+                const select = document.getElementById('tenant_phone');
+                tenants.forEach(tenant => select.add(new Option(tenantLabel(tenant), tenant.phone)));
+            });
+        }
+        
+        function loadTenantCheckboxes() {
+            fetchTenantPage('bulk_tenants').then(tenants => {
+                const container = document.getElementById('bulk_tenants');
+                tenants.forEach(tenant => {
+                    const label = document.createElement('label');
+                    label.style.cssText = 'display: block; margin-bottom: 10px;';
+                    const checkbox = document.createElement('input');
+                    checkbox.type = 'checkbox';
+                    checkbox.name = 'selected_tenants';
+                    checkbox.value = tenant.phone;
+                    checkbox.style.cssText = 'width: auto; margin-right: 10px;';
+                    label.appendChild(checkbox);
+                    label.appendChild(document.createTextNode(
+                        tenantLabel(tenant) + ' (KES ' + tenant.rent_due.toLocaleString() + ')'));
+                    container.appendChild(label);
+                });
+            });
+        }
+        
         function sendQuickInvoice(phone, name, currentRent) {
             document.getElementById('modal_tenant_phone').value = phone;
             document.getElementById('modal_tenant_name').value = name;
@@ -280,17 +438,55 @@ DASHBOARD_HTML = """
 </html>
 """
 
+def _tenant_filters(args):
+    """Estate and arrears filters from the query string"""
+    estate = args.get('estate') or None
+    status = args.get('status') or None
+    if status not in (None, IN_ARREARS, PAID_UP):
+        status = None
+    return estate, status
+
+def _cursor_arg(args, name):
+    try:
+        return int(args[name]) if args.get(name) else None
+    except ValueError:
+        return None
+
 @app.route('/')
 def dashboard():
     """Landlord dashboard main page"""
-    # Calculate totals
-    total_tenants = len(TENANT_DB)
-    total_rent_due = sum(tenant['rent_due'] for tenant in TENANT_DB.values())
+    estate, status = _tenant_filters(request.args)
+    
+    # Only one page of tenants is rendered; the pickers load theirs from /api/tenants
+    page = tenant_store.page(
+        after=_cursor_arg(request.args, 'after'),
+        before=_cursor_arg(request.args, 'before'),
+        limit=Config.DASHBOARD_PAGE_SIZE,
+        estate=estate,
+        status=status
+    )
+    totals = rent_aggregates.totals(estate)
+    job = invoice_jobs.get(request.args['job']) if request.args.get('job') else None
+    filter_args = {key: value for key, value in (('estate', estate), ('status', status)) if value}
     
     return render_template_string(DASHBOARD_HTML, 
-                                tenants=TENANT_DB,
-                                total_tenants=total_tenants,
-                                total_rent_due=total_rent_due,
+                                tenants=page['tenants'],
+                                delivery=sms_service.delivery_reports.status_for(
+                                    tenant['phone'] for tenant in page['tenants']),
+                                next_cursor=page['next_cursor'],
+                                prev_cursor=page['prev_cursor'],
+                                estates=rent_aggregates.estates(),
+                                estate=estate,
+                                status=status,
+                                filter_args=filter_args,
+                                total_tenants=totals['total_tenants'],
+                                total_rent_due=totals['total_rent_due'],
+                                tenants_in_arrears=totals['tenants_in_arrears'],
+                                collected=rent_aggregates.collected(),
+                                job=job,
+                                active_job_statuses=ACTIVE_JOB_STATUSES,
+                                message=request.args.get('message'),
+                                message_type=request.args.get('message_type', 'info'),
                                 ussd_code=USSD_CODE)
 
 @app.route('/send-invoice', methods=['POST'])
@@ -302,11 +498,10 @@ def send_invoice():
         due_date = request.form.get('due_date')
         custom_message = request.form.get('custom_message', '')
         
-        if not tenant_phone or tenant_phone not in TENANT_DB:
+        tenant = tenant_store.get(tenant_phone) if tenant_phone else None
+        if not tenant:
             return redirect('/?message=Invalid tenant selected&message_type=error')
         
-        tenant = TENANT_DB[tenant_phone]
-        
         # Send SMS invoice
         result = sms_service.send_rent_invoice(
             tenant_phone=tenant_phone,
@@ -315,10 +510,18 @@ def send_invoice():
             estate=tenant['estate'],
             rent_amount=rent_amount,
             due_date=due_date,
-            ussd_code=USSD_CODE
+            ussd_code=USSD_CODE,
+            landlord=tenant['landlord']
         )
         
-        if result['success']:
+        if result.get('status') == 'already_queued':
+            state = 'sent to' if result.get('spool_status') == 'sent' else 'queued for'
+            message = f"Not queued again: this invoice was already {state} {tenant['name']}"
+            message_type = 'info'
+        elif result.get('status') == 'queued':
+            message = f"Invoice queued for {tenant['name']}"
+            message_type = 'success'
+        elif result['success']:
             message = f"Invoice sent successfully to {tenant['name']} (Message ID: {result.get('message_id', 'N/A')})"
             message_type = 'success'
         else:
@@ -332,44 +535,179 @@ def send_invoice():
 
 @app.route('/send-bulk-invoices', methods=['POST'])
 def send_bulk_invoices():
-    """Send rent invoices to multiple tenants"""
+    """Queue rent invoices to multiple tenants as a background job"""
     try:
         selected_tenants = request.form.getlist('selected_tenants')
+        select_all = bool(request.form.get('select_all_matching'))
         rent_amount = int(request.form.get('bulk_rent_amount'))
         due_date = request.form.get('bulk_due_date')
         
-        if not selected_tenants:
+        if not selected_tenants and not select_all:
             return redirect('/?message=No tenants selected&message_type=error')
         
-        # Prepare tenant data for bulk sending
-        tenants_data = []
-        for phone in selected_tenants:
-            if phone in TENANT_DB:
-                tenant = TENANT_DB[phone]
-                tenants_data.append({
-                    'phone': phone,
-                    'name': tenant['name'],
-                    'house_number': tenant['house_number'],
-                    'estate': tenant['estate'],
-                    'rent_amount': rent_amount,
-                    'due_date': due_date
-                })
-        
-        # Send bulk invoices
-        result = sms_service.send_bulk_invoices(tenants_data, USSD_CODE)
-        
-        message = f"Bulk invoices sent: {result['success_count']} successful, {result['failure_count']} failed"
-        message_type = 'success' if result['failure_count'] == 0 else 'info'
+        estate, status = _tenant_filters(request.form)
+        job_id = invoice_jobs.submit(
+            rent_amount=rent_amount,
+            due_date=due_date,
+            ussd_code=USSD_CODE,
+            phones=selected_tenants,
+            estate=estate,
+            arrears_status=status,
+            select_all=select_all
+        )
         
-        return redirect(f'/?message={message}&message_type={message_type}')
+        return redirect(url_for('dashboard', job=job_id, message='Bulk invoices queued', message_type='info'))
         
     except Exception as e:
         return redirect(f'/?message=Error: {str(e)}&message_type=error')
 
+@app.route('/invoice-jobs/<job_id>/retry', methods=['POST'])
+def retry_invoice_job(job_id):
+    """Re-send a finished job's invoices only to tenants who did not get them"""
+    new_job_id = invoice_jobs.retry_undelivered(job_id, request.form.get('include_unconfirmed') == '1')
+    if new_job_id is None:
+        return redirect(url_for('dashboard', job=job_id, message='Nothing to retry', message_type='info'))
+    return redirect(url_for('dashboard', job=new_job_id, message='Retrying undelivered invoices',
+                            message_type='info'))
+
+@app.route('/sms/delivery-reports/africastalking', methods=['POST'])
+def africastalking_delivery_report():
+    """Africa's Talking delivery report webhook"""
+    try:
+        status = sms_service.delivery_reports.record_report(parse_africastalking_report(request.form))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'status': 'ok', 'delivery_status': status})
+
+@app.route('/sms/delivery-reports/twilio', methods=['POST'])
+def twilio_delivery_report():
+    """Twilio status callback webhook (signature checked when TWILIO_AUTH_TOKEN is set)"""
+    auth_token = os.getenv('TWILIO_AUTH_TOKEN', '')
+    if auth_token:
+        url = os.getenv('TWILIO_STATUS_CALLBACK_URL') or request.url
+        if not valid_twilio_signature(auth_token, url, request.form.to_dict(),
+                                      request.headers.get('X-Twilio-Signature')):
+            return jsonify({'status': 'error', 'message': 'Invalid signature'}), 403
+    try:
+        status = sms_service.delivery_reports.record_report(parse_twilio_report(request.form))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify({'status': 'ok', 'delivery_status': status})
+
+@app.route('/api/sms/<message_id>')
+def api_sms_message(message_id):
+    """Delivery status and report history of one message"""
+    message = sms_service.delivery_reports.get(message_id)
+    if message is None:
+        return jsonify({'error': 'Message not found'}), 404
+    return jsonify(message)
+
+@app.route('/api/invoice-jobs')
+def api_invoice_jobs():
+    """Most recent bulk invoice jobs"""
+    return jsonify(invoice_jobs.recent())
+
+@app.route('/api/invoice-jobs/<job_id>')
+def api_invoice_job(job_id):
+    """Progress of a bulk invoice job; ?recipients=failed|unknown|sent lists those recipients"""
+    job = invoice_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if request.args.get('recipients'):
+        job['recipients'] = invoice_jobs.recipients(job_id, request.args['recipients'])
+    return jsonify(job)
+
+def _ndjson_chunks(records, chunk_size: int = 500):
+    """One JSON document per line, written out a few hundred lines at a time"""
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record))
+        if len(lines) >= chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
 @app.route('/api/tenants')
 def api_tenants():
-    """API endpoint to get tenant list"""
-    return jsonify(TENANT_DB)
+    """Tenant list, one page at a time (?cursor=&limit=) or as an NDJSON export (?format=ndjson).
+    
+    Filter with ?estate= and ?status=arrears|paid, and project with ?fields=phone,name.
+    The ETag follows the tenant data version, so polling an unchanged list is a 304.
+    """
+    etag = f"tenants-{tenant_store.version()}-{zlib.crc32(request.query_string):08x}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    estate, status = _tenant_filters(request.args)
+    fields = tuple(field.strip() for field in request.args.get('fields', '').split(',') if field.strip())
+    unknown = set(fields) - set(LISTING_FIELDS)
+    if unknown:
+        return jsonify({'error': f"Unknown fields: {', '.join(sorted(unknown))}"}), 400
+    
+    if request.args.get('format') == 'ndjson':
+        # Streamed page by page, so a full export never sits in memory
+        tenants = tenant_store.iter_tenants(estate, status, fields or None)
+        response = Response(_ndjson_chunks(tenants), mimetype='application/x-ndjson')
+    else:
+        try:
+            limit = int(request.args.get('limit', Config.DASHBOARD_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        limit = max(1, min(limit, Config.DASHBOARD_MAX_PAGE_SIZE))
+        response = jsonify(tenant_store.page(
+            after=_cursor_arg(request.args, 'cursor'),
+            limit=limit,
+            estate=estate,
+            status=status,
+            fields=fields or None
+        ))
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/summary')
+def api_summary():
+    """Portfolio and per-estate rent totals plus this month's collections"""
+    return jsonify({
+        'totals': rent_aggregates.totals(),
+        'estates': rent_aggregates.by_estate(),
+        'collected': rent_aggregates.collected(request.args.get('month'))
+    })
+
+@app.route('/api/sms-spool')
+def api_sms_spool():
+    """Outbound SMS spool backlog by status"""
+    if sms_service.spool is None:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'messages': sms_service.spool.stats()})
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint (this worker's numbers)"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/reconcile', methods=['POST'])
+def api_reconcile():
+    """Reconcile uploaded M-Pesa statement CSVs (field 'statement') for a month.
+    apply=1 records payments missing from the ledger and updates balances."""
+    files = request.files.getlist('statement')
+    if not files:
+        return jsonify({'error': "Upload one or more statement CSVs as 'statement'"}), 400
+    month = request.form.get('month') or datetime.now().strftime('%Y-%m')
+    try:
+        datetime.strptime(month, '%Y-%m')
+        statement = merge_statements([
+            load_statement(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''))
+            for upload in files
+        ])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    apply = request.form.get('apply') in ('1', 'true', 'on')
+    return jsonify(reconciler.reconcile(statement, month, apply=apply))
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
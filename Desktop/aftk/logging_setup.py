@@ -0,0 +1,189 @@
+"""
+Logging for the RentPay apps
+
+Request threads only put log records on a queue; a background listener thread
+redacts secrets, formats (plain text or JSON) and writes them out. High-volume
+events can be sampled so they cost almost nothing when dropped.
+
+Tag a record with an event name (and structured fields) via `extra=event(...)`:
+
+    logger.info("STK push accepted", extra=event('stk.response', checkout_id=cid))
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+
+REDACTED = '[REDACTED]'
+
+SECRET_PATTERNS = [
+    re.compile(r'(Bearer\s+)[A-Za-z0-9\-._~+/]+=*', re.IGNORECASE),
+    re.compile(
+        r'''(['"]?(?:password|access_token|apikey|api_key|consumer_secret|consumer_key|'''
+        r'''passkey|auth_token|authorization|secret)['"]?\s*[:=]\s*['"]?)([^'",\s}&]+)''',
+        re.IGNORECASE
+    ),
+]
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+def event(name: str, **fields) -> dict:
+    """`extra` for a log call: event name used for sampling plus structured fields"""
+    return {'event': name, 'fields': fields}
+
+
+def redact(text: str) -> str:
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(lambda match: match.group(1) + REDACTED, text)
+    return text
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """'stk.payload=0.01,ussd.hop=0.1' -> {'stk.payload': 0.01, 'ussd.hop': 0.1}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records for events with a configured sample rate"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record) -> bool:
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class RedactingFilter(logging.Filter):
+    """Strip bearer tokens, passwords and API keys (runs on the listener thread)"""
+
+    def filter(self, record) -> bool:
+        record.msg = redact(record.getMessage())
+        record.args = None
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = {key: redact(str(value)) if isinstance(value, (str, dict, list)) else value
+                             for key, value in fields.items()}
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        if getattr(record, 'event', None):
+            data['event'] = record.event
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+
+    def format(self, record) -> str:
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class _RequestThreadQueueHandler(QueueHandler):
+    def __init__(self, log_queue, start_listener):
+        super().__init__(log_queue)
+        self.start_listener = start_listener
+        self.pid = os.getpid()
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            # Forked worker: the listener thread did not survive the fork
+            self.pid = os.getpid()
+            self.start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Merge args on the calling thread (they may be mutated later), but leave
+        # redaction and formatting to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level: str = None, json_output: bool = None, sample_rates: dict = None):
+    """Route all logging through a queue to a background writer (safe to call repeatedly)"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        level = (level or Config.LOG_LEVEL).upper()
+        if json_output is None:
+            json_output = Config.LOG_FORMAT.lower() == 'json'
+        if sample_rates is None:
+            sample_rates = parse_sample_rates(Config.LOG_SAMPLE_RATES)
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JsonFormatter() if json_output else TextFormatter())
+        output.addFilter(RedactingFilter())
+
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+
+        def start_listener():
+            global _listener
+            _listener = QueueListener(log_queue, output, respect_handler_level=True)
+            _listener.start()
+
+        queue_handler = _RequestThreadQueueHandler(log_queue, start_listener)
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        start_listener()
+        atexit.register(lambda: _listener.stop())
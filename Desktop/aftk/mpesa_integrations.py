@@ -0,0 +1,174 @@
+"""
+Per-landlord M-Pesa integrations
+
+Each landlord collects into their own paybill, so every integration carries
+its own shortcode, passkey and Daraja app credentials, and may point at the
+sandbox or production host. Integrations are read once from a JSON file
+(MPESA_INTEGRATIONS_FILE) and indexed by id, landlord and estate; the
+single MPESA_* configuration is always available as the 'default'
+integration. Secrets can be kept out of the file as "env:VARIABLE_NAME".
+A tenant is routed by their estate, then by the landlord recorded on their
+tenant row (tenants.landlord), so a landlord-only entry collects for every
+tenant with that landlord. An entry with neither can never be picked and is
+rejected.
+
+[
+  {"id": "acme", "landlord": "Acme Properties", "estates": ["Killimani estate"],
+   "shortcode": "600100", "passkey": "env:ACME_PASSKEY",
+   "consumer_key": "env:ACME_CONSUMER_KEY", "consumer_secret": "env:ACME_CONSUMER_SECRET",
+   "sandbox": false}
+]
+"""
+
+import json
+import logging
+import os
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTEGRATION = 'default'
+SANDBOX_BASE_URL = 'https://sandbox.safaricom.co.ke'
+PRODUCTION_BASE_URL = 'https://api.safaricom.co.ke'
+
+
+def _secret(value) -> str:
+    """Resolve "env:NAME" references to the environment variable's value"""
+    value = '' if value is None else str(value)
+    if value.startswith('env:'):
+        return os.getenv(value[4:], '')
+    return value
+
+
+class MpesaIntegration:
+    __slots__ = ('integration_id', 'landlord', 'estates', 'shortcode', 'passkey', 'consumer_key',
+                 'consumer_secret', 'sandbox', 'base_url', 'oauth_url', 'stk_push_url',
+                 'callback_url', 'active')
+
+    def __init__(self, integration_id: str, shortcode: str, passkey: str, consumer_key: str,
+                 consumer_secret: str, sandbox: bool = True, landlord: str = None,
+                 estates: tuple = (), base_url: str = None, callback_url: str = None,
+                 active: bool = True):
+        self.integration_id = integration_id
+        self.landlord = landlord
+        self.estates = tuple(estates)
+        self.shortcode = str(shortcode)
+        self.passkey = passkey
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.sandbox = sandbox
+        self.base_url = (base_url or (SANDBOX_BASE_URL if sandbox else PRODUCTION_BASE_URL)).rstrip('/')
+        self.oauth_url = f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials'
+        self.stk_push_url = f'{self.base_url}/mpesa/stkpush/v1/processrequest'
+        self.callback_url = callback_url or Config.MPESA_CALLBACK_URL
+        self.active = active
+
+    @property
+    def token_key(self) -> str:
+        return f'access_token_{self.integration_id}'
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'MpesaIntegration':
+        return cls(
+            integration_id=data['id'],
+            shortcode=_secret(data['shortcode']),
+            passkey=_secret(data.get('passkey')),
+            consumer_key=_secret(data.get('consumer_key')),
+            consumer_secret=_secret(data.get('consumer_secret')),
+            sandbox=bool(data.get('sandbox', True)),
+            landlord=data.get('landlord'),
+            estates=data.get('estates', ()),
+            base_url=data.get('base_url'),
+            callback_url=data.get('callback_url'),
+            active=bool(data.get('active', True))
+        )
+
+    def to_dict(self) -> dict:
+        """Public description (no secrets)"""
+        return {
+            'id': self.integration_id,
+            'landlord': self.landlord,
+            'estates': list(self.estates),
+            'shortcode': self.shortcode,
+            'sandbox': self.sandbox,
+            'base_url': self.base_url,
+            'active': self.active
+        }
+
+
+def default_integration() -> MpesaIntegration:
+    """The single paybill configured through MPESA_* settings"""
+    return MpesaIntegration(
+        integration_id=DEFAULT_INTEGRATION,
+        shortcode=Config.MPESA_SHORTCODE,
+        passkey=Config.MPESA_PASSKEY,
+        consumer_key=Config.MPESA_CONSUMER_KEY,
+        consumer_secret=Config.MPESA_CONSUMER_SECRET,
+        sandbox=Config.MPESA_SANDBOX,
+        base_url=Config.MPESA_BASE_URL
+    )
+
+
+class IntegrationRegistry:
+    def __init__(self, path: str = None, integrations: list = None):
+        """Load integrations from a JSON file (or a list), plus the default one"""
+        if integrations is None:
+            integrations = self._load(path if path is not None else Config.MPESA_INTEGRATIONS_FILE)
+
+        self.default = default_integration()
+        self._by_id = {DEFAULT_INTEGRATION: self.default}
+        self._by_landlord = {}
+        self._by_estate = {}
+        for integration in integrations:
+            if integration.integration_id in self._by_id and integration.integration_id != DEFAULT_INTEGRATION:
+                raise ValueError(f"Duplicate M-Pesa integration id: {integration.integration_id}")
+            self._by_id[integration.integration_id] = integration
+            if integration.integration_id == DEFAULT_INTEGRATION:
+                self.default = integration
+            if not integration.active:
+                continue
+            if not integration.landlord and not integration.estates and integration is not self.default:
+                raise ValueError(
+                    f"M-Pesa integration '{integration.integration_id}' has no landlord or estates to collect for"
+                )
+            if integration.landlord:
+                self._by_landlord[integration.landlord.lower()] = integration
+            for estate in integration.estates:
+                if estate.lower() in self._by_estate:
+                    raise ValueError(f"Estate '{estate}' is mapped to more than one M-Pesa integration")
+                self._by_estate[estate.lower()] = integration
+
+    @staticmethod
+    def _load(path: str) -> list:
+        if not path:
+            return []
+        with open(path, encoding='utf-8') as handle:
+            entries = json.load(handle)
+        integrations = [MpesaIntegration.from_dict(entry) for entry in entries]
+        logger.info("Loaded %s M-Pesa integrations from %s", len(integrations), path)
+        return integrations
+
+    def get(self, integration_id: str):
+        return self._by_id.get(integration_id)
+
+    def for_landlord(self, landlord: str):
+        return self._by_landlord.get((landlord or '').lower())
+
+    def for_estate(self, estate: str):
+        return self._by_estate.get((estate or '').lower())
+
+    def for_tenant(self, tenant: dict) -> MpesaIntegration:
+        """Paybill a tenant pays into: their estate's, else their landlord's, else the default"""
+        return (self._by_estate.get((tenant.get('estate') or '').lower())
+                or self._by_landlord.get((tenant.get('landlord') or '').lower())
+                or self.default)
+
+    def active(self) -> list:
+        """Integrations that can take payments (credentials present)"""
+        return [
+            integration for integration in self._by_id.values()
+            if integration.active and integration.shortcode and integration.consumer_key
+        ]
+
+    def to_list(self) -> list:
+        return [integration.to_dict() for integration in self._by_id.values()]
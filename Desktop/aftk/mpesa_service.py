@@ -1,10 +1,18 @@
-import base64
-import hashlib
+import logging
 import time
 import requests
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 from config import Config
+from http_pool import PooledSession, Deadline, DeadlineExceeded
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from token_cache import TokenManager
+from stk_credentials import StkCredentialProvider
+from logging_setup import event
+from phone_numbers import msisdn
+from mpesa_integrations import IntegrationRegistry, MpesaIntegration
+
+logger = logging.getLogger(__name__)
 
 class MpesaService:
     def __init__(self):
@@ -12,30 +20,92 @@ class MpesaService:
         # Generate a key for encryption (in production, store this securely)
         self.encryption_key = Fernet.generate_key()
         self.cipher = Fernet(self.encryption_key)
-        self.access_token_cache = {}
+        # OAuth tokens shared across workers, refreshed single-flight in the background
+        self.token_manager = TokenManager()
+        # STK (timestamp, password) pairs, derived once per second per shortcode
+        self.credentials = StkCredentialProvider()
+        # Per-landlord paybills, indexed by id, landlord and estate
+        self.integrations = IntegrationRegistry()
+        # Keep-alive connection pool shared by all threads of this worker
+        self.http = PooledSession(
+            pool_size=self.config.MPESA_HTTP_POOL_SIZE,
+            connect_timeout=self.config.MPESA_HTTP_CONNECT_TIMEOUT,
+            read_timeout=self.config.MPESA_HTTP_READ_TIMEOUT,
+            retries=self.config.MPESA_HTTP_RETRIES,
+            backoff_factor=self.config.MPESA_HTTP_BACKOFF,
+            name='daraja'
+        )
+        # Fail fast while Daraja is erroring or slow, probe it again after a cool-down
+        self.breaker = CircuitBreaker(
+            'daraja',
+            failure_rate=self.config.MPESA_BREAKER_FAILURE_RATE,
+            slow_call_rate=self.config.MPESA_BREAKER_SLOW_CALL_RATE,
+            slow_call_seconds=self.config.MPESA_BREAKER_SLOW_CALL_SECONDS,
+            min_calls=self.config.MPESA_BREAKER_MIN_CALLS,
+            window=self.config.MPESA_BREAKER_WINDOW,
+            open_seconds=self.config.MPESA_BREAKER_OPEN_SECONDS,
+            half_open_probes=self.config.MPESA_BREAKER_HALF_OPEN_PROBES
+        )
+    
+    def _request(self, method: str, url: str, deadline: Deadline = None, operation: str = 'request', **kwargs):
+        """Call Daraja through the circuit breaker, within the caller's deadline if given"""
+        self.breaker.before_call()
+        started = time.monotonic()
+        failed = True
+        try:
+            response = self.http.request(method, url, deadline=deadline, operation=operation, **kwargs)
+            failed = response.status_code >= 500
+            return response
+        except DeadlineExceeded:
+            # Out of time before anything was sent: not Daraja's failure
+            failed = None
+            self.breaker.release()
+            raise
+        except requests.Timeout as e:
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded(f"Daraja did not answer within the deadline: {e}") from e
+            raise
+        finally:
+            if failed is not None:
+                self.breaker.record(failed, time.monotonic() - started)
     
-    def generate_access_token(self, consumer_key: str, consumer_secret: str, integration_id: str) -> str:
-        """Generate M-Pesa access token with caching"""
+    def generate_access_token(self, consumer_key: str, consumer_secret: str, integration_id: str,
+                              oauth_url: str = None, deadline: Deadline = None) -> str:
+        """Generate M-Pesa access token with caching.
+        With a deadline, a token that has to be fetched (or waited for) must arrive in time."""
         cache_key = f'access_token_{integration_id}'
-        
-        # Check if we have a cached token
-        if cache_key in self.access_token_cache:
-            cached_data = self.access_token_cache[cache_key]
-            if time.time() < cached_data['expires_at']:
-                return cached_data['token']
-        
-        # Generate new token
         try:
-            response = requests.get(
-                self.config.MPESA_OAUTH_URL,
+            # Only this call's own fetch and wait are bound by the deadline; renewals get a fetch without it
+            return self.token_manager.get_token(
+                cache_key,
+                lambda: self._fetch_access_token(consumer_key, consumer_secret, oauth_url, deadline),
+                timeout=deadline.remaining() if deadline is not None else None,
+                renew=lambda: self._fetch_access_token(consumer_key, consumer_secret, oauth_url)
+            )
+        except TimeoutError as e:
+            raise DeadlineExceeded(f"Access token not available within the deadline: {e}") from e
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
+        except Exception as e:
+            logger.error("Error generating access token: %s", e, extra=event('mpesa.oauth_error'))
+            raise Exception(f"Access token generation failed: {str(e)}")
+    
+    def _fetch_access_token(self, consumer_key: str, consumer_secret: str, oauth_url: str = None,
+                            deadline: Deadline = None) -> tuple:
+        """Call the OAuth endpoint, returns (access_token, expires_in)"""
+        try:
+            response = self._request(
+                'GET',
+                oauth_url or self.config.MPESA_OAUTH_URL,
+                deadline=deadline,
+                operation='oauth',
                 auth=(consumer_key, consumer_secret),
-                headers={'Accept': 'application/json'},
-                timeout=30
+                headers={'Accept': 'application/json'}
             )
             response.raise_for_status()
             
             data = response.json()
-            print(f"OAuth response: {data}")
+            logger.debug("OAuth response received", extra=event('mpesa.oauth', expires_in=data.get('expires_in')))
             
             access_token = data.get('access_token')
             expires_in = data.get('expires_in', 3600)
@@ -46,69 +116,102 @@ class MpesaService:
                     expires_in = int(expires_in)
                 except ValueError:
                     expires_in = 3600  # Default fallback
-                    print(f"Warning: Could not convert expires_in '{data.get('expires_in')}' to int, using default: {expires_in}")
+                    logger.warning("Could not convert expires_in %r to int, using default: %s",
+                                   data.get('expires_in'), expires_in)
             
             if not access_token:
                 raise Exception("No access token received from M-Pesa OAuth")
             
-            # Cache the token (expires at 80% of actual expiry time)
-            cache_duration = int(expires_in * 0.8)
-            self.access_token_cache[cache_key] = {
-                'token': access_token,
-                'expires_at': time.time() + cache_duration
-            }
-            
-            return access_token
+            return access_token, expires_in
             
+        except DeadlineExceeded:
+            raise
         except requests.RequestException as e:
-            print(f"Request error generating access token: {str(e)}")
+            logger.error("Request error generating access token: %s", e, extra=event('mpesa.oauth_error'))
             raise Exception(f"Failed to generate access token: {str(e)}")
-        except Exception as e:
-            print(f"Error generating access token: {str(e)}")
-            raise Exception(f"Access token generation failed: {str(e)}")
     
     def generate_password(self, shortcode: str, passkey: str) -> str:
-        """Generate M-Pesa password using timestamp"""
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        password_string = f"{shortcode}{passkey}{timestamp}"
-        password = base64.b64encode(password_string.encode()).decode()
-        print(f"Generated password with timestamp: {timestamp}")
-        return password
+        """Generate M-Pesa password for the current second"""
+        return self.credentials.get(shortcode, passkey)[1]
+    
+    def access_token_for(self, integration: MpesaIntegration, deadline: Deadline = None) -> str:
+        """Cached access token of an integration's Daraja app"""
+        return self.generate_access_token(
+            integration.consumer_key,
+            integration.consumer_secret,
+            integration.integration_id,
+            integration.oauth_url,
+            deadline
+        )
+    
+    def prewarm_tokens(self, wait: bool = True) -> dict:
+        """Fetch tokens for every active integration concurrently, so no payment
+        waits on OAuth. Returns integration id -> 'ok' or the error."""
+        integrations = self.integrations.active()
+        if not integrations:
+            return {}
+        
+        def warm(integration):
+            try:
+                self.access_token_for(integration)
+                return integration.integration_id, 'ok'
+            except Exception as e:
+                logger.warning("Could not prewarm token for %s: %s", integration.integration_id, e,
+                               extra=event('mpesa.prewarm_error', integration=integration.integration_id))
+                return integration.integration_id, str(e)
+        
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.config.MPESA_PREWARM_WORKERS, len(integrations)),
+            thread_name_prefix='token-prewarm'
+        )
+        futures = [executor.submit(warm, integration) for integration in integrations]
+        executor.shutdown(wait=False)
+        if not wait:
+            return {}
+        return dict(future.result() for future in futures)
     
-    def send_stk_push(self, phone: str, amount: int, account_ref: str, description: str) -> dict:
-        """Send STK push to initiate M-Pesa payment"""
+    def send_stk_push(self, phone: str, amount: int, account_ref: str, description: str,
+                      deadline: Deadline = None, integration: MpesaIntegration = None) -> dict:
+        """Send STK push to initiate M-Pesa payment into an integration's paybill
+        (the default one if not given).
+        Raises CircuitOpenError without calling Daraja while the circuit is open,
+        and DeadlineExceeded once the deadline has passed."""
+        integration = integration or self.integrations.default
         try:
-            print(f"Starting STK push for phone: {phone}, amount: {amount}")
+            if self.breaker.is_open():
+                raise CircuitOpenError("M-Pesa is unavailable (circuit open)")
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded("STK push deadline passed before it was sent")
             
-            # Generate access token
-            access_token = self.generate_access_token(
-                self.config.MPESA_CONSUMER_KEY,
-                self.config.MPESA_CONSUMER_SECRET,
-                'default'
-            )
-            print(f"Access token generated successfully")
+            logger.info("Starting STK push", extra=event(
+                'stk.start', phone=phone, amount=amount, integration=integration.integration_id
+            ))
+            
+            # Generate access token (prewarmed and renewed in the background)
+            access_token = self.access_token_for(integration, deadline)
             
-            # Generate password
-            password = self.generate_password(self.config.MPESA_SHORTCODE, self.config.MPESA_PASSKEY)
+            # Password and the timestamp it was derived from, as one pair
+            timestamp, password = self.credentials.get(integration.shortcode, integration.passkey)
             
             # Prepare request body
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+            phone = msisdn(phone)
             
             payload = {
-                'BusinessShortCode': self.config.MPESA_SHORTCODE,
+                'BusinessShortCode': integration.shortcode,
                 'Password': password,
                 'Timestamp': timestamp,
                 'TransactionType': 'CustomerPayBillOnline',
                 'Amount': amount,
                 'PartyA': phone,
-                'PartyB': self.config.MPESA_SHORTCODE,
+                'PartyB': integration.shortcode,
                 'PhoneNumber': phone,
-                'CallBackURL': self.config.MPESA_CALLBACK_URL,
+                'CallBackURL': integration.callback_url,
                 'AccountReference': account_ref,
                 'TransactionDesc': description[:13]  # Limit to 13 characters
             }
             
-            print(f"STK push payload: {payload}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("STK push payload: %s", payload, extra=event('stk.payload'))
             
             # Send STK push request
             headers = {
@@ -116,46 +219,47 @@ class MpesaService:
                 'Content-Type': 'application/json'
             }
             
-            print(f"Sending STK push to: {self.config.MPESA_STK_PUSH_URL}")
-            response = requests.post(
-                self.config.MPESA_STK_PUSH_URL,
+            response = self._request(
+                'POST',
+                integration.stk_push_url,
+                deadline=deadline,
+                operation='stk_push',
                 json=payload,
-                headers=headers,
-                timeout=30
+                headers=headers
             )
             
-            # Log the full response for debugging
-            print(f"STK push response status: {response.status_code}")
-            print(f"STK push response headers: {dict(response.headers)}")
-            
             if not response.ok:
-                error_detail = response.text
-                print(f"STK push error response: {error_detail}")
-                try:
-                    error_json = response.json()
-                    print(f"STK push error JSON: {error_json}")
-                except:
-                    pass
+                logger.warning("STK push rejected: %s", response.text,
+                               extra=event('stk.error', status=response.status_code))
                 response.raise_for_status()
             
             result = response.json()
-            print(f"STK push response: {result}")
+            logger.info("STK push response", extra=event(
+                'stk.response',
+                status=response.status_code,
+                response_code=result.get('ResponseCode'),
+                checkout_request_id=result.get('CheckoutRequestID')
+            ))
             
             return result
             
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except requests.RequestException as e:
-            print(f"Request error in STK push: {str(e)}")
+            logger.error("Request error in STK push: %s", e, extra=event('stk.error'))
             raise Exception(f"Failed to send STK push: {str(e)}")
         except Exception as e:
-            print(f"STK push error: {str(e)}")
+            logger.error("STK push error: %s", e, extra=event('stk.error'))
             raise Exception(f"STK push error: {str(e)}")
     
     def format_phone_number(self, phone: str) -> str:
-        """Format phone number for M-Pesa (add 254 prefix if needed)"""
-        if phone.startswith('+'):
-            phone = phone[1:]
-        if phone.startswith('0'):
-            phone = '254' + phone[1:]
-        if not phone.startswith('254'):
-            phone = '254' + phone
-        return phone
+        """Format phone number for M-Pesa (254XXXXXXXXX, no '+')"""
+        return msisdn(phone)
+    
+    def breaker_stats(self) -> dict:
+        """Daraja circuit breaker state and recent error/slow-call counts"""
+        return self.breaker.stats()
+    
+    def pool_stats(self) -> dict:
+        """Connection pool utilisation for the Daraja host"""
+        return self.http.stats()
@@ -0,0 +1,146 @@
+"""
+Durable ledger of M-Pesa STK callbacks
+
+Every callback is appended once: unique indexes on CheckoutRequestID and
+MpesaReceiptNumber make Daraja retries no-ops, so payments are never
+double-counted. Callbacks are written through a group-commit writer and the
+tenant's balance is updated in the same transaction as the ledger row.
+"""
+
+import json
+from datetime import datetime
+from config import Config
+from db import get_database, GroupCommitWriter
+from phone_numbers import normalize_phone
+from tenant_store import SCHEMA as TENANT_SCHEMA
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mpesa_callbacks (
+    id INTEGER PRIMARY KEY,
+    checkout_request_id TEXT NOT NULL,
+    merchant_request_id TEXT,
+    result_code INTEGER NOT NULL,
+    result_desc TEXT,
+    amount INTEGER,
+    receipt_number TEXT,
+    phone TEXT,
+    transaction_date TEXT,
+    payload TEXT NOT NULL,
+    received_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mpesa_callbacks_checkout ON mpesa_callbacks(checkout_request_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mpesa_callbacks_receipt
+    ON mpesa_callbacks(receipt_number) WHERE receipt_number IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_mpesa_callbacks_phone ON mpesa_callbacks(phone);
+
+CREATE TRIGGER IF NOT EXISTS mpesa_callbacks_no_update BEFORE UPDATE ON mpesa_callbacks
+BEGIN
+    SELECT RAISE(ABORT, 'mpesa_callbacks is append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS mpesa_callbacks_no_delete BEFORE DELETE ON mpesa_callbacks
+BEGIN
+    SELECT RAISE(ABORT, 'mpesa_callbacks is append-only');
+END;
+"""
+
+RECORDED = 'recorded'
+DUPLICATE = 'duplicate'
+
+
+def parse_stk_callback(callback_data: dict) -> dict:
+    """Flatten a Daraja STK callback body into a ledger entry"""
+    stk_callback = (callback_data or {}).get('Body', {}).get('stkCallback', {})
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    if not checkout_request_id:
+        raise ValueError("Callback has no CheckoutRequestID")
+
+    metadata = {
+        item.get('Name'): item.get('Value')
+        for item in stk_callback.get('CallbackMetadata', {}).get('Item', [])
+    }
+    amount = metadata.get('Amount')
+    phone = metadata.get('PhoneNumber')
+    transaction_date = metadata.get('TransactionDate')
+
+    return {
+        'checkout_request_id': checkout_request_id,
+        'merchant_request_id': stk_callback.get('MerchantRequestID'),
+        'result_code': int(stk_callback.get('ResultCode', -1)),
+        'result_desc': stk_callback.get('ResultDesc'),
+        'amount': int(round(float(amount))) if amount is not None else None,
+        'receipt_number': metadata.get('MpesaReceiptNumber'),
+        'phone': normalize_phone(phone) or None,
+        'transaction_date': str(transaction_date) if transaction_date is not None else None,
+        'payload': json.dumps(callback_data, separators=(',', ':'))
+    }
+
+
+def _payment_date(transaction_date: str) -> str:
+    """Daraja sends TransactionDate as YYYYMMDDHHMMSS"""
+    try:
+        return datetime.strptime(transaction_date, '%Y%m%d%H%M%S').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return datetime.now().strftime('%Y-%m-%d')
+
+
+class PaymentLedger:
+    def __init__(self, db_path: str = None):
+        self.db = get_database(db_path)
+        self.db.ensure_schema('tenants', TENANT_SCHEMA)
+        self.db.ensure_schema('mpesa_callbacks', SCHEMA)
+        self.writer = GroupCommitWriter(
+            self.db,
+            self._apply_batch,
+            batch_size=Config.LEDGER_BATCH_SIZE,
+            batch_window=Config.LEDGER_BATCH_WINDOW,
+            name='payment-ledger'
+        )
+
+    def record(self, callback_data: dict) -> str:
+        """Append a callback and apply it to the tenant's balance, once it is durable.
+        Returns RECORDED, or DUPLICATE for a callback already in the ledger."""
+        entry = parse_stk_callback(callback_data)
+        return self.writer.submit(entry, timeout=Config.LEDGER_ACK_TIMEOUT)
+
+    def _apply_batch(self, conn, entries: list) -> list:
+        received_at = datetime.now().isoformat(timespec='seconds')
+        results = []
+        for entry in entries:
+            cursor = conn.execute(
+                '''INSERT OR IGNORE INTO mpesa_callbacks
+                   (checkout_request_id, merchant_request_id, result_code, result_desc, amount,
+                    receipt_number, phone, transaction_date, payload, received_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (entry['checkout_request_id'], entry['merchant_request_id'], entry['result_code'],
+                 entry['result_desc'], entry['amount'], entry['receipt_number'], entry['phone'],
+                 entry['transaction_date'], entry['payload'], received_at)
+            )
+            if cursor.rowcount == 0:
+                results.append(DUPLICATE)
+                continue
+
+            if entry['result_code'] == 0 and entry['amount'] and entry['phone']:
+                conn.execute(
+                    '''UPDATE tenants
+                       SET rent_due = MAX(rent_due - ?, 0), last_payment = ?, updated_at = ?
+                       WHERE phone = ?''',
+                    (entry['amount'], _payment_date(entry['transaction_date']), received_at, entry['phone'])
+                )
+            results.append(RECORDED)
+        return results
+
+    def get(self, checkout_request_id: str):
+        row = self.db.execute(
+            'SELECT * FROM mpesa_callbacks WHERE checkout_request_id = ?', (checkout_request_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def payments_for(self, phone: str, limit: int = 20) -> list:
+        rows = self.db.execute(
+            '''SELECT * FROM mpesa_callbacks WHERE phone = ? AND result_code = 0
+               ORDER BY id DESC LIMIT ?''', (normalize_phone(phone), limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def pending_writes(self) -> int:
+        return self.writer.depth()
@@ -0,0 +1,50 @@
+"""
+Canonical phone numbers
+
+Every phone number that enters RentPay (USSD gateway, dashboard forms, tenant
+imports, M-Pesa callbacks) is reduced to E.164 (+254792138852) before it is
+used as a key, so 0792 138 852, 254792138852 and +254-792-138-852 all find the
+same tenant. Results are memoized: the same few thousand tenant numbers are
+normalized over and over.
+"""
+
+from functools import lru_cache
+from config import Config
+
+
+@lru_cache(maxsize=65536)
+def normalize_phone(phone: str) -> str:
+    """E.164 form of a phone number ('' if it has no digits)"""
+    if not phone:
+        return ''
+    phone = str(phone).strip()
+    digits = phone if phone.isdigit() else ''.join(ch for ch in phone if ch.isdigit())
+    if not digits:
+        return ''
+
+    country_code = Config.PHONE_COUNTRY_CODE
+    if phone.startswith('+'):
+        pass
+    elif digits.startswith('00'):
+        digits = digits[2:]  # international dialling prefix
+    elif digits.startswith(country_code) and len(digits) > len(country_code) + 8:
+        pass  # already international, just missing the '+'
+    elif digits.startswith('0'):
+        digits = country_code + digits[1:]  # national trunk prefix
+    else:
+        digits = country_code + digits
+
+    # '+254 0792...' - trunk prefix kept after the country code
+    if digits.startswith(country_code + '0'):
+        digits = country_code + digits[len(country_code) + 1:]
+    return '+' + digits
+
+
+def msisdn(phone: str) -> str:
+    """Digits only (254792138852), as M-Pesa expects"""
+    return normalize_phone(phone)[1:]
+
+
+def normalize_many(phones) -> list:
+    """Normalize a batch of numbers (e.g. a tenant import), dropping empties and duplicates"""
+    return list(dict.fromkeys(number for number in map(normalize_phone, phones) if number))
@@ -0,0 +1,381 @@
+"""
+Opt-in request profiling for the RentPay apps
+
+A RequestProfiler hooks into a Flask app and profiles a sample of its
+requests: either with cProfile, or with a background thread that samples the
+request thread's stack every PROFILE_STACK_INTERVAL seconds (much cheaper,
+fine for production). Results are aggregated per route, or per USSD node when
+a handler calls tag(), into top-function reports and flamegraph-compatible
+collapsed stacks (`flamegraph.pl`, speedscope).
+
+It is switched at runtime through /debug/profile. The switch is stored in the
+RentPay database and re-read every PROFILE_SETTINGS_TTL seconds, so every
+worker follows it without a redeploy; when off, a request pays one cached
+flag check. Aggregates are per process, like the metrics.
+
+    curl -X POST -H "X-Profile-Token: $PROFILE_TOKEN" -d enabled=1 -d sample_rate=0.05 \\
+         http://localhost:5000/debug/profile
+    curl -H "X-Profile-Token: $PROFILE_TOKEN" http://localhost:5000/debug/profile/top
+    curl -H "X-Profile-Token: $PROFILE_TOKEN" http://localhost:5000/debug/profile/collapsed > ussd.collapsed
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import Response, g, jsonify, request
+from config import Config
+from db import get_database
+from logging_setup import event
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiling_settings (
+    app TEXT PRIMARY KEY,
+    enabled INTEGER NOT NULL,
+    sample_rate REAL NOT NULL,
+    mode TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+"""
+
+# Profiling modes
+STACK = 'stack'
+CPROFILE = 'cprofile'
+MODES = (STACK, CPROFILE)
+
+ROUTE_PREFIX = '/debug/profile'
+
+
+def tag(key: str):
+    """Aggregate the current request's profile under key (e.g. 'ussd:pay_rent') instead of its route"""
+    g.profile_key = key
+
+
+def _frame_label(code) -> str:
+    # ';' separates frames in the collapsed format
+    name = getattr(code, 'co_qualname', code.co_name)
+    return f'{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+
+def collapse(frame) -> str:
+    """A stack as 'outer;...;inner' frame labels"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class StackSampler:
+    """Samples the stacks of registered threads while any are registered"""
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or Config.PROFILE_STACK_INTERVAL
+        self._active = {}  # thread id -> Counter of collapsed stacks
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self, thread_id: int) -> Counter:
+        samples = Counter()
+        self._ensure_thread()
+        with self._lock:
+            self._active[thread_id] = samples
+            self._wake.set()
+        return samples
+
+    def stop(self, thread_id: int) -> Counter:
+        with self._lock:
+            return self._active.pop(thread_id, Counter())
+
+    def _ensure_thread(self):
+        """Start the sampler thread, restarting it in forked workers"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[collapse(frame)] += 1
+                if not self._active:
+                    self._wake.clear()
+                    continue
+            del frames
+            time.sleep(self.interval)
+
+
+class RequestProfiler:
+    def __init__(self, app_name: str, db_path: str = None, settings_ttl: float = None):
+        self.app_name = app_name
+        self.settings_ttl = settings_ttl if settings_ttl is not None else Config.PROFILE_SETTINGS_TTL
+        self.db = get_database(db_path)
+        self.db.ensure_schema('profiling_settings', SCHEMA)
+        self.sampler = StackSampler()
+
+        self._settings = None
+        self._settings_read_at = 0.0
+        # cProfile hooks the whole interpreter on newer Pythons; profile one request at a time
+        self._cprofile_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._requests = Counter()   # key -> profiled requests
+        self._seconds = Counter()    # key -> wall time of profiled requests
+        self._stacks = Counter()     # 'key;frame;...' -> samples
+        self._stats = {}             # key -> pstats.Stats
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule(ROUTE_PREFIX, 'profile_settings', self._settings_view, methods=['GET', 'POST'])
+        app.add_url_rule(f'{ROUTE_PREFIX}/top', 'profile_top', self._top_view)
+        app.add_url_rule(f'{ROUTE_PREFIX}/collapsed', 'profile_collapsed', self._collapsed_view)
+        app.add_url_rule(f'{ROUTE_PREFIX}/dump', 'profile_dump', self._dump_view, methods=['POST'])
+        return self
+
+    # Runtime switch
+
+    def settings(self) -> dict:
+        """Current switch for this app, re-read from the database every settings_ttl seconds"""
+        now = time.monotonic()
+        if self._settings is None or now - self._settings_read_at >= self.settings_ttl:
+            row = self.db.execute(
+                'SELECT enabled, sample_rate, mode FROM profiling_settings WHERE app = ?', (self.app_name,)
+            ).fetchone()
+            if row is None:
+                self._settings = {'enabled': Config.PROFILE_ENABLED,
+                                  'sample_rate': Config.PROFILE_SAMPLE_RATE,
+                                  'mode': Config.PROFILE_MODE}
+            else:
+                self._settings = {'enabled': bool(row['enabled']),
+                                  'sample_rate': row['sample_rate'],
+                                  'mode': row['mode']}
+            self._settings_read_at = now
+        return self._settings
+
+    def configure(self, enabled: bool = None, sample_rate: float = None, mode: str = None) -> dict:
+        """Change the switch for every worker of this app"""
+        settings = dict(self.settings())
+        if enabled is not None:
+            settings['enabled'] = bool(enabled)
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError("sample_rate must be between 0 and 1")
+            settings['sample_rate'] = sample_rate
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError(f"mode must be one of {', '.join(MODES)}")
+            settings['mode'] = mode
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO profiling_settings (app, enabled, sample_rate, mode, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (self.app_name, int(settings['enabled']), settings['sample_rate'], settings['mode'],
+                 datetime.now().isoformat(timespec='seconds'))
+            )
+        self._settings, self._settings_read_at = settings, time.monotonic()
+        logger.info("Request profiling for %s: %s", self.app_name, settings, extra=event('profile.settings', **settings))
+        return settings
+
+    # Request hooks
+
+    def _before_request(self):
+        settings = self.settings()
+        if not settings['enabled'] or random.random() >= settings['sample_rate']:
+            return
+        if request.path.startswith(ROUTE_PREFIX):
+            return
+        if settings['mode'] == CPROFILE:
+            if not self._cprofile_lock.acquire(blocking=False):
+                return  # another request is being profiled, this one isn't sampled
+            profile = cProfile.Profile()
+            g.profile_run = (CPROFILE, profile, time.perf_counter())
+            profile.enable()
+        else:
+            samples = self.sampler.start(threading.get_ident())
+            g.profile_run = (STACK, samples, time.perf_counter())
+
+    def _teardown_request(self, exc=None):
+        run = g.pop('profile_run', None)
+        if run is None:
+            return
+        mode, data, started = run
+        if mode == CPROFILE:
+            data.disable()
+            self._cprofile_lock.release()
+        else:
+            self.sampler.stop(threading.get_ident())
+        elapsed = time.perf_counter() - started
+
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        key = g.get('profile_key') or f'{request.method} {rule}'
+        stats = pstats.Stats(data) if mode == CPROFILE else None
+        with self._lock:
+            self._requests[key] += 1
+            self._seconds[key] += elapsed
+            if stats is None:
+                for stack, count in data.items():
+                    self._stacks[f'{key};{stack}'] += count
+            elif key in self._stats:
+                self._stats[key].add(stats)
+            else:
+                self._stats[key] = stats
+
+    # Reports
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                key: {'requests': count, 'avg_ms': round(self._seconds[key] / count * 1000, 2)}
+                for key, count in self._requests.most_common()
+            }
+
+    def collapsed(self, key: str = None) -> str:
+        """Collapsed stacks ('frame;frame;... count' per line), optionally for one key"""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        if key:
+            prefix = f'{key};'
+            stacks = [(stack, count) for stack, count in stacks if stack.startswith(prefix)]
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks))
+
+    def top(self, key: str = None, limit: int = 25, sort: str = 'cumulative') -> list:
+        """Hottest functions: cProfile times plus stack-sample counts, summed over keys"""
+        functions = {}
+
+        def entry(name):
+            return functions.setdefault(name, {
+                'function': name, 'calls': 0, 'self_seconds': 0.0, 'cumulative_seconds': 0.0,
+                'self_samples': 0, 'cumulative_samples': 0
+            })
+
+        with self._lock:
+            profiles = [stats for stats_key, stats in self._stats.items() if not key or stats_key == key]
+            stacks = [(stack, count) for stack, count in self._stacks.items()
+                      if not key or stack.startswith(f'{key};')]
+            for stats in profiles:
+                for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+                    item = entry(f'{name} ({os.path.basename(filename)}:{line})')
+                    item['calls'] += calls
+                    item['self_seconds'] += tottime
+                    item['cumulative_seconds'] += cumtime
+
+        for stack, count in stacks:
+            frames = stack.split(';')[1:]  # drop the key
+            if not frames:
+                continue
+            entry(frames[-1])['self_samples'] += count
+            for name in set(frames):
+                entry(name)['cumulative_samples'] += count
+
+        if sort == 'self':
+            order = lambda item: (item['self_seconds'], item['self_samples'])
+        else:
+            order = lambda item: (item['cumulative_seconds'], item['cumulative_samples'])
+        ranked = sorted(functions.values(), key=order, reverse=True)[:limit]
+        for item in ranked:
+            item['self_seconds'] = round(item['self_seconds'], 6)
+            item['cumulative_seconds'] = round(item['cumulative_seconds'], 6)
+        return ranked
+
+    def dump(self, directory: str = None) -> dict:
+        """Write this process's collapsed stacks and merged cProfile data to files"""
+        directory = directory or Config.PROFILE_OUTPUT_DIR
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f'{self.app_name}-{os.getpid()}')
+        files = {}
+        collapsed = self.collapsed()
+        if collapsed:
+            with open(f'{base}.collapsed', 'w', encoding='utf-8') as handle:
+                handle.write(collapsed)
+            files['collapsed'] = f'{base}.collapsed'
+        with self._lock:
+            profiles = list(self._stats.values())
+        if profiles:
+            merged = pstats.Stats()
+            for stats in profiles:
+                merged.add(stats)
+            merged.dump_stats(f'{base}.prof')
+            files['cprofile'] = f'{base}.prof'
+        return files
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    # Endpoints
+
+    @staticmethod
+    def _authorized() -> bool:
+        """PROFILE_TOKEN in X-Profile-Token if configured, else local requests only"""
+        if Config.PROFILE_TOKEN:
+            return hmac.compare_digest(request.headers.get('X-Profile-Token', ''), Config.PROFILE_TOKEN)
+        return request.remote_addr in ('127.0.0.1', '::1')
+
+    def _settings_view(self):
+        """GET: switch and profiled requests per key. POST enabled, sample_rate, mode, reset to change them."""
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        if request.method == 'POST':
+            values = request.get_json(silent=True) or request.values
+            enabled = values.get('enabled')
+            sample_rate = values.get('sample_rate')
+            try:
+                self.configure(
+                    enabled=None if enabled is None else str(enabled).lower() in ('1', 'true', 'on'),
+                    sample_rate=None if sample_rate is None else float(sample_rate),
+                    mode=values.get('mode')
+                )
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            if str(values.get('reset', '')).lower() in ('1', 'true', 'on'):
+                self.reset()
+        return jsonify({'app': self.app_name, 'pid': os.getpid(), 'settings': self.settings(),
+                        'profiled': self.summary()})
+
+    def _top_view(self):
+        """?key=ussd:pay_rent&limit=25&sort=cumulative|self"""
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        try:
+            limit = int(request.args.get('limit', 25))
+        except ValueError:
+            return jsonify({'error': 'limit must be a number'}), 400
+        key = request.args.get('key')
+        return jsonify({
+            'app': self.app_name,
+            'pid': os.getpid(),
+            'key': key,
+            'functions': self.top(key, limit, request.args.get('sort', 'cumulative'))
+        })
+
+    def _collapsed_view(self):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        return Response(self.collapsed(request.args.get('key')), mimetype='text/plain')
+
+    def _dump_view(self):
+        if not self._authorized():
+            return jsonify({'error': 'Forbidden'}), 403
+        return jsonify({'pid': os.getpid(), 'files': self.dump()})
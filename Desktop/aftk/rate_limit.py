@@ -0,0 +1,51 @@
+"""
+Token-bucket rate limiting for upstream providers
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = None):
+        """
+        rate: tokens added per second (0 or less disables limiting)
+        burst: bucket capacity, defaults to one second's worth of tokens
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Take tokens now, returns how long the caller must wait before using them"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens: int = 1):
+        """Block until tokens are available"""
+        if self.rate <= 0:
+            return
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_acquire(self, tokens: int = 1) -> bool:
+        """Take tokens if available right now without blocking"""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
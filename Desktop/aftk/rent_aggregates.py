@@ -0,0 +1,164 @@
+"""
+Materialized rent aggregates
+
+Per-estate totals (tenants, rent due, tenants in arrears) and monthly M-Pesa
+collections are kept up to date by SQLite triggers on the tenants and
+mpesa_callbacks tables. Every write path (dashboard edits, invoices, payment
+callbacks) maintains them in its own transaction, so reading them never
+scans the tenant book.
+"""
+
+from datetime import datetime
+from db import get_database
+from tenant_store import SCHEMA as TENANT_SCHEMA
+from payment_ledger import SCHEMA as LEDGER_SCHEMA
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rent_totals (
+    estate TEXT PRIMARY KEY,
+    tenants INTEGER NOT NULL DEFAULT 0,
+    rent_due INTEGER NOT NULL DEFAULT 0,
+    in_arrears INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS rent_collections (
+    month TEXT PRIMARY KEY,
+    amount INTEGER NOT NULL DEFAULT 0,
+    payments INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS rent_totals_tenant_insert AFTER INSERT ON tenants
+BEGIN
+    INSERT INTO rent_totals (estate, tenants, rent_due, in_arrears)
+    VALUES (NEW.estate, 1, NEW.rent_due, NEW.rent_due > 0)
+    ON CONFLICT(estate) DO UPDATE SET
+        tenants = tenants + 1,
+        rent_due = rent_due + excluded.rent_due,
+        in_arrears = in_arrears + excluded.in_arrears;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rent_totals_tenant_delete AFTER DELETE ON tenants
+BEGIN
+    UPDATE rent_totals SET
+        tenants = tenants - 1,
+        rent_due = rent_due - OLD.rent_due,
+        in_arrears = in_arrears - (OLD.rent_due > 0)
+    WHERE estate = OLD.estate;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rent_totals_tenant_update AFTER UPDATE OF estate, rent_due ON tenants
+WHEN OLD.estate IS NOT NEW.estate OR OLD.rent_due IS NOT NEW.rent_due
+BEGIN
+    UPDATE rent_totals SET
+        tenants = tenants - 1,
+        rent_due = rent_due - OLD.rent_due,
+        in_arrears = in_arrears - (OLD.rent_due > 0)
+    WHERE estate = OLD.estate;
+    INSERT INTO rent_totals (estate, tenants, rent_due, in_arrears)
+    VALUES (NEW.estate, 1, NEW.rent_due, NEW.rent_due > 0)
+    ON CONFLICT(estate) DO UPDATE SET
+        tenants = tenants + 1,
+        rent_due = rent_due + excluded.rent_due,
+        in_arrears = in_arrears + excluded.in_arrears;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rent_collections_payment AFTER INSERT ON mpesa_callbacks
+WHEN NEW.result_code = 0 AND NEW.amount IS NOT NULL
+BEGIN
+    INSERT INTO rent_collections (month, amount, payments)
+    VALUES (
+        CASE WHEN length(NEW.transaction_date) >= 6
+             THEN substr(NEW.transaction_date, 1, 4) || '-' || substr(NEW.transaction_date, 5, 2)
+             ELSE substr(NEW.received_at, 1, 7) END,
+        NEW.amount, 1
+    )
+    ON CONFLICT(month) DO UPDATE SET
+        amount = amount + excluded.amount,
+        payments = payments + 1;
+END;
+"""
+
+# Same month expression as the trigger, for rebuilding from the ledger
+_MONTH_SQL = """CASE WHEN length(transaction_date) >= 6
+                     THEN substr(transaction_date, 1, 4) || '-' || substr(transaction_date, 5, 2)
+                     ELSE substr(received_at, 1, 7) END"""
+
+
+class RentAggregates:
+    def __init__(self, db_path: str = None):
+        self.db = get_database(db_path)
+        self.db.ensure_schema('tenants', TENANT_SCHEMA)
+        self.db.ensure_schema('mpesa_callbacks', LEDGER_SCHEMA)
+        created = self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rent_totals'"
+        ).fetchone() is None
+        self.db.ensure_schema('rent_aggregates', SCHEMA)
+        if created:
+            # Tenants and payments recorded before the triggers existed
+            self.rebuild()
+
+    def rebuild(self):
+        """Recompute every aggregate from the tenants and ledger tables"""
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM rent_totals')
+            conn.execute(
+                '''INSERT INTO rent_totals (estate, tenants, rent_due, in_arrears)
+                   SELECT estate, COUNT(*), COALESCE(SUM(rent_due), 0), SUM(rent_due > 0)
+                   FROM tenants GROUP BY estate'''
+            )
+            conn.execute('DELETE FROM rent_collections')
+            conn.execute(
+                f'''INSERT INTO rent_collections (month, amount, payments)
+                    SELECT {_MONTH_SQL}, SUM(amount), COUNT(*)
+                    FROM mpesa_callbacks WHERE result_code = 0 AND amount IS NOT NULL
+                    GROUP BY 1'''
+            )
+
+    def totals(self, estate: str = None) -> dict:
+        """Tenant count, rent due and arrears for one estate or the whole portfolio"""
+        if estate:
+            row = self.db.execute(
+                'SELECT tenants, rent_due, in_arrears FROM rent_totals WHERE estate = ?', (estate,)
+            ).fetchone()
+        else:
+            # One row per estate, so this stays cheap however many tenants there are
+            row = self.db.execute(
+                '''SELECT COALESCE(SUM(tenants), 0) AS tenants, COALESCE(SUM(rent_due), 0) AS rent_due,
+                          COALESCE(SUM(in_arrears), 0) AS in_arrears
+                   FROM rent_totals'''
+            ).fetchone()
+        return {
+            'total_tenants': row['tenants'] if row else 0,
+            'total_rent_due': row['rent_due'] if row else 0,
+            'tenants_in_arrears': row['in_arrears'] if row else 0
+        }
+
+    def by_estate(self) -> dict:
+        rows = self.db.execute(
+            'SELECT * FROM rent_totals WHERE tenants > 0 ORDER BY estate'
+        ).fetchall()
+        return {
+            row['estate']: {
+                'total_tenants': row['tenants'],
+                'total_rent_due': row['rent_due'],
+                'tenants_in_arrears': row['in_arrears']
+            }
+            for row in rows
+        }
+
+    def estates(self) -> list:
+        rows = self.db.execute(
+            'SELECT estate FROM rent_totals WHERE tenants > 0 ORDER BY estate'
+        ).fetchall()
+        return [row['estate'] for row in rows]
+
+    def collected(self, month: str = None) -> dict:
+        """M-Pesa rent collected in a month (YYYY-MM, defaults to the current month)"""
+        month = month or datetime.now().strftime('%Y-%m')
+        row = self.db.execute(
+            'SELECT amount, payments FROM rent_collections WHERE month = ?', (month,)
+        ).fetchone()
+        return {
+            'month': month,
+            'amount': row['amount'] if row else 0,
+            'payments': row['payments'] if row else 0
+        }
@@ -1,10 +1,21 @@
-import requests
+import logging
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
+from http_pool import PooledSession
+from rate_limit import TokenBucket
+from logging_setup import event
+from sms_templates import TemplateRegistry
+from phone_numbers import normalize_phone
+from sms_spool import SmsSpool
+from delivery_reports import DeliveryReportStore
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 class SMSService:
     def __init__(self):
         # SMS API Configuration - using Africa's Talking as default
@@ -16,22 +27,86 @@ class SMSService:
         # Alternative SMS providers
         self.provider = os.getenv('SMS_PROVIDER', 'africastalking').lower()
         
+        # Bulk sending: bounded concurrency, per-request timeouts and provider rate limits
+        self.max_in_flight = int(os.getenv('SMS_MAX_IN_FLIGHT', '10'))
+        self.http = PooledSession(
+            pool_size=self.max_in_flight,
+            connect_timeout=float(os.getenv('SMS_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.getenv('SMS_READ_TIMEOUT', '15')),
+            retries=0,
+            name='sms'
+        )
+        self.batch_size = int(os.getenv('SMS_BATCH_SIZE', '100'))  # recipients per Africa's Talking request
+        self.rate_limiters = {
+            'africastalking': TokenBucket(float(os.getenv('SMS_RATE_LIMIT_AFRICASTALKING', '20'))),
+            'twilio': TokenBucket(float(os.getenv('SMS_RATE_LIMIT_TWILIO', '1'))),
+            'generic': TokenBucket(0)
+        }
+        
+        # Compiled, segment-aware message templates (SMS_TEMPLATE_DIR for per-landlord overrides)
+        self.templates = TemplateRegistry()
+        
+        # Invoices go through the disk spool and a separate sender process when enabled
+        self.spool = SmsSpool() if os.getenv('SMS_SPOOL_ENABLED', 'false').lower() == 'true' else None
+        
+        # Accepted messages, moved on to delivered/failed by the providers' delivery reports
+        self.delivery_reports = DeliveryReportStore()
+        
     def send_rent_invoice(self, tenant_phone: str, tenant_name: str, house_number: str, 
-                          estate: str, rent_amount: int, due_date: str, ussd_code: str) -> dict:
-        """Send rent invoice SMS to tenant"""
+                          estate: str, rent_amount: int, due_date: str, ussd_code: str,
+                          landlord: str = None) -> dict:
+        """Send rent invoice SMS to tenant (queue it, when the spool is enabled)"""
         
         # Format the SMS message
-        message = self._format_rent_invoice(
-            tenant_name, house_number, estate, rent_amount, due_date, ussd_code
+        invoice = self.render_rent_invoice(
+            tenant_name, house_number, estate, rent_amount, due_date, ussd_code, landlord
         )
         
+        if self.spool is not None:
+            # One invoice per tenant, amount and due date, however often it is submitted
+            queued = self.spool.enqueue(
+                tenant_phone, invoice['text'],
+                key=f'invoice:{normalize_phone(tenant_phone)}:{due_date}:{rent_amount}',
+                segments=invoice['segments']
+            )
+            if not queued['queued']:
+                # Queued or sent earlier: nothing new goes out (failed or lost ones are queued again)
+                return {
+                    "success": False,
+                    "status": "already_queued",
+                    "spool_status": queued['status'],
+                    "error": "Invoice already sent" if queued['status'] == 'sent' else "Invoice already queued",
+                    "message_id": queued['message_key'],
+                    "provider": "spool",
+                    "segments": invoice['segments']
+                }
+            return {
+                "success": True,
+                "status": "queued",
+                "message_id": queued['message_key'],
+                "provider": "spool",
+                "segments": invoice['segments']
+            }
+        
+        result = self._send_message(tenant_phone, invoice['text'])
+        self._record_sent(tenant_phone, result)
+        result['segments'] = invoice['segments']
+        return result
+    
+    def _record_sent(self, phone: str, result: dict):
+        if result.get('success') and result.get('message_id'):
+            self.delivery_reports.record_sent(result['message_id'], phone, result.get('provider'))
+    
+    def _send_message(self, phone: str, message: str) -> dict:
+        """Send one SMS through the configured provider"""
+        phone = normalize_phone(phone)
         try:
             if self.provider == 'africastalking':
-                return self._send_africastalking(tenant_phone, message)
+                return self._send_africastalking(phone, message)
             elif self.provider == 'twilio':
-                return self._send_twilio(tenant_phone, message)
+                return self._send_twilio(phone, message)
             else:
-                return self._send_generic(tenant_phone, message)
+                return self._send_generic(phone, message)
                 
         except Exception as e:
             return {
@@ -40,27 +115,28 @@ class SMSService:
                 "message": "Failed to send SMS"
             }
     
-    def _format_rent_invoice(self, tenant_name: str, house_number: str, estate: str, 
-                            rent_amount: int, due_date: str, ussd_code: str) -> str:
-        """Format the rent invoice SMS message"""
-        
-        message = f"""RENT INVOICE
-        
-Dear {tenant_name},
-House: {house_number}
-Estate: {estate}
-Rent Due: KES {rent_amount:,}
-Due Date: {due_date}
-
-To pay, dial: {ussd_code}
-
-Thank you,
-RentPay Team"""
-        
-        return message
+    def render_rent_invoice(self, tenant_name: str, house_number: str, estate: str, 
+                             rent_amount: int, due_date: str, ussd_code: str,
+                             landlord: str = None) -> dict:
+        """Render the rent invoice SMS (text plus encoding and segment count)"""
+        return self.templates.render(
+            'invoice',
+            landlord=landlord,
+            tenant_name=tenant_name,
+            house_number=house_number,
+            estate=estate,
+            rent_amount=rent_amount,
+            due_date=due_date,
+            ussd_code=ussd_code
+        )
     
     def _send_africastalking(self, phone: str, message: str) -> dict:
         """Send SMS using Africa's Talking API"""
+        return self._send_africastalking_batch([phone], message)[phone]
+    
+    def _send_africastalking_batch(self, phones: list, message: str) -> dict:
+        """Send one message to many recipients in a single Africa's Talking request.
+        Returns a result per phone, parsed from the response's Recipients list."""
         try:
             headers = {
                 'Accept': 'application/json',
@@ -70,27 +146,56 @@ RentPay Team"""
             
             data = {
                 'username': self.username,
-                'to': phone,
+                'to': ','.join(phones),
                 'message': message,
                 'from': self.sender_id
             }
             
-            response = requests.post(self.api_url, headers=headers, data=data)
+            response = self.http.post(self.api_url, operation='africastalking', headers=headers, data=data)
             response.raise_for_status()
             
             result = response.json()
-            return {
-                "success": True,
-                "message_id": result.get('SMSMessageData', {}).get('Recipients', [{}])[0].get('messageId'),
-                "provider": "Africa's Talking",
-                "status": "sent"
+            recipients = {
+                normalize_phone(recipient.get('number', '')): recipient
+                for recipient in result.get('SMSMessageData', {}).get('Recipients', [])
             }
             
+            results = {}
+            for phone in phones:
+                recipient = recipients.get(normalize_phone(phone))
+                if recipient is None and len(phones) == 1 and len(recipients) == 1:
+                    # Single recipient sends may echo the number in another format
+                    recipient = next(iter(recipients.values()))
+                if recipient is None:
+                    results[phone] = {
+                        "success": False,
+                        "error": "Recipient missing from provider response",
+                        "provider": "Africa's Talking"
+                    }
+                elif recipient.get('status', 'Success') == 'Success':
+                    results[phone] = {
+                        "success": True,
+                        "message_id": recipient.get('messageId'),
+                        "provider": "Africa's Talking",
+                        "status": "sent"
+                    }
+                else:
+                    results[phone] = {
+                        "success": False,
+                        "error": recipient.get('status'),
+                        "message_id": recipient.get('messageId'),
+                        "provider": "Africa's Talking"
+                    }
+            return results
+            
         except Exception as e:
             return {
-                "success": False,
-                "error": str(e),
-                "provider": "Africa's Talking"
+                phone: {
+                    "success": False,
+                    "error": str(e),
+                    "provider": "Africa's Talking"
+                }
+                for phone in phones
             }
     
     def _send_twilio(self, phone: str, message: str) -> dict:
@@ -111,8 +216,11 @@ RentPay Team"""
                 'From': twilio_number,
                 'Body': message
             }
+            status_callback = os.getenv('TWILIO_STATUS_CALLBACK_URL', '')
+            if status_callback:
+                data['StatusCallback'] = status_callback
             
-            response = requests.post(url, data=data, auth=(account_sid, auth_token))
+            response = self.http.post(url, operation='twilio', data=data, auth=(account_sid, auth_token))
             response.raise_for_status()
             
             result = response.json()
@@ -134,14 +242,11 @@ RentPay Team"""
         """Generic SMS sending (for testing or custom providers)"""
         try:
             # For testing purposes, just log the message
-            print(f"=== SMS TO BE SENT ===")
-            print(f"To: {phone}")
-            print(f"Message: {message}")
-            print(f"======================")
+            logger.info("SMS to be sent:\n%s", message, extra=event('sms.generic', to=phone))
             
             return {
                 "success": True,
-                "message_id": f"test_{datetime.now().strftime('%Y%m%d%H%M%S')}",
+                "message_id": f"test_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}",
                 "provider": "Generic/Test",
                 "status": "logged"
             }
@@ -153,37 +258,94 @@ RentPay Team"""
                 "provider": "Generic/Test"
             }
     
-    def send_bulk_invoices(self, tenants_data: list, ussd_code: str) -> dict:
-        """Send rent invoices to multiple tenants"""
-        results = []
-        success_count = 0
-        failure_count = 0
+    def _rate_limiter(self) -> TokenBucket:
+        return self.rate_limiters.get(self.provider, self.rate_limiters['generic'])
+    
+    def _plan_requests(self, messages: list) -> list:
+        """Group (phone, message) pairs into provider requests.
+        Africa's Talking takes a comma-separated recipient list, so identical
+        messages are batched; everything else is one request per message."""
+        if self.provider != 'africastalking':
+            return [(message, [(index, phone)]) for index, (phone, message) in enumerate(messages)]
         
-        for tenant in tenants_data:
-            result = self.send_rent_invoice(
-                tenant_phone=tenant['phone'],
-                tenant_name=tenant['name'],
-                house_number=tenant['house_number'],
-                estate=tenant['estate'],
-                rent_amount=tenant['rent_amount'],
-                due_date=tenant['due_date'],
-                ussd_code=ussd_code
+        groups = {}
+        for index, (phone, message) in enumerate(messages):
+            # Canonical numbers, so two spellings of one number share a single recipient slot
+            groups.setdefault(message, []).append((index, normalize_phone(phone)))
+        
+        requests_plan = []
+        for message, recipients in groups.items():
+            for start in range(0, len(recipients), self.batch_size):
+                requests_plan.append((message, recipients[start:start + self.batch_size]))
+        return requests_plan
+    
+    def _send_request(self, message: str, recipients: list) -> list:
+        """Send one planned request once the provider's rate limit allows it"""
+        self._rate_limiter().acquire()
+        if len(recipients) == 1:
+            index, phone = recipients[0]
+            return [(index, self._send_message(phone, message))]
+        
+        phones = list(dict.fromkeys(phone for _, phone in recipients))
+        results = self._send_africastalking_batch(phones, message)
+        return [(index, results[phone]) for index, phone in recipients]
+    
+    def send_messages(self, messages: list) -> list:
+        """Send (phone, message) pairs concurrently, returns results in the same order"""
+        if not messages:
+            return []
+        
+        plan = self._plan_requests(messages)
+        results = [None] * len(messages)
+        workers = min(self.max_in_flight, len(plan))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sms-bulk') as executor:
+            for request_results in executor.map(lambda item: self._send_request(*item), plan):
+                for index, result in request_results:
+                    results[index] = result
+        for (phone, _), result in zip(messages, results):
+            self._record_sent(phone, result)
+        return results
+    
+    def send_bulk_message(self, phones: list, message: str) -> dict:
+        """Send the same message (reminder, notice) to many tenants"""
+        results = self.send_messages([(phone, message) for phone in phones])
+        success_count = sum(1 for result in results if result['success'])
+        return {
+            "total_sent": len(phones),
+            "success_count": success_count,
+            "failure_count": len(phones) - success_count,
+            "results": [{'phone': phone, 'result': result} for phone, result in zip(phones, results)]
+        }
+    
+    def send_bulk_invoices(self, tenants_data: list, ussd_code: str) -> dict:
+        """Send rent invoices to multiple tenants concurrently, within the provider's rate limit"""
+        invoices = [
+            self.render_rent_invoice(
+                tenant['name'], tenant['house_number'], tenant['estate'],
+                tenant['rent_amount'], tenant['due_date'], ussd_code, tenant.get('landlord')
             )
-            
-            results.append({
+            for tenant in tenants_data
+        ]
+        sent = self.send_messages([
+            (tenant['phone'], invoice['text']) for tenant, invoice in zip(tenants_data, invoices)
+        ])
+        
+        results = [
+            {
                 'tenant': tenant['name'],
                 'phone': tenant['phone'],
                 'result': result
-            })
-            
-            if result['success']:
-                success_count += 1
-            else:
-                failure_count += 1
+            }
+            for tenant, result in zip(tenants_data, sent)
+        ]
+        success_count = sum(1 for item in results if item['result']['success'])
+        failure_count = len(results) - success_count
         
         return {
             "total_sent": len(tenants_data),
             "success_count": success_count,
             "failure_count": failure_count,
+            "total_segments": sum(invoice['segments'] for invoice in invoices),
             "results": results
         }
+
@@ -0,0 +1,298 @@
+"""
+Outbound SMS spool
+
+With SMS_SPOOL_ENABLED=true, SMSService.send_rent_invoice only appends the
+rendered message to the sms_outbox table and returns; a separate sender
+process (`python sms_spool.py`) drains it through the provider. Failed sends
+are retried with exponential backoff until SMS_SPOOL_MAX_ATTEMPTS, and every
+message has a key (e.g. one invoice per tenant and due date), so enqueueing
+the same message twice sends it once, unless the earlier one failed or was
+lost, in which case it is queued again. Queued messages are on disk, so a
+restart of either side loses nothing. Like bulk-invoice recipients, a message
+whose sender died mid-request is marked unknown rather than sent again; a
+sender renews its lease while a batch is in flight. Finished messages are
+purged after SMS_SPOOL_RETENTION_DAYS.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import random
+import signal
+import threading
+import time
+import uuid
+from datetime import datetime
+from config import Config
+from db import get_database
+from logging_setup import setup_logging, event
+from phone_numbers import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sms_outbox (
+    id INTEGER PRIMARY KEY,
+    message_key TEXT NOT NULL UNIQUE,
+    phone TEXT NOT NULL,
+    message TEXT NOT NULL,
+    segments INTEGER NOT NULL DEFAULT 1,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    message_id TEXT,
+    provider TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sms_outbox_due ON sms_outbox(status, next_attempt_at);
+"""
+
+# Message states
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'     # gave up after SMS_SPOOL_MAX_ATTEMPTS
+UNKNOWN = 'unknown'   # the sender died while the provider had it
+
+FINISHED_STATUSES = (SENT, FAILED, UNKNOWN)
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def message_key(phone: str, message: str) -> str:
+    """Default dedupe key: the same text to the same number"""
+    digest = hashlib.sha1(message.encode('utf-8')).hexdigest()[:16]
+    return f'{normalize_phone(phone)}:{digest}'
+
+
+class SmsSpool:
+    def __init__(self, db_path: str = None, max_attempts: int = None, retry_base: float = None,
+                 retry_max: float = None, lease_seconds: float = None):
+        self.max_attempts = max_attempts or Config.SMS_SPOOL_MAX_ATTEMPTS
+        self.retry_base = retry_base or Config.SMS_SPOOL_RETRY_BASE
+        self.retry_max = retry_max or Config.SMS_SPOOL_RETRY_MAX
+        self.lease_seconds = lease_seconds or Config.SMS_SPOOL_LEASE
+        self.db = get_database(db_path or Config.SMS_SPOOL_PATH or None)
+        self.db.ensure_schema('sms_outbox', SCHEMA)
+
+    def enqueue(self, phone: str, message: str, key: str = None, segments: int = 1) -> dict:
+        """Queue one message. A key that already failed or was lost is queued again.
+        Returns the key, whether it was queued, and the message's status."""
+        phone = normalize_phone(phone)
+        key = key or message_key(phone, message)
+        now = _now()
+        cursor = self.db.connection().execute(
+            f'''INSERT INTO sms_outbox
+                (message_key, phone, message, segments, status, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(message_key) DO UPDATE SET
+                    phone = excluded.phone,
+                    message = excluded.message,
+                    segments = excluded.segments,
+                    status = excluded.status,
+                    attempts = 0,
+                    next_attempt_at = excluded.next_attempt_at,
+                    lease_until = NULL,
+                    worker = NULL,
+                    message_id = NULL,
+                    provider = NULL,
+                    error = NULL,
+                    updated_at = excluded.updated_at
+                WHERE sms_outbox.status IN ('{FAILED}', '{UNKNOWN}')''',
+            (key, phone, message, segments, PENDING, time.time(), now, now)
+        )
+        if cursor.rowcount == 1:
+            return {'message_key': key, 'queued': True, 'status': PENDING}
+        existing = self.get(key)
+        return {'message_key': key, 'queued': False, 'status': existing['status'] if existing else None}
+
+    def get(self, key: str):
+        row = self.db.execute('SELECT * FROM sms_outbox WHERE message_key = ?', (key,)).fetchone()
+        return dict(row) if row else None
+
+    def outcomes(self, keys: list) -> dict:
+        """Status, provider message id and error of many messages, by key"""
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.db.execute(
+                f'''SELECT message_key, status, message_id, error FROM sms_outbox
+                    WHERE message_key IN ({",".join("?" * len(batch))})''', batch
+            ).fetchall()
+            found.update({row['message_key']: dict(row) for row in rows})
+        return found
+
+    def claim(self, worker: str, limit: int) -> list:
+        """Lease up to limit due messages to a sender"""
+        now = time.time()
+        with self.db.transaction() as conn:
+            # Leases that ran out belong to a sender that died mid-request
+            conn.execute(
+                'UPDATE sms_outbox SET status = ?, updated_at = ? WHERE status = ? AND lease_until < ?',
+                (UNKNOWN, _now(), SENDING, now)
+            )
+            rows = conn.execute(
+                '''SELECT id, phone, message, attempts FROM sms_outbox
+                   WHERE status = ? AND next_attempt_at <= ?
+                   ORDER BY next_attempt_at LIMIT ?''', (PENDING, now, limit)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE sms_outbox SET status = ?, worker = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                [(SENDING, worker, now + self.lease_seconds, _now(), row['id']) for row in rows]
+            )
+        return [dict(row) for row in rows]
+
+    def renew(self, worker: str, messages: list) -> int:
+        """Extend a sender's lease on messages it is still sending, returns how many it holds"""
+        with self.db.transaction() as conn:
+            cursor = conn.executemany(
+                '''UPDATE sms_outbox SET lease_until = ?, updated_at = ?
+                   WHERE id = ? AND status = ? AND worker = ?''',
+                [(time.time() + self.lease_seconds, _now(), message['id'], SENDING, worker)
+                 for message in messages]
+            )
+        return cursor.rowcount
+
+    def complete(self, messages: list, results: list, worker: str = None):
+        """Record provider results for claimed messages, scheduling retries for failures.
+        With worker, messages that sender no longer holds (marked unknown after its lease
+        ran out) are left as they are."""
+        now = time.time()
+        updated_at = _now()
+        sent, retry, failed = [], [], []
+        for message, result in zip(messages, results):
+            if result.get('success'):
+                sent.append((SENT, result.get('message_id'), result.get('provider'), updated_at, message['id']))
+                continue
+            attempts = message['attempts'] + 1
+            error = str(result.get('error') or 'Unknown error')[:500]
+            if attempts >= self.max_attempts:
+                failed.append((FAILED, attempts, error, updated_at, message['id']))
+            else:
+                # Exponential backoff with jitter, so a provider outage is not hammered in lockstep
+                delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                retry.append((PENDING, attempts, now + delay, error, updated_at, message['id']))
+
+        held = ''
+        if worker is not None:
+            held = ' AND status = ? AND worker = ?'
+            sent, retry, failed = ([row + (SENDING, worker) for row in rows] for rows in (sent, retry, failed))
+        with self.db.transaction() as conn:
+            conn.executemany(
+                f'''UPDATE sms_outbox SET status = ?, attempts = attempts + 1, message_id = ?, provider = ?,
+                           error = NULL, lease_until = NULL, updated_at = ? WHERE id = ?{held}''', sent
+            )
+            conn.executemany(
+                f'''UPDATE sms_outbox SET status = ?, attempts = ?, next_attempt_at = ?, error = ?,
+                           lease_until = NULL, updated_at = ? WHERE id = ?{held}''', retry
+            )
+            conn.executemany(
+                f'''UPDATE sms_outbox SET status = ?, attempts = ?, error = ?, lease_until = NULL,
+                           updated_at = ? WHERE id = ?{held}''', failed
+            )
+        if retry or failed:
+            logger.warning("SMS spool: %s to retry, %s given up", len(retry), len(failed),
+                           extra=event('sms.spool_retry', retry=len(retry), failed=len(failed)))
+
+    def purge(self, older_than_days: float = None) -> int:
+        """Delete finished messages last updated more than the retention period ago"""
+        days = Config.SMS_SPOOL_RETENTION_DAYS if older_than_days is None else older_than_days
+        cutoff = datetime.fromtimestamp(time.time() - days * 86400).isoformat(timespec='seconds')
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                f'''DELETE FROM sms_outbox WHERE status IN ({",".join("?" * len(FINISHED_STATUSES))})
+                    AND updated_at < ?''', (*FINISHED_STATUSES, cutoff)
+            )
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        rows = self.db.execute('SELECT status, COUNT(*) AS count FROM sms_outbox GROUP BY status').fetchall()
+        counts = {status: 0 for status in (PENDING, SENDING, SENT, FAILED, UNKNOWN)}
+        counts.update({row['status']: row['count'] for row in rows})
+        return counts
+
+
+class SmsSender:
+    """Drains the spool through an SMSService; run one or more per host"""
+
+    def __init__(self, spool: SmsSpool, sms_service, batch_size: int = None, poll_interval: float = None):
+        self.spool = spool
+        self.sms_service = sms_service
+        self.batch_size = batch_size or Config.SMS_SPOOL_BATCH_SIZE
+        self.poll_interval = poll_interval or Config.SMS_SPOOL_POLL_INTERVAL
+        self.worker_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._stop = threading.Event()
+        self._purged_at = 0.0
+
+    def _heartbeat(self, messages: list, done: threading.Event):
+        """Renew the batch's lease until done is set, a rate-limited batch can outlast it"""
+        while not done.wait(self.spool.lease_seconds / 3):
+            self.spool.renew(self.worker_id, messages)
+
+    def drain_once(self) -> int:
+        """Send one batch of due messages, returns how many were attempted"""
+        messages = self.spool.claim(self.worker_id, self.batch_size)
+        if not messages:
+            return 0
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(messages, done),
+                                     name='sms-spool-lease', daemon=True)
+        heartbeat.start()
+        try:
+            results = self.sms_service.send_messages([(message['phone'], message['message']) for message in messages])
+        finally:
+            done.set()
+            heartbeat.join()
+        self.spool.complete(messages, results, self.worker_id)
+        return len(messages)
+
+    def _purge_hourly(self):
+        if time.time() - self._purged_at < 3600:
+            return
+        self._purged_at = time.time()
+        purged = self.spool.purge()
+        if purged:
+            logger.info("SMS spool: purged %s finished messages", purged, extra=event('sms.spool_purge', purged=purged))
+
+    def run(self):
+        logger.info("SMS sender %s started", self.worker_id, extra=event('sms.sender_start'))
+        while not self._stop.is_set():
+            try:
+                self._purge_hourly()
+                if self.drain_once() < self.batch_size:
+                    self._stop.wait(self.poll_interval)
+            except Exception:
+                logger.exception("SMS sender error", extra=event('sms.sender_error'))
+                self._stop.wait(self.poll_interval)
+        logger.info("SMS sender %s stopped", self.worker_id, extra=event('sms.sender_stop'))
+
+    def stop(self, *args):
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send the SMS messages queued in the RentPay spool")
+    parser.add_argument('--once', action='store_true', help="drain what is due and exit")
+    args = parser.parse_args()
+
+    from sms_service import SMSService
+    setup_logging()
+    sender = SmsSender(SmsSpool(), SMSService())
+    if args.once:
+        while sender.drain_once():
+            pass
+        return
+    signal.signal(signal.SIGTERM, sender.stop)
+    signal.signal(signal.SIGINT, sender.stop)
+    sender.run()
+
+
+if __name__ == '__main__':
+    main()
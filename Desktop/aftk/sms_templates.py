@@ -0,0 +1,233 @@
+"""
+SMS templates with segment accounting
+
+Templates are compiled once (whitespace compacted, fields checked) and every
+render reports the encoding and how many segments the message will be billed
+as: GSM-7 fits 160 characters in one SMS (153 per part when concatenated),
+while a single character outside GSM-7 turns the whole message into UCS-2 at
+70 (67) characters. Lines starting with `?` are optional and are dropped,
+last first, when a message would exceed its segment budget.
+
+Per-landlord templates are read from SMS_TEMPLATE_DIR as `<name>.<landlord>.txt`,
+falling back to `<name>.txt` and then to the built-in template.
+"""
+
+import logging
+import os
+import threading
+from string import Formatter
+from logging_setup import event
+
+logger = logging.getLogger(__name__)
+
+GSM7 = 'GSM-7'
+UCS2 = 'UCS-2'
+
+GSM7_BASIC = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# Sent as an escape plus the character, so each costs two septets
+GSM7_EXTENDED = frozenset('^{}\\[~]|€\f')
+
+# Look-alikes (usually pasted from word processors) that would otherwise force UCS-2
+GSM7_REPLACEMENTS = str.maketrans({
+    '\u2018': "'", '\u2019': "'", '\u201a': "'", '\u2032': "'",
+    '\u201c': '"', '\u201d': '"', '\u201e': '"', '\u2033': '"',
+    '\u2013': '-', '\u2014': '-', '\u2212': '-', '\u2026': '...',
+    '\u00a0': ' ', '\u2009': ' ', '\u200b': '', '\t': ' '
+})
+
+# (single message, per part of a concatenated message) in encoding units
+SEGMENT_LIMITS = {GSM7: (160, 153), UCS2: (70, 67)}
+
+INVOICE_TEMPLATE = """
+RENT INVOICE
+
+Dear {tenant_name},
+House: {house_number}
+Estate: {estate}
+Rent Due: KES {rent_amount:,}
+Due Date: {due_date}
+
+To pay, dial: {ussd_code}
+
+?Thank you,
+?RentPay Team
+"""
+
+DEFAULT_TEMPLATES = {'invoice': INVOICE_TEMPLATE}
+
+
+def sms_encoding(text: str) -> str:
+    """GSM7 when every character is in the GSM 03.38 alphabet, otherwise UCS2"""
+    for ch in text:
+        if ch not in GSM7_BASIC and ch not in GSM7_EXTENDED:
+            return UCS2
+    return GSM7
+
+
+def _unit_widths(text: str, encoding: str) -> list:
+    if encoding == GSM7:
+        return [2 if ch in GSM7_EXTENDED else 1 for ch in text]
+    # UTF-16 code units: characters outside the BMP (emoji) take two
+    return [2 if ord(ch) > 0xFFFF else 1 for ch in text]
+
+
+def count_segments(text: str) -> dict:
+    """Encoding, length in encoding units and number of billable segments"""
+    encoding = sms_encoding(text)
+    widths = _unit_widths(text, encoding)
+    units = sum(widths)
+    single, part = SEGMENT_LIMITS[encoding]
+    if units <= single:
+        segments = 1
+    else:
+        # Escaped GSM-7 characters and surrogate pairs are never split across parts
+        segments, used = 1, 0
+        for width in widths:
+            if used + width > part:
+                segments += 1
+                used = 0
+            used += width
+    return {'encoding': encoding, 'units': units, 'segments': segments}
+
+
+def compact(text: str) -> str:
+    """Trim every line, collapse runs of spaces and blank lines"""
+    lines = []
+    for line in text.splitlines():
+        line = ' '.join(line.split())
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines)
+
+
+def _clean_value(value):
+    if not isinstance(value, str):
+        return value
+    return ' '.join(value.translate(GSM7_REPLACEMENTS).split())
+
+
+class SmsTemplate:
+    def __init__(self, source: str, name: str = 'sms', max_segments: int = 1, shorten: bool = True):
+        self.name = name
+        self.max_segments = max_segments
+        self.shorten = shorten
+        self.fields = set()
+        self._lines = []  # (line.format_map, optional)
+
+        formatter = Formatter()
+        for line in compact(source).split('\n'):
+            optional = line.startswith('?')
+            if optional:
+                line = line[1:].lstrip()
+            for _, field, _, _ in formatter.parse(line):
+                if field is not None:
+                    if not field.isidentifier():
+                        raise ValueError(f"Template {name}: unsupported field {{{field}}}")
+                    self.fields.add(field)
+            self._lines.append((line.format_map, optional))
+
+    def render(self, **values) -> dict:
+        """Fill the template; returns text, encoding, segments, characters and shortened"""
+        missing = self.fields - values.keys()
+        if missing:
+            raise ValueError(f"Template {self.name}: missing {', '.join(sorted(missing))}")
+        values = {key: _clean_value(value) for key, value in values.items()}
+        lines = [(render(values), optional) for render, optional in self._lines]
+
+        text = '\n'.join(line for line, _ in lines)
+        info = count_segments(text)
+        shortened = False
+        if info['segments'] > self.max_segments and self.shorten:
+            # Blank lines go first, then optional lines from the bottom up
+            lines = [(line, optional) for line, optional in lines if line]
+            while True:
+                text = '\n'.join(line for line, _ in lines)
+                info = count_segments(text)
+                if info['segments'] <= self.max_segments:
+                    break
+                last_optional = next(
+                    (i for i in range(len(lines) - 1, -1, -1) if lines[i][1]), None
+                )
+                if last_optional is None:
+                    break
+                del lines[last_optional]
+            shortened = True
+
+        if info['segments'] > self.max_segments:
+            logger.warning(
+                "SMS template %s renders to %d segments (limit %d)",
+                self.name, info['segments'], self.max_segments,
+                extra=event('sms.overflow', template=self.name, encoding=info['encoding'],
+                            segments=info['segments'], units=info['units'])
+            )
+        return {
+            'text': text,
+            'encoding': info['encoding'],
+            'segments': info['segments'],
+            'characters': len(text),
+            'shortened': shortened
+        }
+
+
+class TemplateRegistry:
+    """Compiled templates by name and landlord, loaded on first use"""
+
+    def __init__(self, template_dir: str = None, max_segments: int = None):
+        self.template_dir = template_dir if template_dir is not None else os.getenv('SMS_TEMPLATE_DIR', '')
+        self.max_segments = max_segments or int(os.getenv('SMS_MAX_SEGMENTS', '1'))
+        self._templates = {}
+        self._no_override = set()  # (name, landlord) pairs using the default template
+        self._lock = threading.Lock()
+
+    def _compile(self, name: str, landlord: str, source: str, max_segments: int = None) -> SmsTemplate:
+        return SmsTemplate(source, name=f'{name}.{landlord}' if landlord else name,
+                           max_segments=max_segments or self.max_segments)
+
+    def register(self, name: str, source: str, landlord: str = None,
+                 max_segments: int = None) -> SmsTemplate:
+        template = self._compile(name, landlord, source, max_segments)
+        with self._lock:
+            self._templates[(name, landlord)] = template
+            self._no_override.discard((name, landlord))
+        return template
+
+    def _load_source(self, name: str, landlord: str = None):
+        if self.template_dir:
+            filename = f'{name}.{landlord}.txt' if landlord else f'{name}.txt'
+            path = os.path.join(self.template_dir, filename)
+            if os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    return f.read()
+        if landlord is None:
+            return DEFAULT_TEMPLATES.get(name)
+        return None
+
+    def get(self, name: str, landlord: str = None) -> SmsTemplate:
+        key = (name, landlord)
+        if landlord is not None and key not in self._no_override:
+            template = self._templates.get(key)
+            if template is not None:
+                return template
+            source = self._load_source(name, landlord)
+            with self._lock:
+                if source is None:
+                    self._no_override.add(key)
+                else:
+                    return self._templates.setdefault(key, self._compile(name, landlord, source))
+
+        template = self._templates.get((name, None))
+        if template is None:
+            source = self._load_source(name)
+            if source is None:
+                raise KeyError(f"No SMS template named {name}")
+            with self._lock:
+                template = self._templates.setdefault((name, None), self._compile(name, None, source))
+        return template
+
+    def render(self, name: str, landlord: str = None, **values) -> dict:
+        return self.get(name, landlord).render(**values)
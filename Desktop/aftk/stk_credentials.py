@@ -0,0 +1,40 @@
+"""
+STK push credentials
+
+Daraja's STK password is base64(shortcode + passkey + timestamp) and must be
+sent with that same Timestamp. StkCredentialProvider derives both from one
+clock reading and keeps the pair for the rest of that second, so every STK
+push in the same second for a shortcode reuses it instead of re-encoding, and
+the password can never disagree with the payload's timestamp.
+"""
+
+import base64
+import threading
+import time
+from datetime import datetime
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+
+
+class StkCredentialProvider:
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = {}  # (shortcode, passkey) -> (second, timestamp, password)
+
+    def get(self, shortcode: str, passkey: str) -> tuple:
+        """(timestamp, password) for the current second"""
+        second = int(self._clock())
+        key = (str(shortcode), passkey)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == second:
+            return entry[1], entry[2]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != second:
+                timestamp = datetime.fromtimestamp(second).strftime(TIMESTAMP_FORMAT)
+                password = base64.b64encode(f"{key[0]}{passkey}{timestamp}".encode()).decode()
+                entry = (second, timestamp, password)
+                self._entries[key] = entry
+            return entry[1], entry[2]
@@ -0,0 +1,317 @@
+"""
+Background STK push queue
+
+The USSD request only queues the STK push and answers the tenant straight
+away; a small worker pool talks to Daraja. Each job carries the deadline of
+the hop that queued it, so a push that can no longer reach the tenant in time
+is dropped instead of holding a worker. Job status can be polled by job id,
+USSD sessionId or the CheckoutRequestID returned by Daraja.
+
+Only dispatch happens in memory. Every status change is written to SQLite
+(stk_jobs, next to reconciliation's stk_requests) through a group-commit
+writer, so a callback or status poll served by another gunicorn worker, or
+after a restart, sees the job. A callback that beats the write of its job's
+CheckoutRequestID is parked in stk_job_results and applied when the row lands.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from config import Config
+from db import get_database, GroupCommitWriter
+from http_pool import Deadline, DeadlineExceeded
+from circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stk_jobs (
+    job_id TEXT PRIMARY KEY,
+    session_id TEXT,
+    phone TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    account_ref TEXT,
+    integration_id TEXT,
+    status TEXT NOT NULL,
+    checkout_request_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_stk_jobs_session ON stk_jobs(session_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_stk_jobs_checkout ON stk_jobs(checkout_request_id);
+
+CREATE TABLE IF NOT EXISTS stk_job_results (
+    checkout_request_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    error TEXT,
+    received_at REAL NOT NULL
+);
+"""
+
+# Parked callbacks whose job never shows up (not ours, or already pruned) are dropped after this
+PARKED_RESULT_SECONDS = 86400
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+PAID = 'paid'
+CANCELLED = 'cancelled'
+
+ACTIVE_STATUSES = (QUEUED, SENDING)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class StkJob:
+    def __init__(self, session_id: str, phone: str, amount: int, account_ref: str, description: str,
+                 deadline: Deadline = None, integration=None):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.phone = phone
+        self.amount = amount
+        self.account_ref = account_ref
+        self.description = description
+        self.deadline = deadline
+        self.integration = integration  # paybill to collect into, None for the default
+        self.integration_id = integration.integration_id if integration else None
+        self.status = QUEUED
+        self.checkout_request_id = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'session_id': self.session_id,
+            'phone': self.phone,
+            'amount': self.amount,
+            'integration_id': self.integration_id,
+            'status': self.status,
+            'checkout_request_id': self.checkout_request_id,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+
+    @classmethod
+    def from_row(cls, row) -> 'StkJob':
+        """A job as stored in stk_jobs (read-only: it carries no deadline or integration)"""
+        job = cls(row['session_id'], row['phone'], row['amount'], row['account_ref'], None)
+        job.job_id = row['job_id']
+        job.integration_id = row['integration_id']
+        job.status = row['status']
+        job.checkout_request_id = row['checkout_request_id']
+        job.error = row['error']
+        job.created_at = row['created_at']
+        job.updated_at = row['updated_at']
+        return job
+
+
+class StkJobQueue:
+    def __init__(self, mpesa_service, max_workers: int = None, max_pending: int = None,
+                 max_jobs: int = None, request_log=None, db_path: str = None):
+        """request_log: optional PaymentReconciler that keeps accepted pushes for reconciliation
+        max_jobs: finished jobs kept in stk_jobs"""
+        self.mpesa_service = mpesa_service
+        self.request_log = request_log
+        self.max_pending = max_pending or Config.STK_MAX_PENDING
+        self.max_jobs = max_jobs or Config.STK_MAX_TRACKED_JOBS
+        self.max_workers = max_workers or Config.STK_WORKERS
+        # A SimpleQueue put never blocks or contends, so submitting costs the
+        # USSD request almost nothing even while every worker is busy
+        self._work = queue.SimpleQueue()
+        self._workers = []
+        self._workers_pid = None
+        self._lock = threading.Lock()
+        # Jobs queued or sending in this process, until their outcome is stored
+        self._jobs = {}
+        self._by_session = {}
+        self._pending = 0
+        self.db = get_database(db_path)
+        self.db.ensure_schema('stk_jobs', SCHEMA)
+        self.writer = GroupCommitWriter(self.db, self._apply_batch, name='stk-jobs')
+
+    def submit(self, session_id: str, phone: str, amount: int, account_ref: str,
+               description: str, deadline: Deadline = None, integration=None) -> StkJob:
+        """Queue an STK push, reusing the session's job if one is still in flight"""
+        with self._lock:
+            existing = self._jobs.get(self._by_session.get(session_id))
+            if existing is not None:
+                return existing
+            if self._pending >= self.max_pending:
+                raise QueueFullError("Too many M-Pesa requests in progress")
+
+            job = StkJob(session_id, phone, amount, account_ref, description, deadline, integration)
+            self._jobs[job.job_id] = job
+            if session_id:
+                self._by_session[session_id] = job.job_id
+            self._pending += 1
+
+        self._persist(job)
+        self._ensure_workers()
+        self._work.put(job)
+        return job
+
+    def _ensure_workers(self):
+        """Start the worker threads (again after a fork, since threads do not survive it)"""
+        if self._workers_pid == os.getpid():
+            return
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            self._workers = [
+                threading.Thread(target=self._worker, name=f'stk-push-{i}', daemon=True)
+                for i in range(self.max_workers)
+            ]
+            for worker in self._workers:
+                worker.start()
+            self._workers_pid = os.getpid()
+
+    def _worker(self):
+        while True:
+            self._run(self._work.get())
+
+    def _persist(self, job: StkJob):
+        """Queue the job's current state for stk_jobs (written in order, without waiting)"""
+        self.writer.submit(dict(job.to_dict(), account_ref=job.account_ref), wait=False)
+
+    def _apply_batch(self, conn, jobs: list) -> list:
+        for job in jobs:
+            # A callback stored by another worker is final, a late local update must not undo it
+            conn.execute(
+                f'''INSERT INTO stk_jobs (job_id, session_id, phone, amount, account_ref, integration_id,
+                                         status, checkout_request_id, error, created_at, updated_at)
+                   VALUES (:job_id, :session_id, :phone, :amount, :account_ref, :integration_id,
+                           :status, :checkout_request_id, :error, :created_at, :updated_at)
+                   ON CONFLICT(job_id) DO UPDATE SET
+                       status = excluded.status,
+                       checkout_request_id = excluded.checkout_request_id,
+                       error = excluded.error,
+                       updated_at = excluded.updated_at
+                   WHERE stk_jobs.status NOT IN ('{PAID}', '{CANCELLED}')''',
+                job
+            )
+            if job['checkout_request_id']:
+                self._apply_parked_result(conn, job['job_id'], job['checkout_request_id'])
+        # Keep the newest max_jobs jobs
+        conn.execute(
+            f'''DELETE FROM stk_jobs WHERE rowid <= (SELECT MAX(rowid) FROM stk_jobs) - ?
+                  AND status NOT IN ('{QUEUED}', '{SENDING}')''',
+            (self.max_jobs,)
+        )
+        conn.execute('DELETE FROM stk_job_results WHERE received_at < ?', (time.time() - PARKED_RESULT_SECONDS,))
+        return [None] * len(jobs)
+
+    @staticmethod
+    def _apply_parked_result(conn, job_id: str, checkout_request_id: str):
+        """Apply a callback that arrived before the job's CheckoutRequestID was stored"""
+        parked = conn.execute(
+            'SELECT status, error FROM stk_job_results WHERE checkout_request_id = ?', (checkout_request_id,)
+        ).fetchone()
+        if parked is None:
+            return
+        conn.execute(
+            'UPDATE stk_jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?',
+            (parked['status'], parked['error'], time.time(), job_id)
+        )
+        conn.execute('DELETE FROM stk_job_results WHERE checkout_request_id = ?', (checkout_request_id,))
+
+    def _update(self, job: StkJob, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.updated_at = time.time()
+            if job.status not in ACTIVE_STATUSES:
+                # Outcome known: from here on the job is only looked up in stk_jobs
+                self._jobs.pop(job.job_id, None)
+                if self._by_session.get(job.session_id) == job.job_id:
+                    del self._by_session[job.session_id]
+        self._persist(job)
+
+    def _run(self, job: StkJob):
+        self._update(job, status=SENDING)
+        try:
+            response = self.mpesa_service.send_stk_push(
+                phone=job.phone,
+                amount=job.amount,
+                account_ref=job.account_ref,
+                description=job.description,
+                deadline=job.deadline,
+                integration=job.integration
+            )
+            if response.get('ResponseCode') == '0':
+                self._update(job, status=SENT, checkout_request_id=response.get('CheckoutRequestID'))
+                self._log_request(job, response)
+            else:
+                self._update(job, status=FAILED, error=response.get('errorMessage', 'Unknown error'))
+        except CircuitOpenError:
+            self._update(job, status=FAILED, error="M-Pesa is temporarily unavailable")
+        except DeadlineExceeded:
+            logger.warning("STK push job %s missed its deadline", job.job_id)
+            self._update(job, status=FAILED, error="M-Pesa took too long to respond")
+        except Exception as e:
+            logger.error("STK push job %s failed: %s", job.job_id, e)
+            self._update(job, status=FAILED, error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _log_request(self, job: StkJob, response: dict):
+        if self.request_log is None:
+            return
+        try:
+            self.request_log.record_stk_request(
+                response.get('CheckoutRequestID'), response.get('MerchantRequestID'),
+                job.phone, job.amount, job.account_ref
+            )
+        except Exception as e:
+            logger.error("Could not record STK request %s: %s", job.job_id, e)
+
+    def _stored(self, where: str, value: str):
+        row = self.db.execute(
+            f'SELECT * FROM stk_jobs WHERE {where} = ? ORDER BY created_at DESC LIMIT 1', (value,)
+        ).fetchone()
+        return StkJob.from_row(row) if row else None
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id) or self._stored('job_id', job_id)
+
+    def get_by_session(self, session_id: str):
+        return self._jobs.get(self._by_session.get(session_id)) or self._stored('session_id', session_id)
+
+    def get_by_checkout(self, checkout_request_id: str):
+        return self._stored('checkout_request_id', checkout_request_id)
+
+    def record_result(self, checkout_request_id: str, result_code, result_desc: str = None) -> bool:
+        """Apply a Daraja callback result to the matching job, whichever worker sent it.
+        Returns False if no stored job has that CheckoutRequestID yet; the result is then
+        parked and applied once the job's row is written."""
+        if str(result_code) == '0':
+            status, error = PAID, None
+        else:
+            status, error = CANCELLED, result_desc
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                'UPDATE stk_jobs SET status = ?, error = ?, updated_at = ? WHERE checkout_request_id = ?',
+                (status, error, time.time(), checkout_request_id)
+            )
+            if cursor.rowcount == 0:
+                conn.execute(
+                    '''INSERT OR REPLACE INTO stk_job_results (checkout_request_id, status, error, received_at)
+                       VALUES (?, ?, ?, ?)''',
+                    (checkout_request_id, status, error, time.time())
+                )
+        return cursor.rowcount > 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'pending': self._pending, 'in_flight_jobs': len(self._jobs),
+                    'unsaved_updates': self.writer.depth()}
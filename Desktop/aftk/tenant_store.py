@@ -0,0 +1,317 @@
+"""
+Tenant repository shared by the USSD app and the landlord dashboard
+
+Tenants live in SQLite with a unique index on the E.164 phone number (the
+USSD hot path) and secondary indexes on estate and house number. Every number
+is normalized on the way in, so any way of writing it hits the same index entry.
+A tenant's landlord picks their paybill and their SMS templates.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime
+from db import get_database
+from phone_numbers import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+    id INTEGER PRIMARY KEY,
+    phone TEXT NOT NULL,
+    name TEXT NOT NULL,
+    house_number TEXT NOT NULL,
+    estate TEXT NOT NULL,
+    rent_due INTEGER NOT NULL DEFAULT 0,
+    last_payment TEXT,
+    updated_at TEXT NOT NULL,
+    landlord TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_tenants_phone ON tenants(phone);
+CREATE INDEX IF NOT EXISTS idx_tenants_estate ON tenants(estate);
+CREATE INDEX IF NOT EXISTS idx_tenants_house_number ON tenants(house_number);
+
+-- Bumped on every tenant change; API clients use it as an ETag
+CREATE TABLE IF NOT EXISTS data_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO data_versions (name, version) VALUES ('tenants', 0);
+INSERT OR IGNORE INTO data_versions (name, version) VALUES ('tenant_phone_format', 0);
+CREATE TRIGGER IF NOT EXISTS tenants_version_insert AFTER INSERT ON tenants
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'tenants';
+END;
+CREATE TRIGGER IF NOT EXISTS tenants_version_update AFTER UPDATE ON tenants
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'tenants';
+END;
+CREATE TRIGGER IF NOT EXISTS tenants_version_delete AFTER DELETE ON tenants
+BEGIN
+    UPDATE data_versions SET version = version + 1 WHERE name = 'tenants';
+END;
+"""
+
+TENANT_FIELDS = ('name', 'house_number', 'estate', 'rent_due', 'last_payment', 'landlord')
+
+# Fields a tenant listing can be projected to
+LISTING_FIELDS = ('phone',) + TENANT_FIELDS
+
+# Bumped when the stored phone format changes, to re-key older databases
+PHONE_FORMAT_VERSION = 1
+
+# Arrears filters for tenant listings
+IN_ARREARS = 'arrears'
+PAID_UP = 'paid'
+
+# Demo tenants loaded into an empty database
+SEED_TENANTS = {
+    "+254792138852": {
+        "name": "John",
+        "house_number": "HSe no. 4",
+        "estate": "Killimani estate",
+        "rent_due": 25000,
+        "last_payment": "2024-01-15"
+    },
+    "+254715035359": {
+        "name": "Kenn",
+        "house_number": "HSe no. 12",
+        "estate": "Westlands",
+        "rent_due": 30000,
+        "last_payment": "2024-01-10"
+    }
+}
+
+
+class TenantStore:
+    def __init__(self, db_path: str = None, seed: bool = True):
+        self.db = get_database(db_path)
+        self.db.ensure_schema('tenants', SCHEMA)
+        self._migrate_phone_format()
+        self._migrate_landlord_column()
+        if seed:
+            self.seed(SEED_TENANTS)
+
+    @staticmethod
+    def _row_to_tenant(row, fields: tuple = None) -> dict:
+        if fields:
+            return {field: row[field] for field in fields}
+        return {
+            'phone': row['phone'],
+            'name': row['name'],
+            'house_number': row['house_number'],
+            'estate': row['estate'],
+            'rent_due': row['rent_due'],
+            'last_payment': row['last_payment'],
+            'landlord': row['landlord']
+        }
+
+    def _migrate_phone_format(self):
+        row = self.db.execute(
+            "SELECT version FROM data_versions WHERE name = 'tenant_phone_format'"
+        ).fetchone()
+        if row['version'] < PHONE_FORMAT_VERSION:
+            self.normalize_existing()
+
+    def _migrate_landlord_column(self):
+        """Add the landlord column to databases created before tenants had one"""
+        if self._has_column('landlord'):
+            return
+        with self.db.transaction() as conn:
+            # Another worker may have added it while we waited for the write lock
+            if not self._has_column('landlord', conn):
+                conn.execute('ALTER TABLE tenants ADD COLUMN landlord TEXT')
+
+    def _has_column(self, column: str, conn=None) -> bool:
+        rows = (conn or self.db.connection()).execute('PRAGMA table_info(tenants)').fetchall()
+        return any(row['name'] == column for row in rows)
+
+    def normalize_existing(self) -> int:
+        """Re-key tenants stored before phone numbers were E.164, returns the rows changed"""
+        changed = 0
+        with self.db.transaction() as conn:
+            for row in conn.execute('SELECT id, phone FROM tenants').fetchall():
+                phone = normalize_phone(row['phone'])
+                if phone == row['phone']:
+                    continue
+                try:
+                    conn.execute('UPDATE tenants SET phone = ? WHERE id = ?', (phone, row['id']))
+                    changed += 1
+                except sqlite3.IntegrityError:
+                    logger.warning("Tenant %s duplicates %s, left unchanged", row['phone'], phone)
+            conn.execute(
+                "UPDATE data_versions SET version = ? WHERE name = 'tenant_phone_format'",
+                (PHONE_FORMAT_VERSION,)
+            )
+        return changed
+
+    def seed(self, tenants: dict):
+        """Load tenants into an empty store"""
+        if self.count() == 0:
+            self.bulk_upsert(tenants)
+
+    def get(self, phone: str):
+        """Look up a tenant by phone number, returns None if not found"""
+        row = self.db.execute(
+            'SELECT * FROM tenants WHERE phone = ?', (normalize_phone(phone),)
+        ).fetchone()
+        return self._row_to_tenant(row) if row else None
+
+    def all(self) -> dict:
+        """All tenants keyed by phone number"""
+        rows = self.db.execute('SELECT * FROM tenants ORDER BY id').fetchall()
+        return {row['phone']: self._row_to_tenant(row) for row in rows}
+
+    @staticmethod
+    def _filters(estate: str = None, status: str = None):
+        clauses, params = [], []
+        if estate:
+            clauses.append('estate = ?')
+            params.append(estate)
+        if status == IN_ARREARS:
+            clauses.append('rent_due > 0')
+        elif status == PAID_UP:
+            clauses.append('rent_due <= 0')
+        elif status:
+            raise ValueError(f"Unknown tenant status filter: {status}")
+        return clauses, params
+
+    def page(self, after: int = None, before: int = None, limit: int = 50,
+             estate: str = None, status: str = None, fields: tuple = None) -> dict:
+        """One page of tenants in id order, filtered by estate and/or arrears status.
+
+        Keyset pagination: pass a page's next_cursor as `after` (or its prev_cursor
+        as `before`), so every page costs the same however deep it is. `fields`
+        limits each tenant to a subset of LISTING_FIELDS."""
+        if fields:
+            unknown = set(fields) - set(LISTING_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown tenant fields: {', '.join(sorted(unknown))}")
+            columns = ', '.join(('id',) + tuple(fields))
+        else:
+            columns = '*'
+        clauses, params = self._filters(estate, status)
+        backwards = before is not None
+        if backwards:
+            clauses.append('id < ?')
+            params.append(int(before))
+        elif after is not None:
+            clauses.append('id > ?')
+            params.append(int(after))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        order = 'DESC' if backwards else 'ASC'
+        params.append(limit + 1)
+        rows = self.db.execute(
+            f'SELECT {columns} FROM tenants {where} ORDER BY id {order} LIMIT ?', params
+        ).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+            next_cursor = rows[-1]['id'] if rows else None
+            prev_cursor = rows[0]['id'] if rows and has_more else None
+        else:
+            next_cursor = rows[-1]['id'] if rows and has_more else None
+            prev_cursor = rows[0]['id'] if rows and after is not None else None
+        return {
+            'tenants': [self._row_to_tenant(row, fields) for row in rows],
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
+        }
+
+    def iter_tenants(self, estate: str = None, status: str = None, fields: tuple = None,
+                     batch_size: int = 500):
+        """Yield every tenant matching the filters, one page at a time"""
+        cursor = None
+        while True:
+            page = self.page(after=cursor, limit=batch_size, estate=estate, status=status, fields=fields)
+            yield from page['tenants']
+            cursor = page['next_cursor']
+            if cursor is None:
+                return
+
+    def find_by_estate(self, estate: str) -> list:
+        rows = self.db.execute(
+            'SELECT * FROM tenants WHERE estate = ? ORDER BY house_number', (estate,)
+        ).fetchall()
+        return [self._row_to_tenant(row) for row in rows]
+
+    def find_by_house(self, house_number: str, estate: str = None) -> list:
+        if estate is None:
+            rows = self.db.execute(
+                'SELECT * FROM tenants WHERE house_number = ?', (house_number,)
+            ).fetchall()
+        else:
+            rows = self.db.execute(
+                'SELECT * FROM tenants WHERE house_number = ? AND estate = ?', (house_number, estate)
+            ).fetchall()
+        return [self._row_to_tenant(row) for row in rows]
+
+    def version(self) -> int:
+        """Counter bumped by every tenant insert, update and delete"""
+        return self.db.execute(
+            "SELECT version FROM data_versions WHERE name = 'tenants'"
+        ).fetchone()[0]
+
+    def count(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM tenants').fetchone()[0]
+
+    def upsert(self, phone: str, name: str, house_number: str, estate: str,
+               rent_due: int = 0, last_payment: str = None, landlord: str = None) -> dict:
+        """Create or replace a tenant"""
+        self.bulk_upsert({phone: {
+            'name': name,
+            'house_number': house_number,
+            'estate': estate,
+            'rent_due': rent_due,
+            'last_payment': last_payment,
+            'landlord': landlord
+        }})
+        return self.get(phone)
+
+    def bulk_upsert(self, tenants: dict):
+        """Create or replace many tenants in one transaction"""
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = [
+            (normalize_phone(phone), t['name'], t['house_number'], t['estate'],
+             int(t.get('rent_due') or 0), t.get('last_payment'), t.get('landlord'), now)
+            for phone, t in tenants.items()
+        ]
+        with self.db.transaction() as conn:
+            conn.executemany(
+                '''INSERT INTO tenants (phone, name, house_number, estate, rent_due, last_payment, landlord, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(phone) DO UPDATE SET
+                       name = excluded.name,
+                       house_number = excluded.house_number,
+                       estate = excluded.estate,
+                       rent_due = excluded.rent_due,
+                       last_payment = excluded.last_payment,
+                       landlord = excluded.landlord,
+                       updated_at = excluded.updated_at''',
+                rows
+            )
+
+    def update(self, phone: str, **fields) -> bool:
+        """Update some fields of a tenant, returns False if the tenant does not exist"""
+        unknown = set(fields) - set(TENANT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown tenant fields: {', '.join(sorted(unknown))}")
+        if not fields:
+            return self.get(phone) is not None
+
+        assignments = ', '.join(f'{field} = ?' for field in fields)
+        params = list(fields.values())
+        params.append(datetime.now().isoformat(timespec='seconds'))
+        params.append(normalize_phone(phone))
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                f'UPDATE tenants SET {assignments}, updated_at = ? WHERE phone = ?', params
+            )
+        return cursor.rowcount > 0
+
+    def delete(self, phone: str) -> bool:
+        with self.db.transaction() as conn:
+            cursor = conn.execute('DELETE FROM tenants WHERE phone = ?', (normalize_phone(phone),))
+        return cursor.rowcount > 0
@@ -0,0 +1,279 @@
+"""
+OAuth token cache shared between workers
+
+TokenManager keeps a per-process copy of each token in front of a pluggable
+backend (in-process memory or SQLite shared by every gunicorn worker).
+Refreshes are single-flight: one thread per process takes a local lock and one
+process across the host takes a lease in the backend, the rest wait for the
+new token. Tokens are renewed in the background once they pass the refresh
+point, well before the hard expiry, so callers never wait on OAuth.
+Lookups are counted by where the token came from (this process, the shared
+backend, or a fetch), which gives the cache hit ratio.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from config import Config
+from db import get_database
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+TOKEN_LOOKUPS = counter(
+    'rentpay_token_cache_lookups_total', "OAuth token lookups by where the token was found", ('result',)
+)
+LOCAL_HIT = TOKEN_LOOKUPS.labels('local')
+SHARED_HIT = TOKEN_LOOKUPS.labels('shared')
+MISS = TOKEN_LOOKUPS.labels('miss')
+
+
+class MemoryTokenCache:
+    """Tokens held in this process only"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._leases = {}
+
+    def get(self, key: str):
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key: str, entry: dict):
+        with self._lock:
+            self._entries[key] = entry
+
+    def acquire_lease(self, key: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease and lease[1] > now and lease[0] != holder:
+                return False
+            self._leases[key] = (holder, now + ttl)
+            return True
+
+    def release_lease(self, key: str, holder: str):
+        with self._lock:
+            if self._leases.get(key, (None,))[0] == holder:
+                del self._leases[key]
+
+
+class SqliteTokenCache:
+    """Tokens shared by every worker process through the RentPay database"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS oauth_tokens (
+        cache_key TEXT PRIMARY KEY,
+        token TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        refresh_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS oauth_refresh_leases (
+        cache_key TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db = get_database(db_path)
+        self.db.ensure_schema('oauth_tokens', self.SCHEMA)
+
+    def get(self, key: str):
+        row = self.db.execute(
+            'SELECT token, expires_at, refresh_at FROM oauth_tokens WHERE cache_key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'token': row['token'], 'expires_at': row['expires_at'], 'refresh_at': row['refresh_at']}
+
+    def set(self, key: str, entry: dict):
+        with self.db.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO oauth_tokens (cache_key, token, expires_at, refresh_at) VALUES (?, ?, ?, ?)',
+                (key, entry['token'], entry['expires_at'], entry['refresh_at'])
+            )
+
+    def acquire_lease(self, key: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                'SELECT holder, expires_at FROM oauth_refresh_leases WHERE cache_key = ?', (key,)
+            ).fetchone()
+            if row and row['expires_at'] > now and row['holder'] != holder:
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO oauth_refresh_leases (cache_key, holder, expires_at) VALUES (?, ?, ?)',
+                (key, holder, now + ttl)
+            )
+            return True
+
+    def release_lease(self, key: str, holder: str):
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM oauth_refresh_leases WHERE cache_key = ? AND holder = ?', (key, holder))
+
+
+def create_token_cache(backend: str = None):
+    """Build the token cache backend named in config ('sqlite' or 'memory')"""
+    backend = (backend or Config.TOKEN_CACHE_BACKEND).lower()
+    if backend == 'memory':
+        return MemoryTokenCache()
+    if backend == 'sqlite':
+        return SqliteTokenCache(Config.TOKEN_CACHE_PATH or None)
+    raise ValueError(f"Unknown token cache backend: {backend}")
+
+
+class TokenManager:
+    def __init__(self, cache=None, refresh_ratio: float = None, expiry_ratio: float = None,
+                 lease_seconds: float = None):
+        """
+        refresh_ratio: fraction of the token lifetime after which it is renewed in the background
+        expiry_ratio: fraction of the token lifetime after which it is no longer used
+        """
+        self.cache = cache or create_token_cache()
+        self.refresh_ratio = refresh_ratio or Config.TOKEN_REFRESH_RATIO
+        self.expiry_ratio = expiry_ratio or Config.TOKEN_EXPIRY_RATIO
+        self.lease_seconds = lease_seconds or Config.TOKEN_REFRESH_LEASE
+        self._instance_id = uuid.uuid4().hex[:8]
+
+        self._local = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._timers = {}
+
+    @property
+    def holder(self) -> str:
+        """Lease owner id, unique per worker process even after a fork"""
+        return f'{os.getpid()}-{self._instance_id}'
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _usable(self, entry, now: float) -> bool:
+        return entry is not None and now < entry['expires_at']
+
+    def _fresh_enough(self, entry, force: bool) -> bool:
+        """Whether a cached entry can stand in for a refresh"""
+        now = time.time()
+        return self._usable(entry, now) and (not force or now < entry['refresh_at'])
+
+    def get_token(self, key: str, fetch, timeout: float = None, renew=None) -> str:
+        """
+        Return a valid token for key.
+        fetch: callable returning (token, expires_in_seconds), called by at most one worker at a time
+        timeout: longest to wait for another thread's or worker's refresh (TimeoutError after that)
+        renew: fetch for the background and scheduled renewals, defaults to fetch. Pass one
+        without the caller's deadline when fetch is bound to it.
+        """
+        renew = renew or fetch
+        now = time.time()
+        entry = self._local.get(key)
+        if self._usable(entry, now):
+            LOCAL_HIT.inc()
+        else:
+            entry = self.cache.get(key)
+            if self._usable(entry, now):
+                SHARED_HIT.inc()
+                self._local[key] = entry
+                self._schedule(key, renew, entry)
+
+        if self._usable(entry, now):
+            if now >= entry['refresh_at']:
+                self._refresh_in_background(key, renew)
+            return entry['token']
+
+        MISS.inc()
+        return self._refresh(key, fetch, force=False, timeout=timeout, renew=renew)['token']
+
+    def _refresh(self, key: str, fetch, force: bool, timeout: float = None, renew=None) -> dict:
+        """Single-flight refresh: one thread per process, one process per host.
+        The renewal scheduled for the new token calls renew (defaults to fetch)."""
+        renew = renew or fetch
+        started = time.time()
+        lock = self._lock_for(key)
+        if not lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Timed out waiting for the {key} refresh")
+        try:
+            # Another thread or worker may have refreshed while we waited
+            entry = self.cache.get(key)
+            if self._fresh_enough(entry, force):
+                self._local[key] = entry
+                self._schedule(key, renew, entry)
+                return entry
+
+            wait = self.lease_seconds if timeout is None else min(self.lease_seconds, started + timeout - time.time())
+            deadline = time.time() + wait
+            while not self.cache.acquire_lease(key, self.holder, self.lease_seconds):
+                # Another worker is fetching, wait for its token
+                time.sleep(0.05)
+                entry = self.cache.get(key)
+                if self._fresh_enough(entry, force=True):
+                    self._local[key] = entry
+                    self._schedule(key, renew, entry)
+                    return entry
+                if time.time() > deadline:
+                    if timeout is not None:
+                        raise TimeoutError(f"Timed out waiting for another worker's {key} refresh")
+                    break
+
+            try:
+                token, expires_in = fetch()
+                fetched_at = time.time()
+                entry = {
+                    'token': token,
+                    'expires_at': fetched_at + expires_in * self.expiry_ratio,
+                    'refresh_at': fetched_at + expires_in * self.refresh_ratio
+                }
+                self.cache.set(key, entry)
+                self._local[key] = entry
+                self._schedule(key, renew, entry)
+                return entry
+            finally:
+                self.cache.release_lease(key, self.holder)
+        finally:
+            lock.release()
+
+    def _refresh_in_background(self, key: str, fetch):
+        lock = self._lock_for(key)
+        if lock.locked():
+            return
+        threading.Thread(target=self._background_refresh, args=(key, fetch),
+                         name=f'token-refresh-{key}', daemon=True).start()
+
+    def _background_refresh(self, key: str, fetch):
+        try:
+            self._refresh(key, fetch, force=True)
+        except Exception as e:
+            # The current token stays in use until its expiry; the next call retries
+            logger.warning("Background token refresh failed for %s: %s", key, e)
+
+    def _schedule(self, key: str, fetch, entry: dict):
+        """Renew proactively at the refresh point even if nobody asks for the token"""
+        with self._locks_guard:
+            timer = self._timers.get(key)
+            if timer is not None and timer.refresh_at == entry['refresh_at']:
+                return
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(max(entry['refresh_at'] - time.time(), 0),
+                                    self._background_refresh, args=(key, fetch))
+            timer.refresh_at = entry['refresh_at']
+            timer.daemon = True
+            self._timers[key] = timer
+            timer.start()
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            key: {
+                'expires_in': round(entry['expires_at'] - now, 1),
+                'refresh_in': round(entry['refresh_at'] - now, 1)
+            }
+            for key, entry in list(self._local.items())
+        }
@@ -1,34 +1,196 @@
+import logging
 import os
-from flask import Flask, request, jsonify
+import time
+from flask import Flask, Response, request, jsonify
+from config import Config
+import metrics
+import profiling
 from mpesa_service import MpesaService
+from http_pool import Deadline
+from circuit_breaker import CLOSED, OPEN, HALF_OPEN
+from ussd_menu import UssdMenu, MenuNode, INVALID_CHOICE
+from ussd_sessions import UssdSessionCache
+from logging_setup import setup_logging, event
+from tenant_store import TenantStore
+from payment_ledger import PaymentLedger
+from reconciliation import PaymentReconciler
+from stk_jobs import StkJobQueue, QueueFullError, FAILED, CANCELLED
+
+setup_logging()
+logger = logging.getLogger('ussd')
 
 app = Flask(__name__)
 
+# Sampled request profiling, off until switched on at /debug/profile
+profiler = profiling.RequestProfiler('ussd').init_app(app)
+
 # Initialize M-Pesa service
 try:
     mpesa_service = MpesaService()
+    stk_queue = StkJobQueue(mpesa_service, request_log=PaymentReconciler())
+    # Fetch every paybill's OAuth token now, so no tenant's payment waits on it
+    mpesa_service.prewarm_tokens(wait=False)
     mpesa_available = True
 except Exception as e:
-    print(f"M-Pesa service initialization failed: {str(e)}")
+    logger.error("M-Pesa service initialization failed: %s", e)
     mpesa_available = False
 
-# Mock tenant database - in production, this would connect to a real database
-TENANT_DB = {
-    "+254792138852": {
-        "name": "John",
-        "house_number": "HSe no. 4",
-        "estate": "Killimani estate",
-        "rent_due": 5,
-        "last_payment": "2024-01-15"
-    },
-    "+254715035359": {
-        "name": "Kenn",
-        "house_number": "HSe no. 12",
-        "estate": "Westlands",
-        "rent_due": 30000,
-        "last_payment": "2024-01-10"
-    }
-}
+# Tenant repository shared with the landlord dashboard
+tenant_store = TenantStore()
+
+# Durable, idempotent record of M-Pesa callbacks
+payment_ledger = PaymentLedger()
+
+# Tenant, balance snapshot and navigation stack of each dial in progress
+ussd_sessions = UssdSessionCache()
+
+USSD_HOPS = metrics.counter(
+    'rentpay_ussd_requests_total', "USSD hops by menu node and END/CON outcome", ('node', 'outcome')
+)
+USSD_SECONDS = metrics.histogram(
+    'rentpay_ussd_request_seconds', "Time to answer a USSD hop, by menu node", ('node',)
+)
+TENANT_LOOKUP_SECONDS = metrics.histogram(
+    'rentpay_tenant_lookup_seconds', "Tenant lookups made on a session's first hop"
+)
+
+metrics.gauge('rentpay_ussd_sessions', "USSD sessions in the session cache",
+              lambda: ussd_sessions.stats()['sessions'])
+metrics.gauge('rentpay_payment_ledger_pending_writes', "M-Pesa callbacks waiting for a group commit",
+              payment_ledger.pending_writes)
+
+
+def breaker_states() -> dict:
+    current = mpesa_service.breaker.state
+    return {state: int(state == current) for state in (CLOSED, OPEN, HALF_OPEN)}
+
+
+if mpesa_available:
+    metrics.gauge('rentpay_stk_queue_pending', "STK push jobs waiting for a worker",
+                  lambda: stk_queue.stats()['pending'])
+    metrics.gauge('rentpay_circuit_breaker_state', "Daraja circuit breaker state (1 for the current one)",
+                  breaker_states, ('state',))
+
+WELCOME_SCREEN = (
+    "CON Welcome, {name}. {house_number}, {estate}\n\n"
+    "1. Check dues\n"
+    "2. Pay rent\n"
+    "0. Exit"
+)
+
+REGISTER_SCREEN = (
+    "CON Welcome to RentPay USSD\n\n"
+    "1. Register as tenant\n"
+    "0. Exit"
+)
+
+PAY_RENT_SCREEN = (
+    "CON Pay Full Rent\n\n"
+    "Amount to pay: KES {rent_due:,}\n\n"
+    "1. Confirm payment\n"
+    "2. Back to main menu\n"
+    "0. Exit"
+)
+
+PAYMENT_METHODS_SCREEN = (
+    "CON Payment Method:\n\n"
+    "1. M-Pesa\n"
+    "2. Airtel Money\n"
+    "#. Back to payment menu\n"
+    "0. Exit"
+)
+
+TENANT_NOT_FOUND = "END Tenant not found. Please register first."
+SESSION_EXPIRED = "END Session expired. Please dial again."
+MPESA_UNAVAILABLE = "END M-Pesa is temporarily unavailable. Please try again in a few minutes."
+
+
+def mpesa_stk_screen(context: dict) -> str:
+    """M-Pesa payment - queue the STK push and answer the tenant immediately"""
+    tenant = context['tenant']
+    if not mpesa_available:
+        return "END M-Pesa service is not available. Please contact support."
+    if mpesa_service.breaker.is_open():
+        # Daraja is failing or too slow - don't queue a push the tenant will never get
+        return MPESA_UNAVAILABLE
+
+    try:
+        # Format phone number for M-Pesa
+        formatted_phone = mpesa_service.format_phone_number(context['phone_number'])
+
+        job = stk_queue.submit(
+            session_id=context['session_id'],
+            phone=formatted_phone,
+            amount=tenant['rent_due'],
+            account_ref=f"RENT_{tenant['house_number']}",
+            description=f"Rent {tenant['estate']}",
+            deadline=Deadline(Config.STK_PUSH_DEADLINE),
+            integration=mpesa_service.integrations.for_tenant(tenant)
+        )
+        logger.info("Queued STK push job", extra=event(
+            'stk.queued', job_id=job.job_id, session_id=context['session_id'], amount=tenant['rent_due']
+        ))
+
+    except QueueFullError:
+        return "END M-Pesa is busy right now. Please try again in a few minutes."
+    except Exception as e:
+        logger.exception("STK push error", extra=event('stk.error'))
+        return f"END Payment error: {str(e)}"
+
+    response = "CON M-Pesa STK Push Sent!\n\n"
+    response += "Check your phone for M-Pesa prompt\n"
+    response += "Enter PIN to complete payment\n\n"
+    response += "1. Payment completed\n"
+    response += "#. Back to payment methods\n"
+    response += "0. Exit"
+    return response
+
+
+def lookup_tenant(phone_number: str):
+    with TENANT_LOOKUP_SECONDS.time():
+        return tenant_store.get(phone_number)
+
+
+def payment_completed_screen(context: dict) -> str:
+    """Tenant reports the payment as done - surface a failed STK push if we know of one"""
+    job = stk_queue.get_by_session(context['session_id']) if mpesa_available else None
+    if job is not None and job.status in (FAILED, CANCELLED):
+        return f"END Payment not completed: {job.error or 'M-Pesa request failed'}"
+    return "END Payment successful! You will receive an SMS confirmation. Thank you for using RentPay USSD."
+
+
+# USSD menu graph: every screen, its numbered options and where '#' goes back to
+MENU = UssdMenu([
+    MenuNode('main', WELCOME_SCREEN,
+             options={'1': 'check_dues', '2': 'pay_rent', '0': 'exit'},
+             tenant_required=True, no_tenant_screen=REGISTER_SCREEN),
+    MenuNode('check_dues',
+             "CON Your rent details:\n\n"
+             "Rent due: KES {rent_due:,}\n"
+             "Last payment: {last_payment}\n\n"
+             "1. Back to main menu\n"
+             "0. Exit",
+             options={'1': 'main', '0': 'exit'}, back='main',
+             tenant_required=True, no_tenant_screen=TENANT_NOT_FOUND),
+    MenuNode('pay_rent', PAY_RENT_SCREEN,
+             options={'1': 'payment_methods', '2': 'main', '0': 'exit'}, back='main',
+             tenant_required=True, no_tenant_screen=TENANT_NOT_FOUND),
+    MenuNode('payment_methods', PAYMENT_METHODS_SCREEN,
+             options={'1': 'mpesa', '2': 'airtel', '3': 'pay_rent', '0': 'exit'}, back='pay_rent'),
+    MenuNode('mpesa', mpesa_stk_screen,
+             options={'1': 'payment_completed', '0': 'exit'}, back='payment_methods',
+             tenant_required=True, no_tenant_screen=SESSION_EXPIRED),
+    MenuNode('airtel',
+             "CON Airtel Money Payment\n\n"
+             "Airtel Money integration coming soon!\n\n"
+             "1. Back to payment methods\n"
+             "#. Back\n"
+             "0. Exit",
+             options={'1': 'payment_methods', '0': 'exit'}, back='pay_rent'),
+    MenuNode('payment_completed', payment_completed_screen),
+    MenuNode('exit', "END Thank you for using RentPay USSD. Goodbye!"),
+], root='main')
+
 
 @app.route("/ussd", methods=['POST'])
 def ussd():
@@ -38,202 +200,22 @@ def ussd():
     phone_number = request.values.get("phoneNumber", None)
     text = request.values.get("text", "")
 
-    if text == '':
-        # Welcome screen with personalized tenant information
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-            response += "1. Check dues\n"
-            response += "2. Pay rent\n"
-            response += "0. Exit"
-        else:
-            # New tenant registration flow
-            response = "CON Welcome to RentPay USSD\n\n"
-            response += "1. Register as tenant\n"
-            response += "0. Exit"
-
-    elif text == '1':
-        # Check dues option
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Your rent details:\n\n"
-            response += f"Rent due: KES {tenant['rent_due']:,}\n"
-            response += f"Last payment: {tenant['last_payment']}\n\n"
-            response += "1. Back to main menu\n"
-            response += "0. Exit"
-        else:
-            response = "END Tenant not found. Please register first."
-
-    elif text == '2':
-        # Pay rent option - only full amount
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Pay Full Rent\n\n"
-            response += f"Amount to pay: KES {tenant['rent_due']:,}\n\n"
-            response += "1. Confirm payment\n"
-            response += "2. Back to main menu\n"
-            response += "0. Exit"
-        else:
-            response = "END Tenant not found. Please register first."
-
-    elif text == '0':
-        # Exit option
-        response = "END Thank you for using RentPay USSD. Goodbye!"
-
-    elif text == '1*1':
-        # Back to main menu from check dues
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-            response += "1. Check dues\n"
-            response += "2. Pay rent\n"
-            response += "0. Exit"
-        else:
-            response = "END Session expired. Please dial again."
-
-    elif text == '2*1':
-        # Confirm payment - show payment methods
-        response = "CON Payment Method:\n\n"
-        response += "1. M-Pesa\n"
-        response += "2. Airtel Money\n"
-        response += "#. Back to payment menu\n"
-        response += "0. Exit"
-
-    elif text == '2*2':
-        # Back to main menu from payment
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-            response += "1. Check dues\n"
-            response += "2. Pay rent\n"
-            response += "0. Exit"
-        else:
-            response = "END Session expired. Please dial again."
-
-    elif text == '2*1*1':
-        # M-Pesa payment - initiate STK push
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            if not mpesa_available:
-                response = "END M-Pesa service is not available. Please contact support."
-            else:
-                try:
-                    # Format phone number for M-Pesa
-                    formatted_phone = mpesa_service.format_phone_number(phone_number)
-                    print(f"Formatted phone: {formatted_phone}")
-                    
-                    # Send STK push
-                    print(f"Sending STK push for amount: {tenant['rent_due']}")
-                    stk_response = mpesa_service.send_stk_push(
-                        phone=formatted_phone,
-                        amount=tenant['rent_due'],
-                        account_ref=f"RENT_{tenant['house_number']}",
-                        description=f"Rent {tenant['estate']}"
-                    )
-                    
-                    print(f"STK push response: {stk_response}")
-                    
-                    if stk_response.get('ResponseCode') == '0':
-                        response = "CON M-Pesa STK Push Sent!\n\n"
-                        response += "Check your phone for M-Pesa prompt\n"
-                        response += "Enter PIN to complete payment\n\n"
-                        response += "1. Payment completed\n"
-                        response += "#. Back to payment methods\n"
-                        response += "0. Exit"
-                    else:
-                        error_msg = stk_response.get('errorMessage', 'Unknown error')
-                        response = f"END STK push failed: {error_msg}"
-                        
-                except Exception as e:
-                    print(f"STK push error: {str(e)}")
-                    response = f"END Payment error: {str(e)}"
-        else:
-            response = "END Session expired. Please dial again."
-
-    elif text == '2*1*2':
-        # Airtel Money payment (placeholder for future implementation)
-        response = "CON Airtel Money Payment\n\n"
-        response += "Airtel Money integration coming soon!\n\n"
-        response += "1. Back to payment methods\n"
-        response += "#. Back to payment menu\n"
-        response += "0. Exit"
-
-    elif text == '2*1*3':
-        # Back to payment confirmation
-        tenant = TENANT_DB.get(phone_number, None)
-        if tenant:
-            response = f"CON Pay Full Rent\n\n"
-            response += f"Amount to pay: KES {tenant['rent_due']:,}\n\n"
-            response += "1. Confirm payment\n"
-            response += "2. Back to main menu\n"
-            response += "0. Exit"
-        else:
-            response = "END Session expired. Please dial again."
-
-    elif text == '2*1*1*1':
-        # M-Pesa payment completed
-        response = "END Payment successful! You will receive an SMS confirmation. Thank you for using RentPay USSD."
-
-    elif text == '2*1*2*1':
-        # Back to payment methods from Airtel Money
-        response = "CON Payment Method:\n\n"
-        response += "1. M-Pesa\n"
-        response += "2. Airtel Money\n"
-        response += "#. Back to payment menu\n"
-        response += "0. Exit"
-
-    # Handle # for going back
-    elif text.endswith('#'):
-        # Remove the # and go back one level
-        previous_text = text[:-1]
-        if previous_text == '':
-            # If just #, go to main menu
-            tenant = TENANT_DB.get(phone_number, None)
-            if tenant:
-                response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-                response += "1. Check dues\n"
-                response += "2. Pay rent\n"
-                response += "0. Exit"
-            else:
-                response = "END Session expired. Please dial again."
-        elif previous_text == '2*1':
-            # Back from payment methods to payment confirmation
-            tenant = TENANT_DB.get(phone_number, None)
-            if tenant:
-                response = f"CON Pay Full Rent\n\n"
-                response += f"Amount to pay: KES {tenant['rent_due']:,}\n\n"
-                response += "1. Confirm payment\n"
-                response += "2. Back to main menu\n"
-                response += "0. Exit"
-            else:
-                response = "END Session expired. Please dial again."
-        elif previous_text == '2':
-            # Back from payment confirmation to main menu
-            tenant = TENANT_DB.get(phone_number, None)
-            if tenant:
-                response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-                response += "1. Check dues\n"
-                response += "2. Pay rent\n"
-                response += "0. Exit"
-            else:
-                response = "END Session expired. Please dial again."
-        elif previous_text == '1':
-            # Back from check dues to main menu
-            tenant = TENANT_DB.get(phone_number, None)
-            if tenant:
-                response = f"CON Welcome, {tenant['name']}. {tenant['house_number']}, {tenant['estate']}\n\n"
-                response += "1. Check dues\n"
-                response += "2. Pay rent\n"
-                response += "0. Exit"
-            else:
-                response = "END Session expired. Please dial again."
-        else:
-            # For other levels, try to go back one step
-            response = "END Invalid back navigation. Please dial again."
-
-    else:
-        # Handle invalid choices
-        response = "END Invalid choice. Please dial again."
+    started = time.perf_counter()
+    session = ussd_sessions.get(session_id, phone_number)
+    context = {
+        'session_id': session_id,
+        'phone_number': phone_number,
+        'tenant': session.tenant
+    }
+    response = MENU.respond(text, context, lambda: session.load_tenant(lookup_tenant), session)
+    ended = response.startswith('END')
+    if ended:
+        ussd_sessions.end(session_id)
+    node = 'invalid' if response is INVALID_CHOICE else session.stack[-1]
+    USSD_SECONDS.labels(node).observe(time.perf_counter() - started)
+    USSD_HOPS.labels(node, 'END' if ended else 'CON').inc()
+    profiling.tag(f'ussd:{node}')
+    logger.debug("USSD hop", extra=event('ussd.hop', session_id=session_id, text=text))
 
     # Send the response back to the API
     return response
@@ -244,22 +226,45 @@ def mpesa_callback():
     try:
         callback_data = request.get_json()
         
-        # Log the callback data
-        print(f"M-Pesa Callback: {callback_data}")
+        # Append to the ledger and update the tenant's balance; acked once durable.
+        # Daraja retries of the same callback are recognised and ignored.
+        try:
+            outcome = payment_ledger.record(callback_data)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
         
-        # Process the callback data
-        # In production, you would:
-        # 1. Verify the callback signature
-        # 2. Update payment status in database
-        # 3. Send confirmation SMS to tenant
-        # 4. Update rent due amount
+        stk_callback = callback_data.get('Body', {}).get('stkCallback', {})
+        if mpesa_available:
+            stk_queue.record_result(
+                stk_callback['CheckoutRequestID'],
+                stk_callback.get('ResultCode'),
+                stk_callback.get('ResultDesc')
+            )
         
-        return jsonify({"status": "success", "message": "Callback received"}), 200
+        return jsonify({"status": "success", "message": "Callback received", "ledger": outcome}), 200
         
     except Exception as e:
-        print(f"Callback error: {str(e)}")
+        logger.exception("Callback error", extra=event('mpesa.callback_error'))
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route("/mpesa/stk-status", methods=['GET'])
+def stk_status():
+    """Poll an STK push job by job id, USSD sessionId or CheckoutRequestID"""
+    if not mpesa_available:
+        return jsonify({"error": "M-Pesa service not available"}), 500
+
+    job = None
+    if request.args.get('jobId'):
+        job = stk_queue.get(request.args['jobId'])
+    elif request.args.get('sessionId'):
+        job = stk_queue.get_by_session(request.args['sessionId'])
+    elif request.args.get('checkoutRequestId'):
+        job = stk_queue.get_by_checkout(request.args['checkoutRequestId'])
+
+    if job is None:
+        return jsonify({"error": "STK push job not found"}), 404
+    return jsonify(job.to_dict())
+
 @app.route("/debug/mpesa", methods=['GET'])
 def debug_mpesa():
     """Debug endpoint to check M-Pesa service status"""
@@ -275,12 +280,23 @@ def debug_mpesa():
         
         return jsonify({
             "mpesa_service_available": mpesa_available,
+            "stk_queue": stk_queue.stats() if mpesa_available else None,
+            "http_pool": mpesa_service.pool_stats() if mpesa_available else None,
+            "circuit_breaker": mpesa_service.breaker_stats() if mpesa_available else None,
+            "token_cache": mpesa_service.token_manager.stats() if mpesa_available else None,
+            "integrations": mpesa_service.integrations.to_list() if mpesa_available else None,
+            "ussd_sessions": ussd_sessions.stats(),
             "config_status": config_status,
             "env_file_exists": os.path.exists('.env')
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (this worker's numbers)"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/test/mpesa", methods=['GET'])
 def test_mpesa():
     """Test endpoint to validate M-Pesa configuration and test STK push"""
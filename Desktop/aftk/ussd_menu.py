@@ -0,0 +1,139 @@
+"""
+USSD menu engine for RentPay
+
+Menus are declared as a graph of MenuNode objects (screens, numbered options
+and a '#' back edge) and compiled once at startup into a dispatch table.
+Resolving the gateway's `text` path is then a walk of dict lookups, memoized
+per path, instead of comparing the text against every branch.
+
+Navigation keeps a stack of the screens visited: '#' returns to the previous
+screen, and choosing a screen already on the stack (e.g. "Back to main menu")
+unwinds to it. A node's declared back edge is only used when there is nothing
+to pop. When a USSD session is passed in, its stack is extended with the new
+inputs of each hop instead of replaying the whole path.
+"""
+
+from functools import lru_cache
+from string import Formatter
+
+BACK = '#'
+INVALID_CHOICE = "END Invalid choice. Please dial again."
+
+
+class MenuNode:
+    def __init__(self, node_id: str, screen, options: dict = None, back: str = None,
+                 tenant_required: bool = False, no_tenant_screen: str = None):
+        """
+        screen: response text (may use tenant fields, e.g. {name} or {rent_due:,})
+                or a callable taking the request context and returning the text
+        options: menu input -> node_id
+        back: node_id reached with '#' when nothing was visited before this node
+              (defaults to staying on this node)
+        """
+        self.node_id = node_id
+        self.screen = screen
+        self.options = options or {}
+        self.back = back
+        self.tenant_required = tenant_required
+        self.no_tenant_screen = no_tenant_screen
+
+
+class UssdMenu:
+    def __init__(self, nodes: list, root: str, cache_size: int = 4096):
+        """Compile the menu graph into a dispatch table"""
+        self.nodes = {node.node_id: node for node in nodes}
+        if root not in self.nodes:
+            raise ValueError(f"Unknown root node: {root}")
+        self.root = root
+
+        self._table = {}
+        self._renderers = {}
+        for node in nodes:
+            transitions = dict(node.options)
+            transitions[BACK] = node.back or node.node_id
+            for token, target in transitions.items():
+                if target not in self.nodes:
+                    raise ValueError(f"Node '{node.node_id}' option '{token}' points to unknown node '{target}'")
+            self._table[node.node_id] = transitions
+            self._renderers[node.node_id] = self._compile_screen(node.screen)
+
+        self.resolve_stack = lru_cache(maxsize=cache_size)(self._resolve_stack)
+
+    @staticmethod
+    def _compile_screen(screen):
+        """Turn a screen declaration into a callable(context) -> str"""
+        if callable(screen):
+            return screen
+        has_fields = any(field is not None for _, field, _, _ in Formatter().parse(screen))
+        if not has_fields:
+            return lambda context: screen
+        return lambda context: screen.format_map(context['tenant'])
+
+    @staticmethod
+    def parse(text: str) -> tuple:
+        """Split the gateway text ('2*1*1', '2*1#') into menu inputs"""
+        if not text:
+            return ()
+        return tuple(token for token in text.replace(BACK, '*' + BACK).split('*') if token)
+
+    def step(self, node_id: str, token: str):
+        """Follow one input from a node, returns None for an invalid choice"""
+        return self._table[node_id].get(token)
+
+    def walk(self, stack: tuple, tokens) -> tuple:
+        """Apply menu inputs to a navigation stack, returns None on an invalid choice"""
+        stack = list(stack)
+        for token in tokens:
+            if token == BACK and len(stack) > 1:
+                stack.pop()
+                continue
+            target = self._table[stack[-1]].get(token)
+            if target is None:
+                return None
+            if target in stack:
+                del stack[stack.index(target) + 1:]
+            elif token == BACK:
+                stack[-1] = target
+            else:
+                stack.append(target)
+        return tuple(stack)
+
+    def _resolve_stack(self, text: str):
+        """Navigation stack reached by a text path, or None if any input is invalid"""
+        return self.walk((self.root,), self.parse(text))
+
+    def resolve(self, text: str):
+        """Return the node_id reached by a text path, or None if any input is invalid"""
+        stack = self.resolve_stack(text)
+        return stack[-1] if stack else None
+
+    def render(self, node_id: str, context: dict, load_tenant=None) -> str:
+        """Render a node's screen, looking the tenant up only if the node needs it"""
+        node = self.nodes[node_id]
+        if node.tenant_required:
+            if context.get('tenant') is None and load_tenant is not None:
+                context['tenant'] = load_tenant()
+            if not context.get('tenant'):
+                return node.no_tenant_screen
+        return self._renderers[node_id](context)
+
+    def respond(self, text: str, context: dict, load_tenant=None, session=None) -> str:
+        """Resolve the text path and render the resulting screen.
+
+        With a session (anything with `tokens` and `stack` attributes) only the
+        inputs added since its previous hop are walked."""
+        if session is None:
+            stack = self.resolve_stack(text)
+        else:
+            tokens = self.parse(text)
+            seen = len(session.tokens)
+            if session.stack and tokens[:seen] == session.tokens:
+                stack = self.walk(session.stack, tokens[seen:])
+            else:
+                stack = self.resolve_stack(text)
+            if stack is not None:
+                session.tokens, session.stack = tokens, stack
+
+        if stack is None:
+            return INVALID_CHOICE
+        return self.render(stack[-1], context, load_tenant)
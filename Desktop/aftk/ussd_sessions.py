@@ -0,0 +1,83 @@
+"""
+USSD session state kept between the hops of one dial
+
+The gateway posts the same sessionId on every hop of a dial. The first hop
+resolves the tenant (a snapshot of their balance included) and later hops
+reuse it together with the navigation stack, so a dial costs one tenant
+lookup and the amount shown on "Pay rent" is the amount the STK push charges.
+Sessions expire after the gateway's session lifetime. A hop that lands on
+another worker process simply starts a fresh session from the text path.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+
+
+class UssdSession:
+    __slots__ = ('session_id', 'phone_number', 'tenant', 'tenant_loaded', 'tokens', 'stack',
+                 'expires_at')
+
+    def __init__(self, session_id: str, phone_number: str, expires_at: float):
+        self.session_id = session_id
+        self.phone_number = phone_number
+        self.tenant = None
+        self.tenant_loaded = False  # also remembers that an unknown caller has no tenant
+        self.tokens = ()
+        self.stack = ()
+        self.expires_at = expires_at
+
+    def load_tenant(self, lookup) -> dict:
+        """The tenant for this dial, looked up once per session"""
+        if not self.tenant_loaded:
+            self.tenant = lookup(self.phone_number)
+            self.tenant_loaded = True
+        return self.tenant
+
+
+class UssdSessionCache:
+    def __init__(self, ttl: float = None, max_sessions: int = None):
+        self.ttl = ttl or Config.USSD_SESSION_TTL
+        self.max_sessions = max_sessions or Config.USSD_MAX_SESSIONS
+        self._sessions = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str, phone_number: str) -> UssdSession:
+        """This dial's session, creating it on the first hop"""
+        now = time.monotonic()
+        if not session_id:
+            return UssdSession(session_id, phone_number, now + self.ttl)
+
+        with self._lock:
+            self._evict(now)
+            session = self._sessions.get(session_id)
+            if session is not None and session.phone_number == phone_number:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+            else:
+                session = UssdSession(session_id, phone_number, now)
+                self._sessions[session_id] = session
+                self.misses += 1
+            session.expires_at = now + self.ttl
+            return session
+
+    def end(self, session_id: str):
+        """Forget a session once the dial is over"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict(self, now: float):
+        # Sessions are kept in last-use order, so expired ones are at the front
+        sessions = self._sessions
+        while sessions:
+            session_id, session = next(iter(sessions.items()))
+            if session.expires_at > now and len(sessions) < self.max_sessions:
+                break
+            del sessions[session_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'sessions': len(self._sessions), 'hits': self.hits, 'misses': self.misses}